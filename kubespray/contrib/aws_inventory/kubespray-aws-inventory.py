@@ -1,22 +1,29 @@
 #!/usr/bin/env python
 
 from __future__ import print_function
-import boto3
 import os
 import argparse
 import json
+import tempfile
+import time
+
+ROLE_TAG = "kubespray-role"
+GROUPS = ["kube_control_plane", "kube_node", "etcd"]
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "kubespray-aws-inventory.json")
+CACHE_TTL = 300
 
 class SearchEC2Tags(object):
 
-  def __init__(self):
-    self.parse_args()
+  def __init__(self, argv=None, session=None):
+    self.parse_args(argv)
+    ##Build the sessions with boto3 only when EC2 is really queried, importing it costs more than a warm cache
+    self.session = session
     if self.args.list:
       self.search_tags()
     if self.args.host:
-      data = {}
-      print(json.dumps(data, indent=2))
+      self.host_vars()
 
-  def parse_args(self):
+  def parse_args(self, argv=None):
 
     ##Check if VPC_VISIBILITY is set, if not default to private
     if "VPC_VISIBILITY" in os.environ:
@@ -24,58 +31,136 @@ class SearchEC2Tags(object):
     else:
       self.vpc_visibility = "private"
 
-    ##Support --list and --host flags. We largely ignore the host one.
+    ##Query every region of AWS_REGIONS, or only AWS_REGION
+    self.regions = [region.strip() for region in os.getenv('AWS_REGIONS', os.getenv('AWS_REGION', '')).split(',') if region.strip()] or [None]
+    self.cluster_name = os.getenv('CLUSTER_NAME')
+
+    ##Keep the inventory in a cache file for AWS_INVENTORY_CACHE_TTL seconds, 0 disables the cache
+    self.cache_path = os.getenv('AWS_INVENTORY_CACHE', CACHE_PATH)
+    self.cache_ttl = int(os.getenv('AWS_INVENTORY_CACHE_TTL', CACHE_TTL))
+
+    ##Support --list and --host flags.
     parser = argparse.ArgumentParser()
     parser.add_argument('--list', action='store_true', default=False, help='List instances')
-    parser.add_argument('--host', action='store_true', help='Get all the variables about a specific instance')
-    self.args = parser.parse_args()
+    parser.add_argument('--host', help='Get all the variables about a specific instance')
+    parser.add_argument('--refresh-cache', action='store_true', default=False, help='Query EC2 even when the cache is fresh')
+    self.args = parser.parse_args(argv)
+
+  def instances(self, region):
+    ##Search ec2 once for the running nodes of the cluster with any kubespray-role
+    if self.session:
+      ec2 = self.session(region_name=region).client('ec2')
+    else:
+      import boto3
+      ec2 = boto3.session.Session(region_name=region).client('ec2')
+    filters = [{'Name': 'tag:'+ROLE_TAG, 'Values': ['*']}, {'Name': 'instance-state-name', 'Values': ['running']}]
+    if self.cluster_name:
+      filters.append({'Name': 'tag-key', 'Values': ['kubernetes.io/cluster/'+self.cluster_name]})
+    instances = []
+    for page in ec2.get_paginator('describe_instances').paginate(Filters=filters):
+      for reservation in page['Reservations']:
+        instances.extend(reservation['Instances'])
+    return instances
+
+  def hostvars(self, instance, tags):
+    ##Suppose default vpc_visibility is private
+    dns_name = instance.get('PrivateDnsName')
+    ansible_host = {
+      'ansible_ssh_host': instance.get('PrivateIpAddress')
+    }
+
+    ##Override when vpc_visibility actually is public
+    if self.vpc_visibility == "public":
+      dns_name = instance.get('PublicDnsName')
+      ansible_host = {
+        'ansible_ssh_host': instance.get('PublicIpAddress')
+      }
+
+    ##Set when instance actually has node_labels
+    if 'kubespray-node-labels' in tags:
+      ansible_host['node_labels'] = dict([ label.strip().split('=') for label in tags['kubespray-node-labels'].split(',') ])
+
+    ##Set when instance actually has node_taints
+    if 'kubespray-node-taints' in tags:
+      ansible_host['node_taints'] = list([ taint.strip() for taint in tags['kubespray-node-taints'].split(',') ])
+
+    return dns_name, ansible_host
+
+  def inventory(self):
+    from concurrent.futures import ThreadPoolExecutor
 
-  def search_tags(self):
     hosts = {}
     hosts['_meta'] = { 'hostvars': {} }
-
-    ##Search ec2 three times to find nodes of each group type. Relies on kubespray-role key/value.
-    for group in ["kube_control_plane", "kube_node", "etcd"]:
+    for group in GROUPS:
       hosts[group] = []
-      tag_key = "kubespray-role"
-      tag_value = ["*"+group+"*"]
-      region = os.environ['AWS_REGION']
-
-      ec2 = boto3.resource('ec2', region)
-      filters = [{'Name': 'tag:'+tag_key, 'Values': tag_value}, {'Name': 'instance-state-name', 'Values': ['running']}]
-      cluster_name = os.getenv('CLUSTER_NAME')
-      if cluster_name:
-        filters.append({'Name': 'tag-key', 'Values': ['kubernetes.io/cluster/'+cluster_name]})
-      instances = ec2.instances.filter(Filters=filters)
-      for instance in instances:
 
-        ##Suppose default vpc_visibility is private
-        dns_name = instance.private_dns_name
-        ansible_host = {
-          'ansible_ssh_host': instance.private_ip_address
-        }
-
-        ##Override when vpc_visibility actually is public
-        if self.vpc_visibility == "public":
-          dns_name = instance.public_dns_name
-          ansible_host = {
-            'ansible_ssh_host': instance.public_ip_address
-          }
-
-        ##Set when instance actually has node_labels
-        node_labels_tag = list(filter(lambda t: t['Key'] == 'kubespray-node-labels', instance.tags))
-        if node_labels_tag:
-          ansible_host['node_labels'] = dict([ label.strip().split('=') for label in node_labels_tag[0]['Value'].split(',') ])
-
-        ##Set when instance actually has node_taints
-        node_taints_tag = list(filter(lambda t: t['Key'] == 'kubespray-node-taints', instance.tags))
-        if node_taints_tag:
-          ansible_host['node_taints'] = list([ taint.strip() for taint in node_taints_tag[0]['Value'].split(',') ])
-
-        hosts[group].append(dns_name)
+    ##Query the regions in parallel, each with its own session, and merge them in the order of AWS_REGIONS
+    with ThreadPoolExecutor(max_workers=max(len(self.regions), 1)) as executor:
+      regions = list(executor.map(self.instances, self.regions))
+
+    ##Split the instances in groups by the value of their kubespray-role tag
+    for instances in regions:
+      for instance in instances:
+        tags = dict((tag['Key'], tag['Value']) for tag in instance.get('Tags', []))
+        dns_name, ansible_host = self.hostvars(instance, tags)
+        for group in GROUPS:
+          if group in tags.get(ROLE_TAG, ''):
+            hosts[group].append(dns_name)
         hosts['_meta']['hostvars'][dns_name] = ansible_host
 
     hosts['k8s_cluster'] = {'children':['kube_control_plane', 'kube_node']}
-    print(json.dumps(hosts, sort_keys=True, indent=2))
+    return hosts
+
+  def cache_key(self):
+    ##A cache written for other regions, cluster or visibility is not used
+    return {'regions': self.regions, 'cluster_name': self.cluster_name, 'vpc_visibility': self.vpc_visibility}
+
+  def read_cache(self):
+    if self.cache_ttl <= 0 or self.args.refresh_cache:
+      return None
+    try:
+      if time.time() - os.path.getmtime(self.cache_path) > self.cache_ttl:
+        return None
+      with open(self.cache_path) as f:
+        cache = json.load(f)
+    except (OSError, IOError, ValueError):
+      return None
+    if cache.get('key') != self.cache_key():
+      return None
+    return cache['inventory']
+
+  def write_cache(self, hosts):
+    if self.cache_ttl <= 0:
+      return
+    ##Write to a temporary file renamed over the cache, so concurrent runs never read a partial one
+    directory = os.path.dirname(self.cache_path) or '.'
+    try:
+      if not os.path.isdir(directory):
+        os.makedirs(directory)
+      fd, tmp = tempfile.mkstemp(dir=directory, prefix='.kubespray-aws-inventory')
+      with os.fdopen(fd, 'w') as f:
+        json.dump({'key': self.cache_key(), 'inventory': hosts}, f)
+      os.rename(tmp, self.cache_path)
+    except (OSError, IOError):
+      pass
+
+  def cached_inventory(self):
+    hosts = self.read_cache()
+    if hosts is None:
+      hosts = self.inventory()
+      self.write_cache(hosts)
+    return hosts
 
-SearchEC2Tags()
+  def search_tags(self):
+    print(json.dumps(self.cached_inventory(), sort_keys=True, indent=2))
+
+  def host_vars(self):
+    ##Answer from the cache, query EC2 again only for a host it does not know
+    hosts = self.cached_inventory()
+    if self.args.host not in hosts['_meta']['hostvars'] and not self.args.refresh_cache:
+      self.args.refresh_cache = True
+      hosts = self.cached_inventory()
+    print(json.dumps(hosts['_meta']['hostvars'].get(self.args.host, {}), sort_keys=True, indent=2))
+
+if __name__ == '__main__':
+  SearchEC2Tags()
@@ -0,0 +1,163 @@
+import importlib.util
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+import boto3
+from botocore.stub import Stubber
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "kubespray-aws-inventory.py")
+spec = importlib.util.spec_from_file_location("kubespray_aws_inventory", SCRIPT)
+aws_inventory = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(aws_inventory)
+
+
+def instance(name, roles, **tags):
+    tags = dict(tags, **{"kubespray-role": roles})
+    return {
+        "InstanceId": "i-" + name,
+        "PrivateDnsName": name + ".ec2.internal",
+        "PrivateIpAddress": "10.0.0." + name[-1],
+        "PublicDnsName": name + ".compute.amazonaws.com",
+        "PublicIpAddress": "54.0.0." + name[-1],
+        "Tags": [{"Key": key, "Value": value} for key, value in tags.items()],
+    }
+
+
+class StubSession(object):
+    """A boto3 session whose ec2 client answers from a local stub."""
+
+    def __init__(self, pages, region="eu-west-1", delay=0.0):
+        self.client_ = boto3.session.Session(
+            region_name=region, aws_access_key_id="testing", aws_secret_access_key="testing").client("ec2")
+        self.stubber = Stubber(self.client_)
+        for index, page in enumerate(pages):
+            response = {"Reservations": [{"ReservationId": "r-%d" % index, "Instances": page}]}
+            if index < len(pages) - 1:
+                response["NextToken"] = "page%d" % (index + 1)
+            self.stubber.add_response("describe_instances", response)
+        self.stubber.activate()
+        self.delay = delay
+        self.clients = 0
+        self.regions = []
+
+    def __call__(self, region_name=None):
+        self.regions.append(region_name)
+        return self
+
+    def client(self, name):
+        self.clients += 1
+        time.sleep(self.delay)
+        return self.client_
+
+
+class TestSearchEC2Tags(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.env = {"AWS_REGION": "eu-west-1", "AWS_INVENTORY_CACHE_TTL": "0",
+                    "AWS_INVENTORY_CACHE": os.path.join(self.cache_dir, "inventory.json")}
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def run_script(self, argv, session, env=None):
+        out = io.StringIO()
+        with mock.patch.dict(os.environ, dict(self.env, **(env or {}))), redirect_stdout(out):
+            aws_inventory.SearchEC2Tags(argv, session=session)
+        return json.loads(out.getvalue())
+
+    def run_inventory(self, pages, env=None):
+        session = StubSession(pages)
+        hosts = self.run_script(["--list"], session, env)
+        session.stubber.assert_no_pending_responses()
+        return session, hosts
+
+    def test_single_query_split_in_groups(self):
+        session, hosts = self.run_inventory([
+            [instance("node1", "kube_control_plane,etcd"), instance("node2", "kube_node")],
+            [instance("node3", "kube_node,etcd", **{"kubespray-node-labels": "disk=ssd, zone=a",
+                                                      "kubespray-node-taints": "dedicated=db:NoSchedule"})],
+        ])
+        # both pages come from one paginated describe_instances on one client
+        self.assertEqual(session.clients, 1)
+        self.assertEqual(hosts["kube_control_plane"], ["node1.ec2.internal"])
+        self.assertEqual(hosts["kube_node"], ["node2.ec2.internal", "node3.ec2.internal"])
+        self.assertEqual(hosts["etcd"], ["node1.ec2.internal", "node3.ec2.internal"])
+        self.assertEqual(hosts["k8s_cluster"], {"children": ["kube_control_plane", "kube_node"]})
+        self.assertEqual(hosts["_meta"]["hostvars"]["node3.ec2.internal"], {
+            "ansible_ssh_host": "10.0.0.3",
+            "node_labels": {"disk": "ssd", "zone": "a"},
+            "node_taints": ["dedicated=db:NoSchedule"],
+        })
+        self.assertEqual(hosts["_meta"]["hostvars"]["node1.ec2.internal"], {"ansible_ssh_host": "10.0.0.1"})
+
+    def test_filters(self):
+        session = StubSession([])
+        session.stubber.add_response("describe_instances", {"Reservations": []}, {"Filters": [
+            {"Name": "tag:kubespray-role", "Values": ["*"]},
+            {"Name": "instance-state-name", "Values": ["running"]},
+            {"Name": "tag-key", "Values": ["kubernetes.io/cluster/prod"]},
+        ]})
+        self.run_script(["--list"], session, {"CLUSTER_NAME": "prod"})
+        session.stubber.assert_no_pending_responses()
+
+    def test_public_visibility(self):
+        _, hosts = self.run_inventory([[instance("node1", "kube_node")]], env={"VPC_VISIBILITY": "public"})
+        self.assertEqual(hosts["kube_node"], ["node1.compute.amazonaws.com"])
+        self.assertEqual(hosts["_meta"]["hostvars"]["node1.compute.amazonaws.com"], {"ansible_ssh_host": "54.0.0.1"})
+
+    def test_regions_in_parallel(self):
+        # the first region of AWS_REGIONS answers last
+        sessions = {
+            "eu-west-1": StubSession([[instance("node1", "kube_node,etcd")]], "eu-west-1"),
+            "us-east-1": StubSession([[instance("node2", "kube_node", **{"kubespray-node-taints": "a=b:NoSchedule"})]],
+                                     "us-east-1", delay=0.2),
+        }
+        hosts = self.run_script(["--list"], lambda region_name: sessions[region_name],
+                                {"AWS_REGIONS": "us-east-1, eu-west-1"})
+        for session in sessions.values():
+            session.stubber.assert_no_pending_responses()
+        # merged in the order of AWS_REGIONS, not in the order the regions answered
+        self.assertEqual(hosts["kube_node"], ["node2.ec2.internal", "node1.ec2.internal"])
+        self.assertEqual(hosts["etcd"], ["node1.ec2.internal"])
+        self.assertEqual(list(hosts["_meta"]["hostvars"]), ["node1.ec2.internal", "node2.ec2.internal"])
+        self.assertEqual(hosts["_meta"]["hostvars"]["node2.ec2.internal"]["node_taints"], ["a=b:NoSchedule"])
+
+    def test_cache(self):
+        self.env["AWS_INVENTORY_CACHE_TTL"] = "300"
+        node = instance("node1", "kube_node", **{"kubespray-node-labels": "disk=ssd"})
+        hosts = self.run_inventory([[node]])[1]
+        # served from the cache, the stub has no response left
+        self.assertEqual(self.run_script(["--list"], StubSession([])), hosts)
+        self.assertEqual(self.run_script(["--host", "node1.ec2.internal"], StubSession([])),
+                         {"ansible_ssh_host": "10.0.0.1", "node_labels": {"disk": "ssd"}})
+        # a cache of another visibility is not used
+        public = self.run_inventory([[node]], env={"VPC_VISIBILITY": "public"})[1]
+        self.assertEqual(public["kube_node"], ["node1.compute.amazonaws.com"])
+        # --refresh-cache and an expired cache query EC2 again
+        session = StubSession([[node]])
+        self.run_script(["--list", "--refresh-cache"], session)
+        session.stubber.assert_no_pending_responses()
+        os.utime(self.env["AWS_INVENTORY_CACHE"], (0, 0))
+        session = StubSession([[node]])
+        self.run_script(["--list"], session)
+        session.stubber.assert_no_pending_responses()
+
+    def test_host_not_in_cache(self):
+        self.env["AWS_INVENTORY_CACHE_TTL"] = "300"
+        self.run_inventory([[instance("node1", "kube_node")]])
+        session = StubSession([[instance("node1", "kube_node"), instance("node2", "etcd")]])
+        self.assertEqual(self.run_script(["--host", "node2.ec2.internal"], session), {"ansible_ssh_host": "10.0.0.2"})
+        session.stubber.assert_no_pending_responses()
+        self.assertEqual(self.run_script(["--host", "node3.ec2.internal"], StubSession([[]])), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
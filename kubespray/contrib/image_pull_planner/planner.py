@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+# Plan the container image pulls of a cluster.
+#
+# For every host of the inventory the planner resolves the images the download
+# role would give it, from the `downloads` entries of
+# roles/kubespray-defaults/defaults/main/download.yml that are enabled for the
+# host and meant for one of its groups, plus the images kubeadm pulls. The
+# images the container runtime of the host already has are left out, and the
+# remaining pulls are spread over time slots so that a host and a registry
+# never serve more than a given number of pulls at once.
+#
+# Record what the runtimes hold, e.g. with
+#   ansible -i inventory/mycluster/hosts.yaml k8s_cluster -b -m command \
+#       -a "crictl images -o json" --tree /tmp/images
+# then plan the pulls:
+#   ./planner.py -i inventory/mycluster/hosts.yaml --runtime-dir /tmp/images
+#
+# crictl images -o json, nerdctl images --format '{{json .}}', the output of
+# the download role's image_info_command and one image per line are understood.
+
+import argparse
+import json
+import os
+import sys
+from collections import OrderedDict, defaultdict
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DEFAULTS_DIR = os.path.join(REPO_ROOT, "roles", "kubespray-defaults", "defaults", "main")
+
+ARCHITECTURES = {"x86_64": "amd64", "aarch64": "arm64", "armv7l": "arm", "ppc64le": "ppc64le"}
+
+# images kubeadm pulls itself, they are not in `downloads`
+KUBEADM_IMAGES = {
+    "kube-apiserver": "kube_control_plane",
+    "kube-controller-manager": "kube_control_plane",
+    "kube-scheduler": "kube_control_plane",
+    "kube-proxy": "k8s_cluster",
+}
+
+
+def normalize(ref):
+    """Strip the implicit docker.io registry and library namespace, as check_pull_required.yml does."""
+    for prefix in ("docker.io/library/", "docker.io/"):
+        if ref.startswith(prefix):
+            return ref[len(prefix):]
+    return ref
+
+
+def image_refs(image):
+    """Return the references an image may be listed under by the runtime."""
+    refs = {normalize(f"{image['repo']}:{image['tag']}")}
+    if image.get("sha256"):
+        refs.add(normalize(f"{image['repo']}@sha256:{image['sha256']}"))
+    return refs
+
+
+def image_name(image):
+    if image.get("sha256"):
+        return f"{image['repo']}@sha256:{image['sha256']}"
+    return f"{image['repo']}:{image['tag']}"
+
+
+def repository(ref):
+    """Return the repository of a reference, without its tag or digest."""
+    if "@" in ref:
+        return ref.split("@", 1)[0]
+    name, sep, tag = ref.rpartition(":")
+    return name if sep and "/" not in tag else ref
+
+
+def registry(image):
+    first, sep, _ = image["repo"].partition("/")
+    if sep and ("." in first or ":" in first or first == "localhost"):
+        return first
+    return "docker.io"
+
+
+def parse_runtime_images(text):
+    """Return the normalized references of the images listed in the output of a container runtime."""
+    text = text.strip()
+    if not text:
+        return set()
+    if text.startswith("{"):
+        try:
+            data = json.loads(text)
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and "stdout" in data:
+            # a result written by ansible --tree
+            return parse_runtime_images(data["stdout"])
+        if isinstance(data, dict) and "images" in data:
+            # crictl images -o json
+            return {normalize(ref) for image in data["images"]
+                    for ref in (image.get("repoTags") or []) + (image.get("repoDigests") or [])}
+        # nerdctl images --format '{{json .}}', one object per line
+        refs = set()
+        for line in text.splitlines():
+            image = json.loads(line)
+            if image.get("Repository") in (None, "", "<none>"):
+                continue
+            if image.get("Tag") and image["Tag"] != "<none>":
+                refs.add(normalize(f"{image['Repository']}:{image['Tag']}"))
+            if image.get("Digest"):
+                refs.add(normalize(f"{image['Repository']}@{image['Digest']}"))
+        return refs
+    # image_info_command output is comma separated, otherwise one image per line
+    return {normalize(ref.strip()) for ref in text.replace(",", "\n").splitlines()
+            if ref.strip() and ref.strip() != ":"}
+
+
+def required_images(downloads, group_names):
+    """Return the container images of the resolved downloads meant for a host in group_names."""
+    images = OrderedDict()
+    for name, download in downloads.items():
+        if not (download.get("container") and download.get("enabled")):
+            continue
+        if not set(download.get("groups") or []) & set(group_names):
+            continue
+        images[name] = download
+    return images
+
+
+def missing_images(required, present):
+    return OrderedDict((name, image) for name, image in required.items() if not image_refs(image) & present)
+
+
+def schedule(missing, host_concurrency, registry_concurrency):
+    """Spread the pulls over slots; return [[(host, image name, registry), ...], ...].
+
+    An image needed by several hosts is first pulled by one host alone, so
+    the other hosts pull it from a warm registry or pull-through cache in
+    the following slots.
+    """
+    popularity = defaultdict(int)
+    for images in missing.values():
+        for image in images.values():
+            popularity[image_name(image)] += 1
+
+    pulls = sorted(((host, image) for host, images in missing.items() for image in images.values()),
+                   key=lambda p: (-popularity[image_name(p[1])], image_name(p[1]), p[0]))
+    slots, per_host, per_registry, seeded = [], [], [], {}
+
+    def place(host, image, earliest):
+        name, reg = image_name(image), registry(image)
+        slot = earliest
+        while True:
+            if slot == len(slots):
+                slots.append([])
+                per_host.append(defaultdict(int))
+                per_registry.append(defaultdict(int))
+            if per_host[slot][host] < host_concurrency and per_registry[slot][reg] < registry_concurrency:
+                slots[slot].append((host, name, reg))
+                per_host[slot][host] += 1
+                per_registry[slot][reg] += 1
+                return slot
+            slot += 1
+
+    # the first pull of every image, then the others once it is done
+    rest = []
+    for host, image in pulls:
+        if image_name(image) in seeded:
+            rest.append((host, image))
+        else:
+            seeded[image_name(image)] = place(host, image, 0)
+    for host, image in rest:
+        place(host, image, seeded[image_name(image)] + 1)
+    return slots
+
+
+def build_plan(hosts, downloads_by_host, present_by_host, host_concurrency=2, registry_concurrency=10,
+               slot_seconds=30):
+    """Return the plan of every host and the pull schedule.
+
+    hosts maps a host to its groups, downloads_by_host a host to its resolved
+    downloads and present_by_host a host to the references its runtime has,
+    None when unknown.
+    """
+    plan, missing = OrderedDict(), OrderedDict()
+    for host, group_names in hosts.items():
+        required = required_images(downloads_by_host[host], group_names)
+        present = present_by_host.get(host)
+        missing[host] = missing_images(required, present or set())
+        required_repos = {normalize(image["repo"]) for image in required.values()}
+        plan[host] = {
+            "required": [image_name(image) for image in required.values()],
+            "missing": [image_name(image) for image in missing[host].values()],
+            # repositories the runtime has images of that are not in the plan,
+            # e.g. components that were disabled or workload images
+            "not_planned": sorted({repository(ref) for ref in present} - required_repos)
+            if present is not None else None,
+            "runtime_known": present is not None,
+        }
+
+    slots = schedule(missing, host_concurrency, registry_concurrency)
+    return {
+        "hosts": plan,
+        "schedule": [{"slot": index, "start": index * slot_seconds,
+                      "pulls": [{"host": host, "image": name, "registry": reg} for host, name, reg in slot]}
+                     for index, slot in enumerate(slots)],
+    }
+
+
+def kubeadm_downloads(image_repo, version, kube_proxy=True):
+    """Return the images kubeadm pulls as resolved downloads."""
+    return {name: {"container": True, "enabled": kube_proxy or name != "kube-proxy",
+                   "repo": f"{image_repo}/{name}", "tag": version, "groups": [group]}
+            for name, group in KUBEADM_IMAGES.items()}
+
+
+def resolve_downloads(inventory, default_arch, extra_vars):
+    """Return ({host: group names}, {host: resolved downloads}) for the hosts of the inventory."""
+    import yaml
+    from ansible.errors import AnsibleError
+    from ansible.inventory.manager import InventoryManager
+    from ansible.module_utils.parsing.convert_bool import boolean
+    from ansible.parsing.dataloader import DataLoader
+    from ansible.template import Templar
+    from ansible.vars.manager import VariableManager
+
+    defaults = {}
+    for name in sorted(os.listdir(DEFAULTS_DIR)):
+        if name.endswith(".yml"):
+            with open(os.path.join(DEFAULTS_DIR, name)) as f:
+                defaults.update(yaml.safe_load(f) or {})
+
+    loader = DataLoader()
+    manager = InventoryManager(loader=loader, sources=[inventory])
+    variable_manager = VariableManager(loader=loader, inventory=manager)
+    hosts, downloads_by_host = OrderedDict(), {}
+    for host in manager.get_hosts("k8s_cluster:etcd"):
+        variables = dict(defaults, **variable_manager.get_vars(host=host))
+        arch = ARCHITECTURES.get(variables.get("ansible_architecture"), default_arch)
+        variables.update(host_architecture=arch, image_arch=arch, ansible_system="Linux", host_os="linux")
+        variables.update(extra_vars)
+        templar = Templar(loader=loader, variables=variables)
+
+        downloads = {}
+        for name, download in defaults["downloads"].items():
+            download = dict(defaults["download_defaults"], **download)
+            try:
+                if not boolean(templar.template(download["container"]), strict=False):
+                    continue
+                downloads[name] = {
+                    "container": True,
+                    "enabled": boolean(templar.template(download["enabled"]), strict=False),
+                    "repo": templar.template(download["repo"]),
+                    "tag": str(templar.template(download["tag"])),
+                    "sha256": templar.template(download.get("sha256") or "") or None,
+                    "groups": download.get("groups") or [],
+                }
+            except AnsibleError as e:
+                print(f"{host.name}: skipped {name}: {e.message}", file=sys.stderr)
+        downloads.update(kubeadm_downloads(templar.template("{{ kube_image_repo }}"),
+                                           templar.template("{{ kube_version }}"),
+                                           not boolean(templar.template("{{ kube_proxy_remove | default(false) }}"),
+                                                       strict=False)))
+        hosts[host.name] = variables["group_names"]
+        downloads_by_host[host.name] = downloads
+    return hosts, downloads_by_host
+
+
+def load_runtime_images(runtime_dir, hosts):
+    present = {}
+    for host in hosts:
+        for name in (host, f"{host}.json", f"{host}.txt"):
+            path = os.path.join(runtime_dir, name)
+            if os.path.isfile(path):
+                with open(path) as f:
+                    present[host] = parse_runtime_images(f.read())
+                break
+    return present
+
+
+def print_plan(plan):
+    for host, entry in plan["hosts"].items():
+        known = "" if entry["runtime_known"] else " (runtime images unknown)"
+        print(f"{host}: {len(entry['required'])} images, {len(entry['missing'])} to pull{known}")
+        for name in entry["missing"]:
+            print(f"  pull    {name}")
+        for name in entry["not_planned"] or []:
+            print(f"  other   {name}")
+    print()
+    for slot in plan["schedule"]:
+        print(f"slot {slot['slot']} (+{slot['start']}s): {len(slot['pulls'])} pulls")
+        for pull in slot["pulls"]:
+            print(f"  {pull['host']:<20} {pull['image']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Plan the container image pulls of every host of a cluster")
+    parser.add_argument("-i", "--inventory", required=True, help="inventory file or directory")
+    parser.add_argument("--runtime-dir", help="directory of <host>[.json|.txt] files listing the images of each host")
+    parser.add_argument("-a", "--arch", default="amd64", choices=sorted(ARCHITECTURES.values()),
+                        help="architecture of the hosts without ansible_architecture (default: %(default)s)")
+    parser.add_argument("-e", "--extra-vars", action="append", default=[], metavar="KEY=VALUE",
+                        help="variables overriding the inventory")
+    parser.add_argument("--host-concurrency", type=int, default=2, help="pulls running at once on a host")
+    parser.add_argument("--registry-concurrency", type=int, default=10, help="pulls running at once from a registry")
+    parser.add_argument("--slot-seconds", type=int, default=30, help="time given to every slot of the schedule")
+    parser.add_argument("--json", action="store_true", help="print the plan as JSON")
+    args = parser.parse_args(argv)
+
+    import yaml
+    extra_vars = {}
+    for value in args.extra_vars:
+        key, _, val = value.partition("=")
+        extra_vars[key] = yaml.safe_load(val)
+
+    hosts, downloads_by_host = resolve_downloads(args.inventory, args.arch, extra_vars)
+    present = load_runtime_images(args.runtime_dir, hosts) if args.runtime_dir else {}
+    plan = build_plan(hosts, downloads_by_host, present, args.host_concurrency, args.registry_concurrency,
+                      args.slot_seconds)
+    if args.json:
+        json.dump(plan, sys.stdout, indent=2)
+        print()
+    else:
+        print_plan(plan)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
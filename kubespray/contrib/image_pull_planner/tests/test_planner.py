@@ -0,0 +1,130 @@
+import os
+import sys
+import unittest
+
+path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+if path not in sys.path:
+    sys.path.append(path)
+
+import planner  # noqa
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+COREDNS = "registry.k8s.io/coredns/coredns"
+COREDNS_DIGEST = "a0ead06651cf580044aeb0a0feba63591858fb2e43ade8c9dea45a6a89ae7e5e"
+
+
+def read(name):
+    with open(os.path.join(DATA_DIR, name)) as f:
+        return f.read()
+
+
+def container(repo, tag, groups, enabled=True, sha256=None):
+    return {"container": True, "enabled": enabled, "repo": repo, "tag": tag, "sha256": sha256, "groups": groups}
+
+
+DOWNLOADS = {
+    "pod_infra": container("registry.k8s.io/pause", "3.9", ["k8s_cluster"]),
+    "coredns": container(COREDNS, "v1.10.1", ["k8s_cluster"]),
+    "cilium": container("quay.io/cilium/cilium", "v1.13.4", ["k8s_cluster"], enabled=False),
+    "nginx": container("docker.io/library/nginx", "1.25.2-alpine", ["kube_node"]),
+    "etcd": container("quay.io/coreos/etcd", "v3.5.10", ["etcd"]),
+}
+DOWNLOADS.update(planner.kubeadm_downloads("registry.k8s.io", "v1.28.6"))
+
+HOSTS = {
+    "node1": ["etcd", "k8s_cluster", "kube_control_plane"],
+    "node2": ["k8s_cluster", "kube_node"],
+    "node3": ["k8s_cluster", "kube_node"],
+}
+
+
+class TestParseRuntimeImages(unittest.TestCase):
+
+    expected = {
+        "registry.k8s.io/pause:3.9",
+        "registry.k8s.io/coredns/coredns:v1.10.1",
+        "%s@sha256:%s" % (COREDNS, COREDNS_DIGEST),
+    }
+
+    def test_crictl_json(self):
+        refs = planner.parse_runtime_images(read("crictl.json"))
+        self.assertTrue(self.expected <= refs)
+        # docker.io/library/ is implicit, as in check_pull_required.yml
+        self.assertIn("nginx:1.25.2-alpine", refs)
+
+    def test_nerdctl_json_lines(self):
+        refs = planner.parse_runtime_images(read("nerdctl.jsonl"))
+        self.assertTrue(self.expected <= refs)
+        self.assertFalse([ref for ref in refs if ref.startswith("<none>")])
+
+    def test_image_info_command(self):
+        refs = planner.parse_runtime_images(read("image_info.txt"))
+        self.assertEqual(refs, self.expected | {"nginx:1.25.2-alpine"})
+
+    def test_ansible_tree_result(self):
+        self.assertEqual(planner.parse_runtime_images(read("node2.json")),
+                         planner.parse_runtime_images(read("crictl.json")))
+
+    def test_empty_output(self):
+        self.assertEqual(planner.parse_runtime_images(""), set())
+
+
+class TestRequiredImages(unittest.TestCase):
+
+    def test_groups_and_enabled(self):
+        self.assertEqual(list(planner.required_images(DOWNLOADS, HOSTS["node1"])),
+                         ["pod_infra", "coredns", "etcd", "kube-apiserver", "kube-controller-manager",
+                          "kube-scheduler", "kube-proxy"])
+        self.assertEqual(list(planner.required_images(DOWNLOADS, HOSTS["node2"])),
+                         ["pod_infra", "coredns", "nginx", "kube-proxy"])
+
+    def test_kube_proxy_removed(self):
+        downloads = planner.kubeadm_downloads("registry.k8s.io", "v1.28.6", kube_proxy=False)
+        self.assertNotIn("kube-proxy", planner.required_images(downloads, HOSTS["node2"]))
+
+    def test_present_by_digest(self):
+        required = {"coredns": container(COREDNS, "v1.10.0", ["k8s_cluster"], sha256=COREDNS_DIGEST)}
+        present = planner.parse_runtime_images(read("crictl.json"))
+        self.assertEqual(planner.missing_images(required, present), {})
+
+
+class TestBuildPlan(unittest.TestCase):
+
+    def plan(self, **kwargs):
+        downloads = dict((host, DOWNLOADS) for host in HOSTS)
+        present = {"node2": planner.parse_runtime_images(read("node2.json")),
+                   "node3": planner.parse_runtime_images(read("nerdctl.jsonl"))}
+        return planner.build_plan(HOSTS, downloads, present, **kwargs)
+
+    def test_missing_images(self):
+        hosts = self.plan()["hosts"]
+        self.assertEqual(hosts["node2"]["missing"], ["registry.k8s.io/kube-proxy:v1.28.6"])
+        self.assertEqual(hosts["node3"]["missing"], ["docker.io/library/nginx:1.25.2-alpine",
+                                                     "registry.k8s.io/kube-proxy:v1.28.6"])
+        # nothing is known of node1, it pulls everything
+        self.assertFalse(hosts["node1"]["runtime_known"])
+        self.assertEqual(len(hosts["node1"]["missing"]), 7)
+        self.assertEqual(hosts["node2"]["not_planned"], [])
+
+    def test_limits(self):
+        schedule = self.plan(host_concurrency=1, registry_concurrency=2)["schedule"]
+        for slot in schedule:
+            hosts = [pull["host"] for pull in slot["pulls"]]
+            self.assertEqual(len(hosts), len(set(hosts)))
+            for reg in set(pull["registry"] for pull in slot["pulls"]):
+                self.assertLessEqual(len([p for p in slot["pulls"] if p["registry"] == reg]), 2)
+        pulls = sorted((p["host"], p["image"]) for slot in schedule for p in slot["pulls"])
+        self.assertEqual(len(pulls), 10)
+
+    def test_seed_pull_first(self):
+        schedule = self.plan(slot_seconds=60)["schedule"]
+        slots = [(slot["slot"], slot["start"], pull["host"]) for slot in schedule for pull in slot["pulls"]
+                 if pull["image"] == "registry.k8s.io/kube-proxy:v1.28.6"]
+        # one host warms the registry, the two others follow in the next slot
+        self.assertEqual([s[0] for s in slots], [0, 1, 1])
+        self.assertEqual(slots[1][1], 60)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+# Build the file mirror served to offline clusters.
+#
+# The list of files is resolved from the `downloads` entries of
+# roles/kubespray-defaults/defaults/main/download.yml, the data the download
+# role itself uses, with the versions of the given inventory. Every file is
+# streamed to disk while its sha256 is checked against checksums.yml, several
+# files at a time. Interrupted downloads are resumed from their .part file and
+# files already verified by a previous run are skipped, so refreshing a mirror
+# only fetches what changed.
+#
+#   ./build-offline-mirror.py -i ../../inventory/mycluster -a amd64 -a arm64
+#
+# The files are stored as <host>/<path of the url> under offline-files/, the
+# layout of manage-offline-files.sh, next to a manifest.json recording the
+# url, size and sha256 of every file. Requires ansible-core and requests.
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+import requests
+from ansible.errors import AnsibleError
+from ansible.module_utils.parsing.convert_bool import boolean
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(os.path.dirname(CURRENT_DIR))
+sys.path.insert(0, os.path.join(REPO_ROOT, "scripts"))
+
+from generate_download_vars import (ARCH_FACTS, DEFAULTS_DIR, arch_templar,  # noqa: E402
+                                    inventory_var_files, load_vars, parse_extra_vars)
+
+OFFLINE_FILES_DIR = os.path.join(CURRENT_DIR, "offline-files")
+MANIFEST_NAME = "manifest.json"
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = 60
+
+
+class MirrorError(Exception):
+    pass
+
+
+def resolve_files(templar, downloads, defaults, enabled_only):
+    """Return the file downloads resolved by templar and the names of those that do not resolve."""
+    files, skipped = [], []
+    for name, download in downloads.items():
+        download = dict(defaults, **download)
+        try:
+            if not boolean(templar.template(download["file"]), strict=False):
+                continue
+            if enabled_only and not boolean(templar.template(download["enabled"]), strict=False):
+                continue
+            url = templar.template(download["url"])
+            sha256 = templar.template(download.get("sha256") or "")
+        except AnsibleError:
+            skipped.append(name)
+            continue
+        if str(sha256).strip() == "0":
+            # checksums.yml marks releases not published for an architecture with 0
+            skipped.append(name)
+            continue
+        parsed = urlparse(url)
+        files.append({
+            "name": name,
+            "url": url,
+            "sha256": str(sha256 or "").strip().lower() or None,
+            "path": parsed.netloc + parsed.path,
+        })
+    return files, skipped
+
+
+def artifacts(arches, base_vars, extra_vars, enabled_only):
+    downloads = base_vars["downloads"]
+    defaults = base_vars["download_defaults"]
+    by_url = {}
+    for arch in arches:
+        files, skipped = resolve_files(arch_templar(arch, base_vars, extra_vars), downloads, defaults, enabled_only)
+        for name in skipped:
+            print(f"{arch}: skipped {name}, it does not resolve for this architecture", file=sys.stderr)
+        for artifact in files:
+            # files shared by every architecture (e.g. the calico CRDs) are fetched once
+            by_url.setdefault(artifact["url"], dict(artifact, arch=arch))
+    return list(by_url.values())
+
+
+def new_session(workers):
+    session = requests.Session()
+    retries = Retry(total=5, backoff_factor=2, status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def file_sha256(path, sha256=None):
+    sha256 = sha256 or hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256
+
+
+class Manifest:
+    """The manifest.json of a mirror, written again after every file so an interrupted run keeps its progress."""
+
+    def __init__(self, root):
+        self.path = os.path.join(root, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.files = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.files = json.load(f).get("files", {})
+
+    def verified(self, artifact, path):
+        """True when the file is the one a previous run recorded and it has the expected sha256."""
+        record = self.files.get(artifact["path"])
+        if not record or not os.path.isfile(path):
+            return False
+        stat = os.stat(path)
+        return (record["size"] == stat.st_size and record["mtime"] == stat.st_mtime
+                and record["sha256"] == (artifact["sha256"] or record["sha256"]))
+
+    def record(self, artifact, path, sha256):
+        stat = os.stat(path)
+        with self.lock:
+            self.files[artifact["path"]] = {
+                "name": artifact["name"],
+                "arch": artifact["arch"],
+                "url": artifact["url"],
+                "sha256": sha256,
+                "verified": artifact["sha256"] is not None,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+            }
+            self.save()
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"generated": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                       "files": dict(sorted(self.files.items()))}, f, indent=2)
+        os.replace(tmp, self.path)
+
+
+def download(session, artifact, path, resume=True):
+    """Stream artifact["url"] to path, resuming from path.part; return (sha256, bytes fetched)."""
+    part = f"{path}.part"
+    offset = os.path.getsize(part) if resume and os.path.isfile(part) else 0
+    sha256 = file_sha256(part) if offset else hashlib.sha256()
+    fetched = 0
+
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with session.get(artifact["url"], headers=headers, stream=True, timeout=TIMEOUT) as response:
+        # 416: the partial file already holds the whole download
+        if not (offset and response.status_code == 416):
+            response.raise_for_status()
+            if offset and response.status_code != 206:
+                # the server ignored the range, start over
+                offset, sha256 = 0, hashlib.sha256()
+            with open(part, "ab" if offset else "wb") as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    sha256.update(chunk)
+                    f.write(chunk)
+                    fetched += len(chunk)
+
+    digest = sha256.hexdigest()
+    if artifact["sha256"] and digest != artifact["sha256"]:
+        os.remove(part)
+        if offset:
+            # the partial file may be from another version of the file
+            return download(session, artifact, path, resume=False)
+        raise MirrorError(f"{artifact['url']}: sha256 {digest} does not match the expected {artifact['sha256']}")
+    os.replace(part, path)
+    return digest, fetched
+
+
+def mirror(session, artifact, root, manifest, rehash):
+    """Make sure root holds a verified copy of artifact; return (status, bytes fetched)."""
+    path = os.path.join(root, artifact["path"])
+    if not rehash and manifest.verified(artifact, path):
+        return "skipped", 0
+
+    if os.path.isfile(path):
+        digest = file_sha256(path).hexdigest()
+        if artifact["sha256"] in (None, digest):
+            manifest.record(artifact, path, digest)
+            return "verified", 0
+        os.remove(path)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    resumed = os.path.isfile(f"{path}.part")
+    digest, fetched = download(session, artifact, path)
+    manifest.record(artifact, path, digest)
+    return "resumed" if resumed else "downloaded", fetched
+
+
+def build_mirror(files, root, workers, rehash=False):
+    os.makedirs(root, exist_ok=True)
+    manifest = Manifest(root)
+    session = new_session(workers)
+    statuses, fetched, failed = {}, 0, []
+    start = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(mirror, session, artifact, root, manifest, rehash): artifact for artifact in files}
+        for future in as_completed(futures):
+            artifact = futures[future]
+            try:
+                status, size = future.result()
+            except (requests.RequestException, MirrorError, OSError) as e:
+                print(f"failed {artifact['url']}: {e}", file=sys.stderr)
+                failed.append(artifact["url"])
+                continue
+            statuses[status] = statuses.get(status, 0) + 1
+            fetched += size
+            if status != "skipped":
+                print(f"{status} {artifact['path']}")
+                if artifact["sha256"] is None:
+                    print(f"warning: no checksum known for {artifact['url']}", file=sys.stderr)
+
+    elapsed = time.monotonic() - start
+    summary = ", ".join(f"{count} {status}" for status, count in sorted(statuses.items())) or "nothing to do"
+    print(f"{summary}, {len(failed)} failed; {fetched / 1024 ** 2:.1f} MiB in {elapsed:.1f}s"
+          f" ({fetched / 1024 ** 2 / max(elapsed, 0.001):.1f} MiB/s)")
+    return not failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Download the files of an offline mirror and verify their sha256")
+    parser.add_argument("-i", "--inventory", help="inventory directory (or hosts file) whose group_vars select the versions")
+    parser.add_argument("-a", "--arch", action="append", choices=sorted(ARCH_FACTS),
+                        help="architecture to mirror, repeat for mixed clusters (default: amd64)")
+    parser.add_argument("-e", "--extra-vars", action="append", metavar="KEY=VALUE|@FILE",
+                        help="variables overriding the inventory, e.g. kube_version=v1.28.6")
+    parser.add_argument("-o", "--output", default=OFFLINE_FILES_DIR, help="mirror directory (default: %(default)s)")
+    parser.add_argument("--enabled-only", action="store_true",
+                        help="only mirror the files the inventory enables instead of every file download")
+    parser.add_argument("--workers", type=int, default=8, help="number of files downloaded in parallel")
+    parser.add_argument("--rehash", action="store_true", help="hash files recorded in the manifest again")
+    parser.add_argument("--archive", metavar="FILE", help="also pack the mirror into this .tar.gz")
+    parser.add_argument("--list", action="store_true", help="only print the resolved files")
+    args = parser.parse_args(argv)
+
+    base_vars = load_vars(sorted(os.path.join(DEFAULTS_DIR, f) for f in os.listdir(DEFAULTS_DIR) if f.endswith(".yml")))
+    if args.inventory:
+        base_vars.update(load_vars(inventory_var_files(args.inventory)))
+    files = artifacts(args.arch or ["amd64"], base_vars, parse_extra_vars(args.extra_vars), args.enabled_only)
+
+    if args.list:
+        for artifact in files:
+            print(f"{artifact['sha256'] or '-':<64}  {artifact['url']}")
+        return 0
+
+    if not build_mirror(files, args.output, args.workers, args.rehash):
+        return 1
+    if args.archive:
+        with tarfile.open(args.archive, "w:gz") as archive:
+            archive.add(args.output, arcname=os.path.basename(os.path.normpath(args.output)))
+        print(f"Wrote {args.archive}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1 @@
+../plugins/modules/download_mirrors.py
\ No newline at end of file
@@ -0,0 +1,581 @@
+# -*- coding: utf-8 -*-
+
+# kubectl driver shared by the kube module (plugins/modules/kube.py)
+
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+# Action reported for each object, keyed by the kubectl verb that produced it.
+# With report_actions, apply reports created, configured or unchanged instead,
+# from the resourceVersion the objects had before; applied is kept when the
+# option is off or the objects could not be read.
+ACTIONS = {
+    'apply': 'applied',
+    'delete': 'deleted',
+    'get': 'exists',
+    'stop': 'stopped',
+}
+
+LAST_APPLIED_ANNOTATION = 'kubectl.kubernetes.io/last-applied-configuration'
+
+# Extensions kubectl reads when --filename points at a directory.
+MANIFEST_EXTENSIONS = ('.json', '.yaml', '.yml')
+
+# Actions that changed the objects. applied is not one of them: without
+# report_actions the module does not know, and reports no change as it always did.
+CHANGED_ACTIONS = ('created', 'configured', 'deleted', 'stopped')
+
+VERSION_COLUMNS = 'KIND:.kind,NAMESPACE:.metadata.namespace,NAME:.metadata.name,VERSION:.metadata.resourceVersion'
+
+
+class KubeManager(object):
+
+    def __init__(self, module):
+
+        self.module = module
+
+        self.kubectl = module.params.get('kubectl')
+        if self.kubectl is None:
+            self.kubectl =  module.get_bin_path('kubectl', True)
+        self.base_cmd = [self.kubectl]
+
+        if module.params.get('server'):
+            self.base_cmd.append('--server=' + module.params.get('server'))
+
+        if module.params.get('kubeconfig'):
+            self.base_cmd.append('--kubeconfig=' + module.params.get('kubeconfig'))
+
+        if module.params.get('log_level'):
+            self.base_cmd.append('--v=' + str(module.params.get('log_level')))
+
+        if module.params.get('namespace'):
+            self.base_cmd.append('--namespace=' + module.params.get('namespace'))
+
+
+        self.all = module.params.get('all')
+        self.force = module.params.get('force')
+        self.wait = module.params.get('wait')
+        self.name = module.params.get('name')
+        self.filename = [f.strip() for f in module.params.get('filename') or []]
+        self.resource = module.params.get('resource')
+        self.label = module.params.get('label')
+        self.recursive = module.params.get('recursive')
+        self.namespace = module.params.get('namespace')
+        self.checksum_cache = module.params.get('checksum_cache')
+        self.report_actions = module.params.get('report_actions')
+
+        # object key -> sha256 of its last-applied configuration, filled
+        # while parsing apply output when checksum_cache is set
+        self._applied = {}
+        # object key -> resourceVersion of the existing objects before an apply
+        self._versions = None
+
+        self.chunk_size = module.params.get('chunk_size')
+        self.concurrency = max(1, module.params.get('concurrency') or 1)
+        self.counts_only = module.params.get('counts_only')
+        # matched/deleted totals of a paginated delete
+        self.counts = None
+
+        self.timings = [] if module.params.get('timings') else None
+
+    def _run(self, args):
+        if self.timings is None:
+            return self.module.run_command(args)
+
+        start = time.time()
+        rc, out, err = self.module.run_command(args)
+        self.timings.append(dict(
+            cmd=' '.join(args),
+            rc=rc,
+            seconds=round(time.time() - start, 3),
+            stdout_bytes=len(out.encode('utf-8')) if out else 0,
+            stderr_bytes=len(err.encode('utf-8')) if err else 0,
+        ))
+        return rc, out, err
+
+    def _fail(self, **kwargs):
+        if self.timings is not None:
+            kwargs['timings'] = self.timings
+        self.module.fail_json(**kwargs)
+
+    def _summarize(self, obj, action):
+        metadata = obj.get('metadata') or {}
+        return dict(
+            kind=obj.get('kind'),
+            name=metadata.get('name'),
+            namespace=metadata.get('namespace'),
+            action=action,
+            generation=metadata.get('generation'),
+            resourceVersion=metadata.get('resourceVersion'),
+        )
+
+    def _summarize_name(self, line, action):
+        # `-o name` output: <kind>[.<group>]/<name>
+        kind, _, name = line.strip().partition('/')
+        return dict(
+            kind=kind,
+            name=name,
+            namespace=self.namespace,
+            action=action,
+            generation=None,
+            resourceVersion=None,
+        )
+
+    def _parse(self, cmd, out):
+        """Reduce kubectl output to one summary dict per object.
+
+        Only the summary fields are kept, the decoded objects are dropped as
+        soon as they have been summarized so large outputs do not stay in
+        memory for the rest of the module run.
+        """
+        action = ACTIONS.get(cmd[0], cmd[0])
+        if '--output=json' not in cmd:
+            return [self._summarize_name(line, action) for line in out.splitlines() if line.strip()]
+
+        result = []
+        for obj in self._documents(cmd, out):
+            if cmd[0] == 'apply':
+                if self.checksum_cache:
+                    annotations = (obj.get('metadata') or {}).get('annotations') or {}
+                    if LAST_APPLIED_ANNOTATION in annotations:
+                        last_applied = json.loads(annotations[LAST_APPLIED_ANNOTATION])
+                        self._applied[self._object_key(last_applied)] = self._object_hash(last_applied)
+                action = self._apply_action(obj)
+            result.append(self._summarize(obj, action))
+        return result
+
+    def _apply_action(self, obj):
+        if self._versions is None:
+            return ACTIONS['apply']
+        version = self._versions.get(self._object_key(obj))
+        if version is None:
+            return 'created'
+        if version == (obj.get('metadata') or {}).get('resourceVersion'):
+            return 'unchanged'
+        return 'configured'
+
+    def _resource_versions(self):
+        """Return object key -> resourceVersion of the objects of the manifests that
+        already exist, None when kubectl cannot read them (e.g. a CRD not created yet).
+
+        Only four columns are printed per object, not the objects themselves.
+        """
+        cmd = ['get', '--filename=' + ','.join(self.filename)]
+        if self.recursive:
+            cmd.append('--recursive={}'.format(self.recursive))
+        cmd += ['--ignore-not-found', '--no-headers', '--output=custom-columns=' + VERSION_COLUMNS]
+
+        rc, out, err = self._run(self.base_cmd + cmd)
+        if rc != 0:
+            return None
+        versions = {}
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) == 4:
+                kind, namespace, name, version = fields
+                versions['%s/%s/%s' % (kind, '' if namespace == '<none>' else namespace, name)] = version
+        return versions
+
+    def _apply(self, cmd):
+        # one more kubectl call, only made when the actions are asked for
+        self._versions = self._resource_versions() if self.report_actions else None
+        return self._execute(cmd)
+
+    def _documents(self, cmd, out):
+        # kubectl may print several JSON documents back to back
+        # (one per file), or a single List wrapping the objects.
+        decoder = json.JSONDecoder()
+        pos = 0
+        end = len(out)
+        while True:
+            while pos < end and out[pos].isspace():
+                pos += 1
+            if pos >= end:
+                break
+            try:
+                doc, pos = decoder.raw_decode(out, pos)
+            except ValueError as exc:
+                self._fail(msg='unable to parse kubectl (%s) output: %s' % (' '.join(cmd), str(exc)))
+            if doc.get('kind', '').endswith('List') and 'items' in doc:
+                for item in doc['items']:
+                    yield item
+            else:
+                yield doc
+
+    @staticmethod
+    def _object_key(obj):
+        metadata = obj.get('metadata') or {}
+        return '%s/%s/%s' % (obj.get('kind'), metadata.get('namespace') or '', metadata.get('name'))
+
+    @staticmethod
+    def _object_hash(obj):
+        return hashlib.sha256(json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _manifest_paths(self):
+        paths = []
+        for filename in self.filename:
+            if not os.path.isdir(filename):
+                paths.append(filename)
+                continue
+            for root, dirs, files in os.walk(filename):
+                if not self.recursive:
+                    dirs[:] = []
+                paths.extend(os.path.join(root, f) for f in files if f.endswith(MANIFEST_EXTENSIONS))
+        return sorted(paths)
+
+    def _manifest_hash(self):
+        digest = hashlib.sha256()
+        for path in self._manifest_paths():
+            digest.update(path.encode('utf-8') + b'\0')
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    digest.update(chunk)
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _cache_key(self):
+        return '%s|%s' % (self.namespace or '', ','.join(sorted(self.filename)))
+
+    def _load_cache(self):
+        try:
+            with open(self.checksum_cache) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save_cache(self, cache):
+        tmp = self.checksum_cache + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(cache, f, sort_keys=True)
+            os.rename(tmp, self.checksum_cache)
+        except (IOError, OSError) as exc:
+            self.module.warn('unable to write checksum cache %s: %s' % (self.checksum_cache, str(exc)))
+
+    def _last_applied(self):
+        cmd = ['apply', 'view-last-applied', '--filename=' + ','.join(self.filename)]
+        if self.recursive:
+            cmd.append('--recursive={}'.format(self.recursive))
+        cmd.append('--output=json')
+
+        rc, out, err = self._run(self.base_cmd + cmd)
+        if rc != 0:
+            return None
+        return list(self._documents(cmd, out))
+
+    def _unchanged(self, manifest_hash):
+        """Return summaries for the objects when nothing changed since the
+        last recorded apply, None when kubectl apply has to run."""
+        entry = self._load_cache().get(self._cache_key())
+        if not entry or entry.get('manifest') != manifest_hash:
+            return None
+
+        last_applied = self._last_applied()
+        if not last_applied:
+            return None
+        objects = dict((self._object_key(obj), self._object_hash(obj)) for obj in last_applied)
+        if objects != entry.get('objects'):
+            return None
+        return [self._summarize(obj, 'unchanged') for obj in last_applied]
+
+    def _execute(self, cmd):
+        args = self.base_cmd + cmd
+        try:
+            rc, out, err = self._run(args)
+            if rc != 0:
+                self._fail(
+                    msg='error running kubectl (%s) command (rc=%d), out=\'%s\', err=\'%s\'' % (' '.join(args), rc, out, err))
+        except Exception as exc:
+            self._fail(
+                msg='error running kubectl (%s) command: %s' % (' '.join(args), str(exc)))
+        return self._parse(cmd, out)
+
+    def _execute_nofail(self, cmd):
+        args = self.base_cmd + cmd
+        rc, out, err = self._run(args)
+        if rc != 0:
+            return None
+        return self._parse(cmd, out)
+
+    def create(self, check=True, force=True):
+        if check and self.exists():
+            return []
+
+        cmd = ['apply']
+
+        if force:
+            cmd.append('--force')
+
+        if self.wait:
+            cmd.append('--wait')
+
+        if self.recursive:
+            cmd.append('--recursive={}'.format(self.recursive))
+
+        if not self.filename:
+            self._fail(msg='filename required to create')
+
+        cmd.append('--filename=' + ','.join(self.filename))
+        cmd.append('--output=json')
+
+        return self._apply(cmd)
+
+    def replace(self, force=True):
+
+        cmd = ['apply']
+
+        if force:
+            cmd.append('--force')
+
+        if self.wait:
+            cmd.append('--wait')
+
+        if self.recursive:
+            cmd.append('--recursive={}'.format(self.recursive))
+
+        if not self.filename:
+            self._fail(msg='filename required to reload')
+
+        cmd.append('--filename=' + ','.join(self.filename))
+        cmd.append('--output=json')
+
+        if not self.checksum_cache:
+            return self._apply(cmd)
+
+        manifest_hash = self._manifest_hash()
+        result = self._unchanged(manifest_hash)
+        if result is not None:
+            return result
+
+        self._applied = {}
+        result = self._apply(cmd)
+        cache = self._load_cache()
+        cache[self._cache_key()] = dict(manifest=manifest_hash, objects=self._applied)
+        self._save_cache(cache)
+        return result
+
+    def delete(self):
+
+        if self._paginated():
+            result = self._paginated_delete()
+            if result is not None:
+                return result
+
+        if not self.force and not self.exists():
+            return []
+
+        cmd = ['delete']
+
+        if self.filename:
+            cmd.append('--filename=' + ','.join(self.filename))
+            if self.recursive:
+                cmd.append('--recursive={}'.format(self.recursive))
+        else:
+            if not self.resource:
+                self._fail(msg='resource required to delete without filename')
+
+            cmd.append(self.resource)
+
+            if self.name:
+                cmd.append(self.name)
+
+            if self.label:
+                cmd.append('--selector=' + self.label)
+
+            if self.all:
+                cmd.append('--all')
+
+            if self.force:
+                cmd.append('--ignore-not-found')
+
+            if self.recursive:
+                cmd.append('--recursive={}'.format(self.recursive))
+
+        cmd.append('--output=name')
+
+        return self._execute(cmd)
+
+    def exists(self):
+        if self._paginated():
+            result = self._paginated_exists()
+            if result is not None:
+                return result
+
+        cmd = ['get']
+
+        if self.filename:
+            cmd.append('--filename=' + ','.join(self.filename))
+            if self.recursive:
+                cmd.append('--recursive={}'.format(self.recursive))
+        else:
+            if not self.resource:
+                self._fail(msg='resource required without filename')
+
+            cmd.append(self.resource)
+
+            if self.name:
+                cmd.append(self.name)
+
+            if self.label:
+                cmd.append('--selector=' + self.label)
+
+            if self.all:
+                cmd.append('--all-namespaces')
+
+        # names only, the objects are not needed to tell whether they exist
+        cmd.append('--output=name')
+
+        result = self._execute_nofail(cmd)
+        if not result:
+            return False
+        return True
+
+    def _paginated(self):
+        return (self.chunk_size and self.chunk_size > 0 and not self.filename and not self.name
+                and self.resource and (self.label or self.all))
+
+    def _api_path(self, all_namespaces):
+        """Resolve the collection URL of self.resource from kubectl api-resources,
+        None when the resource is unknown to the API server."""
+        out = self._execute_raw(['api-resources', '--no-headers'])
+        wanted = self.resource.lower()
+        for line in out.splitlines():
+            # NAME [SHORTNAMES] APIVERSION NAMESPACED KIND
+            fields = line.split()
+            namespaced = [i for i, f in enumerate(fields) if f in ('true', 'false')]
+            if not namespaced or namespaced[-1] < 2:
+                continue
+            idx = namespaced[-1]
+            name, api_version = fields[0], fields[idx - 1]
+            short_names = fields[1].split(',') if idx == 3 else []
+            kind = fields[idx + 1].lower() if len(fields) > idx + 1 else ''
+            group = api_version.rpartition('/')[0]
+            candidates = [name, kind] + short_names
+            if group:
+                candidates += ['%s.%s' % (c, group) for c in (name, kind)]
+            if wanted not in candidates and wanted + 's' != name:
+                continue
+
+            path = '/api/' + api_version if not group else '/apis/' + api_version
+            if fields[idx] == 'true' and not all_namespaces:
+                path += '/namespaces/' + self._current_namespace()
+            return path + '/' + name
+        return None
+
+    def _current_namespace(self):
+        if self.namespace:
+            return self.namespace
+        out = self._execute_raw(['config', 'view', '--minify', '--output=jsonpath={..namespace}'])
+        return out.strip() or 'default'
+
+    def _execute_raw(self, cmd):
+        args = self.base_cmd + cmd
+        rc, out, err = self._run(args)
+        if rc != 0:
+            self._fail(
+                msg='error running kubectl (%s) command (rc=%d), out=\'%s\', err=\'%s\'' % (' '.join(args), rc, out, err))
+        return out
+
+    def _pages(self, path, limit):
+        """Yield the items of a collection one API page at a time."""
+        query = {'limit': limit}
+        if self.label:
+            query['labelSelector'] = self.label
+        while True:
+            page = json.loads(self._execute_raw(['get', '--raw', path + '?' + urlencode(query)]))
+            yield page.get('items') or []
+            token = (page.get('metadata') or {}).get('continue')
+            if not token:
+                break
+            query['continue'] = token
+
+    def _paginated_exists(self):
+        path = self._api_path(self.all)
+        if path is None:
+            return None
+        for items in self._pages(path, 1):
+            return bool(items)
+        return False
+
+    def _paginated_delete(self):
+        path = self._api_path(False)
+        if path is None:
+            return None
+
+        self.counts = dict(matched=0, deleted=0)
+        result = []
+
+        def collect(future):
+            args, (rc, out, err) = future.result()
+            if rc != 0:
+                self._fail(
+                    msg='error running kubectl (%s) command (rc=%d), out=\'%s\', err=\'%s\'' % (' '.join(args), rc, out, err))
+            deleted = [line for line in out.splitlines() if line.strip()]
+            self.counts['deleted'] += len(deleted)
+            if not self.counts_only:
+                result.extend(self._summarize_name(line, ACTIONS['delete']) for line in deleted)
+
+        def run(args):
+            return args, self._run(args)
+
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        pending = set()
+        try:
+            for items in self._pages(path, self.chunk_size):
+                names = [(item.get('metadata') or {}).get('name') for item in items]
+                if not names:
+                    continue
+                self.counts['matched'] += len(names)
+                # keep at most `concurrency` batches in flight so only a
+                # bounded number of pages is ever held in memory
+                while len(pending) >= self.concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(future)
+                args = self.base_cmd + ['delete', self.resource] + names + ['--ignore-not-found', '--output=name']
+                pending.add(executor.submit(run, args))
+            for future in wait(pending)[0]:
+                collect(future)
+        finally:
+            executor.shutdown(wait=True)
+        return result
+
+    # TODO: This is currently unused, perhaps convert to 'scale' with a replicas param?
+    def stop(self):
+
+        if not self.force and not self.exists():
+            return []
+
+        cmd = ['stop']
+
+        if self.filename:
+            cmd.append('--filename=' + ','.join(self.filename))
+            if self.recursive:
+                cmd.append('--recursive={}'.format(self.recursive))
+        else:
+            if not self.resource:
+                self._fail(msg='resource required to stop without filename')
+
+            cmd.append(self.resource)
+
+            if self.name:
+                cmd.append(self.name)
+
+            if self.label:
+                cmd.append('--selector=' + self.label)
+
+            if self.all:
+                cmd.append('--all')
+
+            if self.force:
+                cmd.append('--ignore-not-found')
+
+        return self._execute(cmd)
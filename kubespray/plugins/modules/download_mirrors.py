@@ -0,0 +1,342 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+DOCUMENTATION = """
+---
+module: download_mirrors
+short_description: Rank download mirrors and fetch a file from several of them
+description:
+  - Probe every mirror of a file in parallel with a ranged GET of its first bytes,
+    measuring the time to the response and the throughput, and rank the working
+    mirrors from the fastest.
+  - Optionally download the file to dest, split in ranges fetched in parallel from
+    all the working mirrors that support ranges, and verify its sha256.
+options:
+  urls:
+    required: true
+    description:
+      - The mirrors of the file.
+  probes:
+    required: false
+    default: {}
+    description:
+      - Measures returned in probes by a previous call. The latency and throughput of
+        mirrors whose scheme and host are in probes are not measured again, so they can
+        be kept for a whole run. Every mirror is still checked for the file with a ranged
+        GET of its first byte, which also gives its size and support of ranges.
+  probe_bytes:
+    required: false
+    default: 65536
+    description:
+      - Number of bytes requested from each mirror to measure its throughput.
+  dest:
+    required: false
+    default: null
+    description:
+      - Path to download the file to. Only the mirrors are ranked when not set.
+  sha256:
+    required: false
+    default: null
+    description:
+      - Expected sha256 of the file. An existing dest with this checksum is not downloaded again.
+  segments:
+    required: false
+    default: 4
+    description:
+      - Number of ranges the download to dest is split in.
+  timeout:
+    required: false
+    default: 10
+    description:
+      - Timeout in seconds of every request.
+  validate_certs:
+    required: false
+    default: true
+    description:
+      - Validate the TLS certificates of the mirrors.
+  url_username:
+    required: false
+    default: null
+    description:
+      - Username for the mirrors.
+  url_password:
+    required: false
+    default: null
+    description:
+      - Password for the mirrors.
+  force_basic_auth:
+    required: false
+    default: false
+    description:
+      - Send the basic authentication header with the first request.
+extends_documentation_fragment:
+  - files
+requirements:
+  - python >= 3.6
+"""
+
+EXAMPLES = """
+- name: rank the mirrors of kubeadm
+  download_mirrors:
+    urls:
+      - https://dl.k8s.io/release/v1.28.6/bin/linux/amd64/kubeadm
+      - https://mirror.example.com/kubernetes/v1.28.6/kubeadm
+  register: kubeadm_mirrors
+
+- name: download the calico CRDs from all mirrors at once
+  download_mirrors:
+    urls: "{{ calico_crds_mirrors }}"
+    dest: /tmp/releases/calico-v3.26.4-kdd-crds.tar.gz
+    sha256: "{{ calico_crds_archive_checksum }}"
+    segments: 8
+"""
+
+RETURN = """
+mirrors:
+  description:
+    - Every mirror with its measures, working mirrors first, from the fastest.
+  returned: always
+  type: list
+  sample:
+    - url: https://dl.k8s.io/release/v1.28.6/bin/linux/amd64/kubeadm
+      ok: true
+      latency: 0.082
+      throughput: 10485760
+      ranges: true
+      size: 50577408
+probes:
+  description:
+    - Latency and throughput per scheme and host of the working mirrors, to be passed
+      to the next calls with probes.
+  returned: always
+  type: dict
+size:
+  description:
+    - Size of the file in bytes, when a mirror reported it.
+  returned: always
+  type: int
+sha256:
+  description:
+    - sha256 of dest.
+  returned: when dest is set
+  type: str
+"""
+
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.urls import open_url
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class MirrorFetcher(object):
+
+    def __init__(self, module):
+        self.module = module
+        self.timeout = module.params['timeout']
+        self.request_args = dict(
+            validate_certs=module.params['validate_certs'],
+            url_username=module.params['url_username'],
+            url_password=module.params['url_password'],
+            force_basic_auth=module.params['force_basic_auth'],
+        )
+
+    def _get(self, url, start=None, end=None):
+        headers = {}
+        if start is not None:
+            headers['Range'] = 'bytes=%d-%s' % (start, '' if end is None else end)
+        return open_url(url, headers=headers, timeout=self.timeout, **self.request_args)
+
+    @staticmethod
+    def host(url):
+        parts = urlsplit(url)
+        return '%s://%s' % (parts.scheme, parts.netloc)
+
+    def probe(self, url, probe_bytes):
+        """Measure the latency and throughput of url with a ranged GET of its first probe_bytes."""
+        start = time.time()
+        try:
+            response = self._get(url, 0, probe_bytes - 1)
+            latency = time.time() - start
+            data = response.read(probe_bytes)
+            transfer = time.time() - start - latency
+        except Exception as e:
+            return dict(url=url, ok=False, error=str(e))
+
+        size = None
+        content_range = response.headers.get('Content-Range')
+        if content_range and '/' in content_range and not content_range.endswith('*'):
+            size = int(content_range.rsplit('/', 1)[1])
+        elif response.headers.get('Content-Length') and response.getcode() == 200:
+            size = int(response.headers['Content-Length'])
+        return dict(url=url, ok=True,
+                    latency=round(latency, 3),
+                    throughput=int(len(data) / max(transfer, 0.001)),
+                    ranges=response.getcode() == 206,
+                    size=size)
+
+    def check(self, url, measures):
+        """Check that url serves the file with a ranged GET of its first byte, using the measures of its host."""
+        mirror = self.probe(url, 1)
+        if mirror['ok']:
+            mirror.update(latency=measures['latency'], throughput=measures['throughput'])
+        return mirror
+
+    def rank(self, urls, probes, probe_bytes):
+        """Return the mirrors from the fastest, measuring the hosts without measures in probes.
+
+        Only the latency and throughput of a host are kept in probes: whether a
+        mirror has the file, its size and its support of ranges are checked for
+        every url, and a host that failed is measured again by the next call.
+        """
+        def measure(url):
+            if self.host(url) in probes:
+                return self.check(url, probes[self.host(url)])
+            return self.probe(url, probe_bytes)
+
+        with ThreadPoolExecutor(max_workers=max(len(urls), 1)) as executor:
+            mirrors = list(executor.map(measure, urls))
+        for mirror in mirrors:
+            if mirror['ok']:
+                probes.setdefault(self.host(mirror['url']),
+                                  dict(latency=mirror['latency'], throughput=mirror['throughput']))
+        # the time to fetch the probe is what a small file takes, the order
+        # it gives also favours high throughput for large ones
+        return sorted(mirrors, key=lambda m: (not m['ok'], m.get('latency', 0) + probe_bytes / float(max(m.get('throughput', 1), 1))))
+
+    def fetch(self, mirrors, dest, size, segments):
+        """Download to dest.part from the mirrors, in ranges when they support it; return the sha256."""
+        part = dest + '.part'
+        ranged = [m['url'] for m in mirrors if m['ok'] and m.get('ranges')]
+        if not size or not ranged or segments < 2:
+            failed = []
+            for url in [m['url'] for m in mirrors if m['ok']]:
+                sha256 = hashlib.sha256()
+                try:
+                    response = self._get(url)
+                    with open(part, 'wb') as f:
+                        for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                            sha256.update(chunk)
+                            f.write(chunk)
+                except Exception as e:
+                    failed.append('%s: %s' % (url, e))
+                    continue
+                return part, sha256.hexdigest()
+            self.module.fail_json(msg='Failed to download %s from any mirror: %s' % (dest, '; '.join(failed)))
+
+        step = -(-size // segments)
+        queue = [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+        failed = []
+        fd = os.open(part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+
+            # ranges being fetched; a worker finding the queue empty waits
+            # for them, as a failed one is put back for it to take
+            in_flight = [0]
+            changed = threading.Condition()
+
+            def worker(url):
+                # one worker per mirror takes ranges until none are left, so
+                # faster mirrors serve more of them; a failed range is left
+                # to the other mirrors
+                while True:
+                    with changed:
+                        while not queue and in_flight[0]:
+                            changed.wait()
+                        if not queue:
+                            return
+                        start, end = queue.pop(0)
+                        in_flight[0] += 1
+                    error = None
+                    try:
+                        response = self._get(url, start, end)
+                        if response.getcode() != 206:
+                            raise ValueError('%s does not serve ranges' % url)
+                        offset = start
+                        for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                            os.pwrite(fd, chunk, offset)
+                            offset += len(chunk)
+                        if offset != end + 1:
+                            raise ValueError('%s returned %d bytes of range %d-%d' % (url, offset - start, start, end))
+                    except Exception as e:
+                        error = e
+                    with changed:
+                        in_flight[0] -= 1
+                        if error is not None:
+                            queue.append((start, end))
+                            failed.append('%s: %s' % (url, error))
+                        changed.notify_all()
+                    if error is not None:
+                        return
+
+            with ThreadPoolExecutor(max_workers=len(ranged)) as executor:
+                list(executor.map(worker, ranged))
+        finally:
+            os.close(fd)
+        if queue:
+            os.remove(part)
+            self.module.fail_json(msg='Failed to download %s from any mirror: %s' % (dest, '; '.join(failed)))
+        return part, self.module.digest_from_file(part, 'sha256')
+
+
+def main():
+
+    module = AnsibleModule(
+        argument_spec=dict(
+            urls=dict(type='list', elements='str', required=True),
+            probes=dict(type='dict', default={}),
+            probe_bytes=dict(type='int', default=65536),
+            dest=dict(type='path'),
+            sha256=dict(),
+            segments=dict(type='int', default=4),
+            timeout=dict(type='int', default=10),
+            validate_certs=dict(type='bool', default=True),
+            url_username=dict(),
+            url_password=dict(no_log=True),
+            force_basic_auth=dict(type='bool', default=False),
+            ),
+            add_file_common_args=True,
+            supports_check_mode=True,
+        )
+
+    fetcher = MirrorFetcher(module)
+    probes = dict(module.params['probes'])
+    mirrors = fetcher.rank(module.params['urls'], probes, module.params['probe_bytes'])
+    size = next((m['size'] for m in mirrors if m.get('size')), None)
+    result = dict(changed=False, mirrors=mirrors, probes=probes, size=size)
+
+    if not mirrors[0]['ok']:
+        module.fail_json(msg='No working mirror: %s' % '; '.join('%s: %s' % (m['url'], m['error']) for m in mirrors),
+                         **result)
+
+    dest = module.params['dest']
+    if not dest:
+        module.exit_json(msg='Fastest mirror: %s' % mirrors[0]['url'], **result)
+
+    expected = (module.params['sha256'] or '').lower() or None
+    if os.path.isfile(dest) and expected and module.digest_from_file(dest, 'sha256') == expected:
+        result['sha256'] = expected
+        result['changed'] = module.set_fs_attributes_if_different(module.load_file_common_arguments(module.params), False)
+        module.exit_json(msg='file already exists', **result)
+    if module.check_mode:
+        module.exit_json(msg='Would download %s' % dest, **dict(result, changed=True))
+
+    part, sha256 = fetcher.fetch(mirrors, dest, size, module.params['segments'])
+    if expected and sha256 != expected:
+        os.remove(part)
+        module.fail_json(msg='The sha256 %s of %s does not match the expected %s' % (sha256, dest, expected), **result)
+    module.atomic_move(part, dest)
+    module.set_fs_attributes_if_different(module.load_file_common_arguments(module.params), True)
+    result.update(changed=True, sha256=sha256)
+    module.exit_json(msg='OK', **result)
+
+
+if __name__ == '__main__':
+    main()
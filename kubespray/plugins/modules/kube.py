@@ -88,6 +88,51 @@ options:
       - Process the directory used in -f, --filename recursively.
         Useful when you want to manage related manifests organized
         within the same directory.
+  checksum_cache:
+    required: false
+    default: null
+    description:
+      - Path of a JSON file on the target node recording, per set of manifest files,
+        a hash of the files and of the last-applied configuration of every object they define.
+      - When set, latest and reloaded skip kubectl apply if neither the manifests on disk
+        nor the last-applied annotations in the cluster changed since the previous run.
+  chunk_size:
+    required: false
+    default: 0
+    description:
+      - When greater than 0, absent and exists with label or all (and without name or filename)
+        list the resources from the API server page by page (limit/continue) with this many
+        objects per page instead of a single unpaginated kubectl call.
+      - Every page is deleted as soon as it is listed, so memory use does not grow with the
+        number of matching objects.
+  concurrency:
+    required: false
+    default: 4
+    description:
+      - Number of kubectl delete calls running in parallel for a paginated delete.
+  counts_only:
+    required: false
+    default: false
+    description:
+      - Only return the number of matched and deleted objects of a paginated delete
+        (in counts) instead of one entry per object in resources.
+  report_actions:
+    required: false
+    default: false
+    description:
+      - Report for every object of present, latest and reloaded whether kubectl apply
+        created, configured or left it unchanged, and set changed from it.
+      - This reads the resourceVersion of the objects with one more kubectl get before
+        the apply. When false, a single kubectl apply is run, the action of every object
+        is applied and an apply is never reported as changed.
+  timings:
+    required: false
+    default: false
+    description:
+      - Record every kubectl call made by the module (command, exit code, wall time,
+        bytes of stdout and stderr) and return them in timings.
+      - scripts/kube_timings.py turns a playbook log with these results into a report
+        of the slowest kube operations per role.
 requirements:
   - kubectl
 author: "Kenny Jones (@kenjones-cisco)"
@@ -114,197 +159,75 @@ EXAMPLES = """
     files:
       - /tmp/nginx.yml
       - /tmp/postgresql.yml
-"""
-
-
-class KubeManager(object):
-
-    def __init__(self, module):
-
-        self.module = module
-
-        self.kubectl = module.params.get('kubectl')
-        if self.kubectl is None:
-            self.kubectl =  module.get_bin_path('kubectl', True)
-        self.base_cmd = [self.kubectl]
-
-        if module.params.get('server'):
-            self.base_cmd.append('--server=' + module.params.get('server'))
-
-        if module.params.get('kubeconfig'):
-            self.base_cmd.append('--kubeconfig=' + module.params.get('kubeconfig'))
-
-        if module.params.get('log_level'):
-            self.base_cmd.append('--v=' + str(module.params.get('log_level')))
-
-        if module.params.get('namespace'):
-            self.base_cmd.append('--namespace=' + module.params.get('namespace'))
-
-
-        self.all = module.params.get('all')
-        self.force = module.params.get('force')
-        self.wait = module.params.get('wait')
-        self.name = module.params.get('name')
-        self.filename = [f.strip() for f in module.params.get('filename') or []]
-        self.resource = module.params.get('resource')
-        self.label = module.params.get('label')
-        self.recursive = module.params.get('recursive')
-
-    def _execute(self, cmd):
-        args = self.base_cmd + cmd
-        try:
-            rc, out, err = self.module.run_command(args)
-            if rc != 0:
-                self.module.fail_json(
-                    msg='error running kubectl (%s) command (rc=%d), out=\'%s\', err=\'%s\'' % (' '.join(args), rc, out, err))
-        except Exception as exc:
-            self.module.fail_json(
-                msg='error running kubectl (%s) command: %s' % (' '.join(args), str(exc)))
-        return out.splitlines()
-
-    def _execute_nofail(self, cmd):
-        args = self.base_cmd + cmd
-        rc, out, err = self.module.run_command(args)
-        if rc != 0:
-            return None
-        return out.splitlines()
-
-    def create(self, check=True, force=True):
-        if check and self.exists():
-            return []
-
-        cmd = ['apply']
-
-        if force:
-            cmd.append('--force')
-
-        if self.wait:
-            cmd.append('--wait')
-
-        if self.recursive:
-            cmd.append('--recursive={}'.format(self.recursive))
-
-        if not self.filename:
-            self.module.fail_json(msg='filename required to create')
-
-        cmd.append('--filename=' + ','.join(self.filename))
-
-        return self._execute(cmd)
 
-    def replace(self, force=True):
-
-        cmd = ['apply']
-
-        if force:
-            cmd.append('--force')
-
-        if self.wait:
-            cmd.append('--wait')
-
-        if self.recursive:
-            cmd.append('--recursive={}'.format(self.recursive))
-
-        if not self.filename:
-            self.module.fail_json(msg='filename required to reload')
-
-        cmd.append('--filename=' + ','.join(self.filename))
-
-        return self._execute(cmd)
-
-    def delete(self):
-
-        if not self.force and not self.exists():
-            return []
-
-        cmd = ['delete']
-
-        if self.filename:
-            cmd.append('--filename=' + ','.join(self.filename))
-            if self.recursive:
-                cmd.append('--recursive={}'.format(self.recursive))
-        else:
-            if not self.resource:
-                self.module.fail_json(msg='resource required to delete without filename')
-
-            cmd.append(self.resource)
-
-            if self.name:
-                cmd.append(self.name)
-
-            if self.label:
-                cmd.append('--selector=' + self.label)
-
-            if self.all:
-                cmd.append('--all')
-
-            if self.force:
-                cmd.append('--ignore-not-found')
-
-            if self.recursive:
-                cmd.append('--recursive={}'.format(self.recursive))
-
-        return self._execute(cmd)
-
-    def exists(self):
-        cmd = ['get']
-
-        if self.filename:
-            cmd.append('--filename=' + ','.join(self.filename))
-            if self.recursive:
-                cmd.append('--recursive={}'.format(self.recursive))
-        else:
-            if not self.resource:
-                self.module.fail_json(msg='resource required without filename')
-
-            cmd.append(self.resource)
-
-            if self.name:
-                cmd.append(self.name)
-
-            if self.label:
-                cmd.append('--selector=' + self.label)
-
-            if self.all:
-                cmd.append('--all-namespaces')
-
-        cmd.append('--no-headers')
-
-        result = self._execute_nofail(cmd)
-        if not result:
-            return False
-        return True
-
-    # TODO: This is currently unused, perhaps convert to 'scale' with a replicas param?
-    def stop(self):
-
-        if not self.force and not self.exists():
-            return []
-
-        cmd = ['stop']
-
-        if self.filename:
-            cmd.append('--filename=' + ','.join(self.filename))
-            if self.recursive:
-                cmd.append('--recursive={}'.format(self.recursive))
-        else:
-            if not self.resource:
-                self.module.fail_json(msg='resource required to stop without filename')
-
-            cmd.append(self.resource)
+- name: register the applied objects and whether kubectl changed them
+  kube:
+    filename: /tmp/nginx.yml
+    state: latest
+    report_actions: true
+  register: nginx_apply
 
-            if self.name:
-                cmd.append(self.name)
+- name: only apply nginx when the manifest or the cluster copy changed
+  kube:
+    filename: /tmp/nginx.yml
+    state: latest
+    checksum_cache: /etc/kubernetes/.kube-checksums.json
 
-            if self.label:
-                cmd.append('--selector=' + self.label)
+- name: delete every job runner pod, 500 at a time
+  kube:
+    resource: pods
+    label: app=job-runner
+    namespace: default
+    state: absent
+    chunk_size: 500
+    concurrency: 8
+    counts_only: true
+"""
 
-            if self.all:
-                cmd.append('--all')
+RETURN = """
+resources:
+  description:
+    - The objects reported by kubectl for the operation, one entry per object.
+    - Each entry has kind, name, namespace, action, generation and resourceVersion.
+    - The action of an apply is applied, or with report_actions created, configured or
+      unchanged, found by comparing the resourceVersion of the objects before and after it.
+      Fields kubectl does not report for the operation (e.g. generation on delete) are null.
+  returned: success
+  type: list
+  sample:
+    - kind: Deployment
+      name: nginx
+      namespace: default
+      action: configured
+      generation: 3
+      resourceVersion: "123456"
+counts:
+  description:
+    - Number of objects matched and deleted by a paginated delete.
+  returned: when chunk_size is set and the delete selects by label or all
+  type: dict
+  sample:
+    matched: 12000
+    deleted: 12000
+timings:
+  description:
+    - One entry per kubectl call, in the order the calls were started.
+  returned: when timings is true
+  type: list
+  sample:
+    - cmd: "/usr/local/bin/kubectl --namespace=kube-system apply --force --filename=/etc/kubernetes/coredns.yml --output=json"
+      rc: 0
+      seconds: 1.734
+      stdout_bytes: 5120
+      stderr_bytes: 0
+"""
 
-            if self.force:
-                cmd.append('--ignore-not-found')
+from ansible.module_utils.basic import AnsibleModule
 
-        return self._execute(cmd)
+try:
+    from ansible.module_utils.kube import KubeManager, CHANGED_ACTIONS
+except ImportError:
+    from ansible_collections.kubernetes_sigs.kubespray.plugins.module_utils.kube import KubeManager, CHANGED_ACTIONS
 
 
 def main():
@@ -325,6 +248,12 @@ def main():
             log_level=dict(default=0, type='int'),
             state=dict(default='present', choices=['present', 'absent', 'latest', 'reloaded', 'stopped', 'exists']),
             recursive=dict(default=False, type='bool'),
+            checksum_cache=dict(type='path'),
+            chunk_size=dict(default=0, type='int'),
+            concurrency=dict(default=4, type='int'),
+            counts_only=dict(default=False, type='bool'),
+            report_actions=dict(default=False, type='bool'),
+            timings=dict(default=False, type='bool'),
             ),
             mutually_exclusive=[['filename', 'list']]
         )
@@ -332,6 +261,10 @@ def main():
     changed = False
 
     manager = KubeManager(module)
+    extra = {}
+    if manager.timings is not None:
+        extra['timings'] = manager.timings
+
     state = module.params.get('state')
     if state == 'present':
         result = manager.create(check=False)
@@ -351,16 +284,25 @@ def main():
     elif state == 'exists':
         result = manager.exists()
         module.exit_json(changed=changed,
-                     msg='%s' % result)
+                         msg='%s' % result,
+                         **extra)
 
     else:
         module.fail_json(msg='Unrecognized state %s.' % state)
 
+    if manager.counts is not None:
+        module.exit_json(changed=manager.counts['deleted'] > 0,
+                         msg='success: %(deleted)d of %(matched)d matched objects deleted' % manager.counts,
+                         resources=result,
+                         counts=manager.counts,
+                         **extra)
+
+    changed = any(r['action'] in CHANGED_ACTIONS for r in result)
     module.exit_json(changed=changed,
-                     msg='success: %s' % (' '.join(result))
-                     )
+                     msg='success: %s' % (' '.join('%s/%s %s' % (r['kind'], r['name'], r['action']) for r in result)),
+                     resources=result,
+                     **extra)
 
 
-from ansible.module_utils.basic import *  # noqa
 if __name__ == '__main__':
     main()
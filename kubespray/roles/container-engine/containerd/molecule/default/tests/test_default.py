@@ -1,10 +1,6 @@
-import os
-import pytest
+from container_engine import CRICTL, HELLO_FROM_DOCKER, NERDCTL, inventory_hosts, run
 
-import testinfra.utils.ansible_runner
-
-testinfra_hosts = testinfra.utils.ansible_runner.AnsibleRunner(
-    os.environ['MOLECULE_INVENTORY_FILE']).get_hosts('all')
+testinfra_hosts = inventory_hosts()
 
 
 def test_service(host):
@@ -14,42 +10,18 @@ def test_service(host):
 
 
 def test_version(host):
-    crictl = "/usr/local/bin/crictl"
     path = "unix:///var/run/containerd/containerd.sock"
-    with host.sudo():
-        cmd = host.command(crictl + " --runtime-endpoint " + path + " version")
-    assert cmd.rc == 0
+    cmd = run(host, CRICTL + " --runtime-endpoint " + path + " version")
     assert "RuntimeName:  containerd" in cmd.stdout
 
 
-@pytest.mark.parametrize('image, dest', [
-    ('quay.io/kubespray/hello-world:latest', '/tmp/hello-world.tar')
-])
-def test_image_pull_save_load(host, image, dest):
-    nerdctl = "/usr/local/bin/nerdctl"
-    dest_file = host.file(dest)
-
+def test_image_pull_save_load(host, hello_world_tar, hello_world_image):
     with host.sudo():
-        pull_cmd = host.command(nerdctl + " pull " + image)
-    assert pull_cmd.rc ==0
+        assert host.file(hello_world_tar).exists
+    cmd = run(host, NERDCTL + " -n k8s.io images --quiet --no-trunc " + hello_world_image)
+    assert cmd.stdout.strip()
 
-    with host.sudo():
-        save_cmd = host.command(nerdctl + " save -o " + dest + " " + image)
-    assert save_cmd.rc == 0
-    assert dest_file.exists
 
-    with host.sudo():
-        load_cmd = host.command(nerdctl + " load < " + dest)
-    assert load_cmd.rc == 0
-
-
-@pytest.mark.parametrize('image', [
-    ('quay.io/kubespray/hello-world:latest')
-])
-def test_run(host, image):
-    nerdctl = "/usr/local/bin/nerdctl"
-
-    with host.sudo():
-        cmd = host.command(nerdctl + " -n k8s.io run " + image)
-    assert cmd.rc == 0
-    assert "Hello from Docker" in cmd.stdout
+def test_run(host, hello_world_image):
+    cmd = run(host, NERDCTL + " -n k8s.io run --rm --pull never " + hello_world_image)
+    assert HELLO_FROM_DOCKER in cmd.stdout
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the fixtures shared by the container-engine scenarios are in tests/testinfra/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), *[os.pardir] * 6, 'tests', 'testinfra'))
+
+from container_engine import *  # noqa: E402,F401,F403
@@ -1,9 +1,6 @@
-import os
+from container_engine import CRICTL, HELLO_FROM_DOCKER, inventory_hosts, run, run_pod
 
-import testinfra.utils.ansible_runner
-
-testinfra_hosts = testinfra.utils.ansible_runner.AnsibleRunner(
-    os.environ['MOLECULE_INVENTORY_FILE']).get_hosts('all')
+testinfra_hosts = inventory_hosts()
 
 
 def test_service(host):
@@ -13,23 +10,10 @@ def test_service(host):
 
 
 def test_run(host):
-    crictl = "/usr/local/bin/crictl"
     path = "unix:///var/run/crio/crio.sock"
-    with host.sudo():
-        cmd = host.command(crictl + " --runtime-endpoint " + path + " version")
-    assert cmd.rc == 0
+    cmd = run(host, CRICTL + " --runtime-endpoint " + path + " version")
     assert "RuntimeName:  cri-o" in cmd.stdout
 
-def test_run_pod(host):
-    runtime = "runc"
-
-    run_command = "/usr/local/bin/crictl run --with-pull --runtime {} /tmp/container.json /tmp/sandbox.json".format(runtime)
-    with host.sudo():
-        cmd = host.command(run_command)
-    assert cmd.rc == 0
 
-    with host.sudo():
-      log_f = host.file("/tmp/runc1.0.log")
-
-      assert log_f.exists
-      assert b"Hello from Docker" in log_f.content
+def test_run_pod(host):
+    assert HELLO_FROM_DOCKER in run_pod(host, "/tmp/runc1.0.log", runtime="runc")
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+# Maintain the content-addressed file cache of the download role.
+#
+# With download_cache_content_addressed enabled, cached files are stored once
+# as <download_cache_dir>/sha256/<sha256> and hardlinked to the name of their
+# url under <download_cache_dir>/files/. The role records the time a file is
+# last used in its access time.
+#
+#   download_cache.py prune /tmp/kubespray_cache --max-size 20G --hits 30 --misses 2
+#   download_cache.py stats /tmp/kubespray_cache
+#
+# prune evicts the least recently used files until the cache fits max-size,
+# records the hits and misses of the run in stats.json and prints the report
+# of stats.
+
+import argparse
+import json
+import os
+import sys
+import time
+
+SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+STATS_FILE = "stats.json"
+# runs kept in stats.json
+HISTORY = 50
+
+
+def parse_size(value):
+    value = str(value).strip().upper().rstrip("IB")
+    if value and value[-1] in SUFFIXES:
+        return int(float(value[:-1]) * SUFFIXES[value[-1]])
+    return int(value)
+
+
+def human(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+def scan(cache_dir):
+    """Return ({inode: blob}, {inode: [names]}) of the content-addressed cache."""
+    blobs, names = {}, {}
+    blob_dir = os.path.join(cache_dir, "sha256")
+    if os.path.isdir(blob_dir):
+        for entry in os.scandir(blob_dir):
+            if entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                blobs[stat.st_ino] = {"path": entry.path, "size": stat.st_size, "atime": stat.st_atime}
+    for root, _, files in os.walk(os.path.join(cache_dir, "files")):
+        for name in files:
+            path = os.path.join(root, name)
+            names.setdefault(os.lstat(path).st_ino, []).append(path)
+    return blobs, names
+
+
+def remove(path, cache_dir):
+    os.remove(path)
+    # drop the directories of the url the file was named after once empty
+    parent = os.path.dirname(path)
+    while parent.startswith(os.path.join(cache_dir, "files") + os.sep):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+
+
+def prune(cache_dir, max_size):
+    """Evict the least recently used files until the cache holds at most max_size bytes; return them."""
+    blobs, names = scan(cache_dir)
+    # names whose file is no longer in the cache
+    for inode in set(names) - set(blobs):
+        for path in names.pop(inode):
+            remove(path, cache_dir)
+
+    evicted = []
+    total = sum(blob["size"] for blob in blobs.values())
+    for inode, blob in sorted(blobs.items(), key=lambda b: b[1]["atime"]):
+        if not max_size or total <= max_size:
+            break
+        for path in names.get(inode, []):
+            remove(path, cache_dir)
+        os.remove(blob["path"])
+        total -= blob["size"]
+        evicted.append(blob)
+    return evicted
+
+
+def load_stats(cache_dir):
+    path = os.path.join(cache_dir, STATS_FILE)
+    if not os.path.isfile(path):
+        return {"runs": []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def record_run(cache_dir, hits, misses, evicted):
+    stats = load_stats(cache_dir)
+    stats["runs"] = stats["runs"][-(HISTORY - 1):] + [{
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "hits": hits,
+        "misses": misses,
+        "evicted": len(evicted),
+        "evicted_bytes": sum(blob["size"] for blob in evicted),
+    }]
+    path = os.path.join(cache_dir, STATS_FILE)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(stats, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def report(cache_dir):
+    blobs, names = scan(cache_dir)
+    stored = sum(blob["size"] for blob in blobs.values())
+    # what the cache would hold if every name were a copy of its own
+    by_name = sum(blob["size"] * len(names.get(inode, [])) for inode, blob in blobs.items())
+    runs = load_stats(cache_dir)["runs"]
+    hits, misses = sum(r["hits"] for r in runs), sum(r["misses"] for r in runs)
+    oldest = min((blob["atime"] for blob in blobs.values()), default=None)
+    return {
+        "files": len(blobs),
+        "names": sum(len(paths) for inode, paths in names.items() if inode in blobs),
+        "stored_bytes": stored,
+        "saved_bytes": max(by_name - stored, 0),
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+        "evicted": sum(r["evicted"] for r in runs),
+        "runs": len(runs),
+        "last_run": runs[-1] if runs else None,
+        "oldest_use_days": round((time.time() - oldest) / 86400, 1) if oldest else None,
+    }
+
+
+def print_report(stats):
+    print(f"files:     {stats['files']} ({human(stats['stored_bytes'])}), {stats['names']} names,"
+          f" {human(stats['saved_bytes'])} saved by deduplication")
+    hit_rate = f"{stats['hit_rate'] * 100:.1f}%" if stats["hit_rate"] is not None else "-"
+    print(f"hit rate:  {hit_rate} ({stats['hits']} hits, {stats['misses']} misses over {stats['runs']} runs)")
+    if stats["last_run"]:
+        last = stats["last_run"]
+        print(f"last run:  {last['time']}, {last['hits']} hits, {last['misses']} misses,"
+              f" {last['evicted']} evicted ({human(last['evicted_bytes'])})")
+    if stats["oldest_use_days"] is not None:
+        print(f"LRU file:  last used {stats['oldest_use_days']} days ago")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the content-addressed download cache")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    prune_parser = subparsers.add_parser("prune", help="evict least recently used files and record a run")
+    prune_parser.add_argument("cache_dir")
+    prune_parser.add_argument("--max-size", type=parse_size, default=0,
+                              help="size of the cache, e.g. 20G (default: 0, unlimited)")
+    prune_parser.add_argument("--hits", type=int, default=0, help="files of the run found in the cache")
+    prune_parser.add_argument("--misses", type=int, default=0, help="files of the run downloaded")
+    stats_parser = subparsers.add_parser("stats", help="report the cache size, deduplication and hit rate")
+    stats_parser.add_argument("cache_dir")
+    stats_parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    if args.command == "prune":
+        evicted = prune(args.cache_dir, args.max_size)
+        record_run(args.cache_dir, args.hits, args.misses, evicted)
+        for blob in evicted:
+            print(f"evicted {os.path.basename(blob['path'])} ({human(blob['size'])})")
+    stats = report(args.cache_dir)
+    if getattr(args, "json", False):
+        json.dump(stats, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(stats)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
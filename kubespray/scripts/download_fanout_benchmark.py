@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Compare the time to distribute a file to every node from the ansible host
+# (download_fanout_width: 0) with the fan-out distribution of the download role.
+#
+# The nodes are directories on this host. Each copy really reads, writes and
+# verifies the file, and every host (including the ansible host) has an upload
+# bandwidth shared by all the copies it serves at the same time, as a network
+# link would be. At most --forks copies run at once, as with Ansible forks,
+# and every copy costs --overhead seconds for the ssh/rsync start-up.
+#
+#   ./download_fanout_benchmark.py --nodes 100 --size 64 --bandwidth 100 --width 0 --width 2 --width 4 --width 8
+
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class Uplink:
+    """Upload bandwidth of a host, shared by the copies it serves concurrently."""
+
+    def __init__(self, bandwidth):
+        self.seconds_per_byte = 1 / (bandwidth * 1024 * 1024)
+        self.free_at = 0.0
+        self.lock = threading.Lock()
+
+    def send(self, size):
+        with self.lock:
+            start = max(time.monotonic(), self.free_at)
+            self.free_at = start + size * self.seconds_per_byte
+            done = self.free_at
+        time.sleep(max(done - time.monotonic(), 0))
+
+
+def copy(src, dest, uplink, overhead, sha256):
+    time.sleep(overhead)
+    digest = hashlib.sha256()
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        for chunk in iter(lambda: fsrc.read(CHUNK_SIZE), b""):
+            uplink.send(len(chunk))
+            fdest.write(chunk)
+            digest.update(chunk)
+    if digest.hexdigest() != sha256:
+        raise RuntimeError(f"{dest} does not match its sha256")
+
+
+def tree(nodes, width):
+    """Return [(node, parent, wave)] in the order of the download role, parent 0 being the cache."""
+    placement = []
+    for node in range(1, nodes + 1):
+        parent = (node - 1) // width if width else 0
+        wave = placement[parent - 1][2] + 1 if parent else 1
+        placement.append((node, parent, wave))
+    return placement
+
+
+def distribute(workdir, source, sha256, nodes, width, bandwidth, forks, overhead):
+    uplinks = [Uplink(bandwidth) for _ in range(nodes + 1)]
+    paths = [source] + [os.path.join(workdir, f"node{node}") for node in range(1, nodes + 1)]
+    placement = tree(nodes, width)
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=forks) as executor:
+        # every wave is an Ansible task, the next one starts when all its nodes are done
+        for wave in range(1, max(w for _, _, w in placement) + 1):
+            futures = [executor.submit(copy, paths[parent], paths[node], uplinks[parent], overhead, sha256)
+                       for node, parent, w in placement if w == wave]
+            for future in futures:
+                future.result()
+    elapsed = time.monotonic() - start
+    for path in paths[1:]:
+        os.remove(path)
+    return elapsed, max(w for _, _, w in placement)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the fan-out distribution of the download role")
+    parser.add_argument("--nodes", type=int, default=30, help="number of nodes receiving the file")
+    parser.add_argument("--size", type=int, default=16, help="size of the file in MiB")
+    parser.add_argument("--bandwidth", type=float, default=100, help="upload bandwidth of every host in MiB/s")
+    parser.add_argument("--forks", type=int, default=50, help="copies running at the same time")
+    parser.add_argument("--overhead", type=float, default=0.5, help="start-up time of every copy in seconds")
+    parser.add_argument("--width", type=int, action="append",
+                        help="download_fanout_width to measure, repeatable, 0 copies from the ansible host (default: 0 2 4)")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="fanout-")
+    try:
+        source = os.path.join(workdir, "cache")
+        with open(source, "wb") as f:
+            for _ in range(args.size):
+                f.write(os.urandom(CHUNK_SIZE))
+        with open(source, "rb") as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+
+        print(f"{args.nodes} nodes, {args.size} MiB, {args.bandwidth:g} MiB/s per host, {args.forks} forks")
+        print(f"{'width':>5} {'waves':>5} {'seconds':>8}")
+        for width in args.width or [0, 2, 4]:
+            elapsed, waves = distribute(workdir, source, sha256, args.nodes, width, args.bandwidth,
+                                        args.forks, args.overhead)
+            print(f"{width:>5} {waves:>5} {elapsed:>8.2f}")
+    finally:
+        shutil.rmtree(workdir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,65 +1,474 @@
 #!/usr/bin/env python3
 
-# After a new version of Kubernetes has been released,
-# run this script to update roles/kubespray-defaults/defaults/main/download.yml
+# After new versions of the components have been released,
+# run this script to update roles/kubespray-defaults/defaults/main/checksums.yml
 # with new hashes.
+#
+#   ./download_hash.py                    regenerate every *_checksums map from the
+#                                         latest upstream releases
+#   ./download_hash.py --only crictl runc regenerate only these maps
+#   ./download_hash.py v1.29.1 v1.28.6    add these Kubernetes versions to the
+#                                         kubelet/kubectl/kubeadm maps
+#
+# Digests are kept in a local cache keyed by URL, together with the ETag and
+# Last-Modified of the response they were computed from, so an interrupted
+# run resumes where it stopped and only fetches what is still missing.
+# Checksums already in checksums.yml and cached digests are trusted without
+# any network access. --revalidate checks them against upstream with a HEAD
+# request, fetching again only the files whose ETag or Last-Modified changed;
+# --verify downloads every file again, checks it against its published digest
+# and that it still matches.
 
+import argparse
 import hashlib
+import json
+import os
+import re
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
 from ruamel.yaml import YAML
+from urllib3.util.retry import Retry
+
+MAIN_YML = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "../roles/kubespray-defaults/defaults/main/checksums.yml")
+CACHE_FILE = os.environ.get("KUBESPRAY_DIGEST_CACHE") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "kubespray", "download_hash.json")
+
+ARCHITECTURES = ["arm", "arm64", "amd64", "ppc64le"]
+
+CHUNK_SIZE = 1024 * 1024
+
+SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+SEMVER_RE = re.compile(r"^v?(0|[1-9]\d*)\.(0|[1-9]\d*)\.(0|[1-9]\d*)$")
+
+GITHUB_RELEASES = "https://github.com/{repo}/releases/download/{version}/{file}"
+GITHUB_ARCHIVE = "https://github.com/{repo}/archive/{file}"
+GOOGLE_STORAGE = "https://storage.googleapis.com"
+K8S_RELEASE = "https://dl.k8s.io/release/{version}/bin/{os}/{arch}/{file}"
+
+
+@dataclass(frozen=True)
+class Versions:
+    """Release versions of a component, taken from the tags of its GitHub repository."""
+
+    repo: str
+    limit: int = 7
+    pattern: re.Pattern = SEMVER_RE
+    # turns a matching tag into the version used in URLs and checksums.yml
+    transform: Callable[[str], str] = lambda tag: tag
+
+
+@dataclass
+class Component:
+    """How to build the download URLs of a *_checksums map in checksums.yml."""
+
+    name: str
+    url: Callable[[str, str, str], str]
+    versions: Versions
+    # "arch": arch -> version, "os": os -> arch -> version, "flat": version
+    layout: str = "arch"
+    skip_archs: Tuple[str, ...] = ()
+    # extra availability rule, (version, arch) -> bool
+    available: Optional[Callable[[str, str], bool]] = None
+    # version keys in checksums.yml are written without the leading v
+    strip_v: bool = False
+    # layout "os": architectures published for every os
+    oses: Dict[str, Tuple[str, ...]] = field(default_factory=dict)
+    # URL of a digest file published upstream next to the download
+    digest_url: Optional[Callable[[str], str]] = None
+    comment: Tuple[str, ...] = ()
+
+    @property
+    def key(self):
+        return f"{self.name}_checksums"
+
+
+def version_tuple(version):
+    return tuple(int(n) for n in re.findall(r"\d+", str(version)))
+
+
+def github(repo, file):
+    return lambda version, arch, os: GITHUB_RELEASES.format(
+        repo=repo, version=version, file=file.format(version=version, v=version.lstrip("v"), arch=arch, os=os))
+
+
+def k8s(file):
+    return lambda version, arch, os: K8S_RELEASE.format(version=version, os=os, arch=arch, file=file)
+
+
+def gvisor(file):
+    machine = {"amd64": "x86_64", "arm64": "aarch64"}
+    return lambda version, arch, os: f"{GOOGLE_STORAGE}/gvisor/releases/release/{version}/{machine.get(arch, arch)}/{file}"
+
+
+def youki_url(version, arch, os):
+    tag = "v0_0_1" if version == "v0.0.1" else version.lstrip("v").replace(".", "_")
+    return GITHUB_RELEASES.format(repo="containers/youki", version=version, file=f"youki_{tag}_{os}.tar.gz")
+
+
+def kube_arm_available(version, arch):
+    # kubelet and kubeadm are no longer published for arm since 1.27
+    return arch != "arm" or version_tuple(version) < (1, 27)
+
+
+def containerd_available(version, arch):
+    first = {"arm": (2,), "arm64": (1, 6, 0), "amd64": (1, 5, 5), "ppc64le": (1, 6, 7)}
+    return version_tuple(version) >= first[arch]
+
+
+KUBERNETES = Versions("kubernetes/kubernetes", 25)
+CALICO = Versions("projectcalico/calico", 20)
+GVISOR = Versions("google/gvisor", 9, re.compile(r"^release-?(0|[1-9]\d*)\.(0|[1-9]\d*)$"), lambda tag: tag[8:16])
+
+COMPONENTS = [
+    Component("crictl", github("kubernetes-sigs/cri-tools", "crictl-{version}-{os}-{arch}.tar.gz"),
+              Versions("kubernetes-sigs/cri-tools", 4)),
+    Component("crio_archive", lambda version, arch, os: f"{GOOGLE_STORAGE}/cri-o/artifacts/cri-o.{arch}.{version}.tar.gz",
+              Versions("cri-o/cri-o"), skip_archs=("arm", "ppc64le")),
+    Component("kubelet", k8s("kubelet"), KUBERNETES, available=kube_arm_available,
+              digest_url=lambda url: f"{url}.sha256",
+              comment=("# Checksum",
+                       "# Kubernetes versions above Kubespray's current target version are untested and should be used with caution.")),
+    Component("kubectl", k8s("kubectl"), KUBERNETES, digest_url=lambda url: f"{url}.sha256"),
+    Component("kubeadm", k8s("kubeadm"), KUBERNETES, available=kube_arm_available,
+              digest_url=lambda url: f"{url}.sha256"),
+    Component("etcd_binary", github("etcd-io/etcd", "etcd-{version}-{os}-{arch}.tar.gz"),
+              Versions("etcd-io/etcd"), skip_archs=("arm",)),
+    Component("cni_binary", github("containernetworking/plugins", "cni-plugins-{os}-{arch}-{version}.tgz"),
+              Versions("containernetworking/plugins")),
+    Component("calicoctl_binary", github("projectcalico/calico", "calicoctl-{os}-{arch}"), CALICO, skip_archs=("arm",)),
+    Component("ciliumcli_binary", github("cilium/cilium-cli", "cilium-{os}-{arch}.tar.gz"),
+              Versions("cilium/cilium-cli", 10), skip_archs=("ppc64le",)),
+    Component("calico_crds_archive",
+              lambda version, arch, os: GITHUB_ARCHIVE.format(repo="projectcalico/calico", file=f"{version}.tar.gz"),
+              CALICO, layout="flat"),
+    Component("krew_archive", github("kubernetes-sigs/krew", "krew-{os}_{arch}.tar.gz"),
+              Versions("kubernetes-sigs/krew", 2), layout="os",
+              oses={"darwin": ("arm64", "amd64"), "linux": ("arm", "arm64", "amd64"), "windows": ("amd64",)}),
+    Component("helm_archive", lambda version, arch, os: f"https://get.helm.sh/helm-{version}-{os}-{arch}.tar.gz",
+              Versions("helm/helm")),
+    Component("cri_dockerd_archive", github("Mirantis/cri-dockerd", "cri-dockerd-{v}.{arch}.tgz"),
+              Versions("Mirantis/cri-dockerd"), skip_archs=("arm", "ppc64le"), strip_v=True),
+    Component("runc", github("opencontainers/runc", "runc.{arch}"), Versions("opencontainers/runc", 5), skip_archs=("arm",)),
+    Component("crun", github("containers/crun", "crun-{version}-{os}-{arch}"), Versions("containers/crun"),
+              skip_archs=("arm", "ppc64le")),
+    Component("youki", youki_url, Versions("containers/youki"), skip_archs=("arm", "arm64", "ppc64le"), strip_v=True),
+    Component("kata_containers_binary",
+              lambda version, arch, os: GITHUB_RELEASES.format(
+                  repo="kata-containers/kata-containers", version=version,
+                  file=f"kata-static-{version}-{arch.replace('amd64', 'x86_64')}.tar.xz"),
+              Versions("kata-containers/kata-containers", 10), skip_archs=("arm", "arm64", "ppc64le")),
+    Component("gvisor_runsc_binary", gvisor("runsc"), GVISOR, skip_archs=("arm", "ppc64le")),
+    Component("gvisor_containerd_shim_binary", gvisor("containerd-shim-runsc-v1"), GVISOR, skip_archs=("arm", "ppc64le")),
+    Component("nerdctl_archive",
+              lambda version, arch, os: GITHUB_RELEASES.format(
+                  repo="containerd/nerdctl", version=version,
+                  file=f"nerdctl-{version.lstrip('v')}-{os}-{'arm-v7' if arch == 'arm' else arch}.tar.gz"),
+              Versions("containerd/nerdctl"), strip_v=True),
+    Component("containerd_archive", github("containerd/containerd", "containerd-{v}-{os}-{arch}.tar.gz"),
+              Versions("containerd/containerd", 30), available=containerd_available, strip_v=True),
+    Component("skopeo_binary", github("lework/skopeo-binary", "skopeo-{os}-{arch}"), Versions("lework/skopeo-binary"),
+              skip_archs=("arm", "ppc64le")),
+    Component("yq", github("mikefarah/yq", "yq_{os}_{arch}"), Versions("mikefarah/yq")),
+]
 
-MAIN_YML = "../roles/kubespray-defaults/defaults/main/download.yml"
 
 def open_main_yaml():
-    yaml = YAML()
-    yaml.explicit_start = True
-    yaml.preserve_quotes = True
-    yaml.width = 4096
+    yaml = YAML(typ="safe")
 
     with open(MAIN_YML, "r") as main_yml:
-        data = yaml.load(main_yml)
+        data = yaml.load(main_yml) or {}
+
+    return data
+
+
+def new_session(workers):
+    session = requests.Session()
+    # one pooled connection per worker, reused for every download; transient
+    # errors and rate limiting are retried with an exponential backoff
+    retries = Retry(total=5, backoff_factor=2, status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if os.environ.get("GITHUB_TOKEN"):
+        session.headers["Authorization"] = f"token {os.environ['GITHUB_TOKEN']}"
+    return session
+
+
+def validators(response, url):
+    return {
+        "source": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
 
-    return data, yaml
+def stream_sha256(session, url):
+    """Hash the file at url without holding it in memory."""
+    sha256 = hashlib.sha256()
+    with session.get(url, allow_redirects=True, stream=True) as download_file:
+        download_file.raise_for_status()
+        for chunk in download_file.iter_content(chunk_size=CHUNK_SIZE):
+            sha256.update(chunk)
+    return dict(validators(download_file, url), sha256=sha256.hexdigest())
 
 
-def download_hash(versions):
-    architectures = ["arm", "arm64", "amd64", "ppc64le"]
-    downloads = ["kubelet", "kubectl", "kubeadm"]
+def published_sha256(session, url):
+    """Return the digest published at url, None when there is none."""
+    response = session.get(url, allow_redirects=True)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    fields = response.text.split()
+    if not fields or not SHA256_RE.match(fields[0].lower()):
+        return None
+    return dict(validators(response, url), sha256=fields[0].lower())
 
-    data, yaml = open_main_yaml()
 
-    for download in downloads:
-        checksum_name = f"{download}_checksums"
-        for arch in architectures:
+def unchanged(session, entry):
+    """Whether the response a cache entry was computed from is still the same upstream."""
+    if not entry.get("source") or not (entry.get("etag") or entry.get("last_modified")):
+        return False
+    response = session.head(entry["source"], allow_redirects=True)
+    if not response.ok:
+        return False
+    if entry.get("etag"):
+        return response.headers.get("ETag") == entry["etag"]
+    return response.headers.get("Last-Modified") == entry["last_modified"]
+
+
+def resolve_sha256(session, url, digest_url=None, verify=False, cached=None):
+    """Return the cache entry for url: its sha256 and the validators of the response it came from.
+
+    A cached entry still current upstream is returned as is, unless verify
+    asks for the file to be downloaded and hashed again.
+    """
+    if cached and not verify and unchanged(session, cached):
+        return cached
+    if digest_url:
+        entry = published_sha256(session, digest_url)
+        if entry is not None:
+            if verify:
+                downloaded = stream_sha256(session, url)
+                if downloaded["sha256"] != entry["sha256"]:
+                    raise ValueError(f"{url}: published sha256 {entry['sha256']} does not match downloaded file {downloaded['sha256']}")
+            return entry
+    return stream_sha256(session, url)
+
+
+class DigestCache:
+    """sha256 of every URL fetched so far with the validators of the response
+    it was computed from, saved after each new entry."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        # caches written before validators were recorded only hold the digest
+        for url, entry in self.entries.items():
+            if isinstance(entry, str):
+                self.entries[url] = {"sha256": entry}
+
+    def get(self, url):
+        entry = self.entries.get(url)
+        return entry["sha256"] if entry else None
+
+    def entry(self, url):
+        return self.entries.get(url)
+
+    def set(self, url, entry):
+        with self.lock:
+            self.entries[url] = entry
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f, indent=0, sort_keys=True)
+            os.replace(tmp, self.path)
+
+
+_versions = {}
+
+
+def get_versions(session, source):
+    if source not in _versions:
+        response = session.get(f"https://api.github.com/repos/{source.repo}/tags", params={"per_page": 100})
+        response.raise_for_status()
+        tags = [tag["name"] for tag in response.json() if source.pattern.match(tag["name"])]
+        if not tags:
+            raise ValueError(f"no release tags found for {source.repo}")
+        _versions[source] = [source.transform(tag) for tag in tags[:source.limit]]
+    return _versions[source]
+
+
+def entries(component, versions):
+    """Yield (path in the checksums map, url or None when not published) for every version."""
+    if component.layout == "flat":
+        for version in versions:
+            yield (version,), component.url(version, "amd64", "linux")
+        return
+
+    for os_name, archs in (component.oses.items() if component.layout == "os" else [("linux", ARCHITECTURES)]):
+        for arch in ARCHITECTURES:
             for version in versions:
-                if not version.startswith("v"):
-                    version = f"v{version}"
-                url = f"https://dl.k8s.io/release/{version}/bin/linux/{arch}/{download}"
-                download_file = requests.get(url, allow_redirects=True)
-                download_file.raise_for_status()
-                sha256sum = hashlib.sha256(download_file.content).hexdigest()
-                data[checksum_name][arch][version] = sha256sum
+                key = version.lstrip("v") if component.strip_v else version
+                published = (arch in archs and arch not in component.skip_archs
+                             and (component.available is None or component.available(version, arch)))
+                url = component.url(version, arch, os_name) if published else None
+                path = (os_name, arch, key) if component.layout == "os" else (arch, key)
+                yield path, url
+
+
+def merge_versions(current, new):
+    """Add new version keys to an existing version -> checksum map, newest first."""
+    merged = dict(current or {})
+    merged.update(new)
+    return dict(sorted(merged.items(), key=lambda item: version_tuple(item[0]), reverse=True))
+
+
+def lookup(data, key, path):
+    node = data.get(key)
+    for part in path:
+        if not isinstance(node, dict):
+            return None
+        # version keys such as gvisor's 20231113 are loaded as integers
+        node = node.get(part, node.get(int(part)) if str(part).isdigit() else None)
+    return node or None
+
+
+def build_maps(jobs, digests):
+    maps = {}
+    for component, path, url in jobs:
+        node = maps.setdefault(component.key, {})
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = digests[url] if url else 0
+    return maps
+
+
+def write_checksums(data):
+    known = [component.key for component in COMPONENTS]
+    comments = {component.key: component.comment for component in COMPONENTS}
+
+    def dump(node, indent):
+        for key, value in node.items():
+            if isinstance(value, dict):
+                lines.append(f"{'  ' * indent}{key}:")
+                dump(value, indent + 1)
+            else:
+                lines.append(f"{'  ' * indent}{key}: {value}")
+
+    lines = ["---"]
+    for key in known + sorted(set(data) - set(known)):
+        if key not in data:
+            continue
+        lines.extend(comments.get(key, ()))
+        lines.append(f"{key}:")
+        dump(data[key], 1)
 
     with open(MAIN_YML, "w") as main_yml:
-        yaml.dump(data, main_yml)
-        print(f"\n\nUpdated {MAIN_YML}\n")
+        main_yml.write("\n".join(lines) + "\n")
+    print(f"\n\nUpdated {MAIN_YML}\n")
 
 
-def usage():
-    print(f"USAGE:\n    {sys.argv[0]} [k8s_version1] [[k8s_version2]....[k8s_versionN]]")
+def download_hash(components, kube_versions=None, workers=8, digest_files=True, verify=False, revalidate=False,
+                  cache_file=CACHE_FILE):
+    session = new_session(workers)
+    cache = DigestCache(cache_file)
+    data = open_main_yaml()
 
+    jobs = []
+    for component in components:
+        if kube_versions:
+            versions = [version if version.startswith("v") else f"v{version}" for version in kube_versions]
+        else:
+            versions = get_versions(session, component.versions)
+        jobs.extend((component, path, url) for path, url in entries(component, versions))
 
-def main(argv=None):
-    if not argv:
-        argv = sys.argv[1:]
-    if not argv:
-        usage()
+    digest_urls = {url: component.digest_url(url) if digest_files and component.digest_url else None
+                   for component, _, url in jobs if url}
+    # checksums already in checksums.yml, trusted unless --verify or --revalidate is given
+    known = {url: lookup(data, component.key, path) for component, path, url in jobs if url}
+    known = {url: sha256sum for url, sha256sum in known.items() if sha256sum}
+    if verify or revalidate:
+        missing = list(digest_urls)
+    else:
+        missing = [url for url in digest_urls if url not in known and cache.get(url) is None]
+    print(f"{len(digest_urls)} downloads, {len(digest_urls) - len(missing)} already known")
+
+    failed = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(resolve_sha256, session, url, digest_urls[url], verify, cache.entry(url)): url
+                   for url in missing}
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                entry = future.result()
+            except Exception as exc:
+                failed[url] = exc
+                continue
+            expected = known.get(url) or cache.get(url)
+            if expected and expected != entry["sha256"]:
+                failed[url] = ValueError(f"sha256 {entry['sha256']} does not match the known checksum {expected}")
+                continue
+            cache.set(url, entry)
+            print(f"{url}: {entry['sha256']}")
+
+    if failed:
+        for url, exc in failed.items():
+            print(f"FAILED {url}: {exc}", file=sys.stderr)
+        print(f"\n{len(failed)} downloads failed, {MAIN_YML} was not changed. "
+              "Run the script again to retry them, completed downloads are cached.", file=sys.stderr)
         return 1
-    download_hash(argv)
+
+    maps = build_maps(jobs, {**{url: entry["sha256"] for url, entry in cache.entries.items()}, **known})
+    if kube_versions:
+        for key, archs in maps.items():
+            data[key] = {arch: merge_versions(data.get(key, {}).get(arch), versions) for arch, versions in archs.items()}
+    else:
+        data.update(maps)
+    write_checksums(data)
     return 0
 
 
+def main(argv=None):
+    names = [component.name for component in COMPONENTS]
+    parser = argparse.ArgumentParser(description=f"Update the *_checksums maps of {MAIN_YML}")
+    parser.add_argument("kube_versions", nargs="*", metavar="k8s_version",
+                        help="only add these Kubernetes versions to the kubelet/kubectl/kubeadm checksums")
+    parser.add_argument("--only", nargs="+", choices=names, metavar="COMPONENT",
+                        help=f"only regenerate these maps, one of: {', '.join(names)}")
+    parser.add_argument("--workers", type=int, default=8, help="number of parallel downloads (default: %(default)s)")
+    parser.add_argument("--cache", default=CACHE_FILE,
+                        help="digest cache file, also set by KUBESPRAY_DIGEST_CACHE (default: %(default)s)")
+    parser.add_argument("--hash-downloads", dest="digest_files", action="store_false",
+                        help="always download and hash the files instead of reading published digest files")
+    parser.add_argument("--verify", action="store_true",
+                        help="download every file again and check it against its published digest, "
+                             "checksums.yml and the cache")
+    parser.add_argument("--revalidate", action="store_true",
+                        help="check checksums.yml and the cache against upstream with HEAD requests: only the "
+                             "files whose ETag or Last-Modified changed are fetched again and must still match")
+    args = parser.parse_args(argv)
+
+    if args.kube_versions:
+        selected = [component for component in COMPONENTS if component.versions == KUBERNETES]
+    else:
+        selected = [component for component in COMPONENTS if not args.only or component.name in args.only]
+
+    return download_hash(selected, kube_versions=args.kube_versions, workers=args.workers,
+                         digest_files=args.digest_files, verify=args.verify, revalidate=args.revalidate,
+                         cache_file=args.cache)
+
+
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# Resolve the checksums and download URLs used by a cluster into a small
+# vars file, so Ansible does not have to template lookups into the full
+# *_checksums tables of roles/kubespray-defaults/defaults/main/checksums.yml
+# on every host.
+#
+#   ./generate_download_vars.py -i ../inventory/mycluster \
+#       -o ../inventory/mycluster/group_vars/all/download_vars.yml
+#
+# The output holds the *_checksums maps pruned to the selected
+# architectures and the versions configured in the inventory. For a single
+# architecture every *_checksum and *_download_url is also written as a
+# literal value. Run it again whenever versions or architectures change.
+
+import argparse
+import glob
+import os
+import re
+import sys
+
+import yaml
+from ansible.errors import AnsibleError
+from ansible.parsing.dataloader import DataLoader
+from ansible.template import Templar
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULTS_DIR = os.path.join(REPO_ROOT, "roles", "kubespray-defaults", "defaults", "main")
+DOWNLOAD_YML = os.path.join(DEFAULTS_DIR, "download.yml")
+
+# facts the download variables depend on, per architecture
+ARCH_FACTS = {
+    "amd64": {"ansible_architecture": "x86_64"},
+    "arm64": {"ansible_architecture": "aarch64"},
+    "arm": {"ansible_architecture": "armv7l"},
+    "ppc64le": {"ansible_architecture": "ppc64le"},
+}
+
+CHECKSUM_RE = re.compile(r"^\{\{\s*(?P<map>\w+_checksums)(?P<keys>(?:\[\w+\])+)\s*\}\}$")
+
+
+def load_vars(paths):
+    variables = {}
+    for path in paths:
+        with open(path) as f:
+            variables.update(yaml.safe_load(f) or {})
+    return variables
+
+
+def inventory_var_files(inventory):
+    if os.path.isfile(inventory):
+        inventory = os.path.dirname(inventory)
+    files = []
+    # lowest precedence first, as Ansible merges group_vars for all then k8s_cluster
+    for group in ("all", "k8s_cluster"):
+        base = os.path.join(inventory, "group_vars", group)
+        files += [f for f in (f"{base}.yml", f"{base}.yaml") if os.path.isfile(f)]
+        files += sorted(glob.glob(os.path.join(base, "*.yml")) + glob.glob(os.path.join(base, "*.yaml")))
+    return files
+
+
+def parse_extra_vars(values):
+    extra = {}
+    for value in values or []:
+        if value.startswith("@"):
+            extra.update(load_vars([value[1:]]))
+        else:
+            key, _, val = value.partition("=")
+            extra[key] = yaml.safe_load(val)
+    return extra
+
+
+def download_variables():
+    """Return ({checksum var: (map, [key vars])}, [download url vars]) declared in download.yml."""
+    defaults = load_vars([DOWNLOAD_YML])
+    checksums = {}
+    for name, value in defaults.items():
+        match = CHECKSUM_RE.match(str(value))
+        if name.endswith("_checksum") and match:
+            checksums[name] = (match.group("map"), re.findall(r"\[(\w+)\]", match.group("keys")))
+    urls = [name for name in defaults if name.endswith("_download_url")]
+    return checksums, urls
+
+
+def arch_templar(arch, base_vars, extra_vars):
+    """Return a Templar resolving variables as they are on a node of the given architecture."""
+    variables = dict(base_vars, host_architecture=arch, image_arch=arch, ansible_system="Linux",
+                     host_os="linux", **ARCH_FACTS[arch])
+    variables.update(extra_vars)
+    return Templar(loader=DataLoader(), variables=variables)
+
+
+def resolve(arch, base_vars, extra_vars, checksums, urls):
+    templar = arch_templar(arch, base_vars, extra_vars)
+
+    resolved, pruned, skipped = {}, {}, []
+    for name, (map_name, key_vars) in checksums.items():
+        try:
+            # keep the key types (e.g. gvisor versions are integers) so the
+            # lookups in download.yml still match the pruned maps
+            keys = [templar.template("{{ %s }}" % key) for key in key_vars]
+            value = templar.template("{{ %s }}" % name)
+        except AnsibleError:
+            skipped.append(name)
+            continue
+        resolved[name] = value
+        node = pruned.setdefault(map_name, {})
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+        node[keys[-1]] = value
+    for name in urls:
+        try:
+            resolved[name] = templar.template("{{ %s }}" % name)
+        except AnsibleError:
+            skipped.append(name)
+    return resolved, pruned, skipped
+
+
+def merge(into, other):
+    for key, value in other.items():
+        if isinstance(value, dict):
+            merge(into.setdefault(key, {}), value)
+        else:
+            into[key] = value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a pruned, pre-resolved vars file of download checksums and URLs")
+    parser.add_argument("-i", "--inventory", help="inventory directory (or hosts file) whose group_vars select the versions")
+    parser.add_argument("-a", "--arch", action="append", choices=sorted(ARCH_FACTS),
+                        help="architecture of the cluster nodes, repeat for mixed clusters (default: amd64)")
+    parser.add_argument("-e", "--extra-vars", action="append", metavar="KEY=VALUE|@FILE",
+                        help="variables overriding the inventory, e.g. kube_version=v1.28.6")
+    parser.add_argument("-o", "--output", help="vars file to write (default: stdout)")
+    args = parser.parse_args(argv)
+
+    arches = args.arch or ["amd64"]
+    base_vars = load_vars(sorted(glob.glob(os.path.join(DEFAULTS_DIR, "*.yml"))))
+    if args.inventory:
+        base_vars.update(load_vars(inventory_var_files(args.inventory)))
+    extra_vars = parse_extra_vars(args.extra_vars)
+
+    checksums, urls = download_variables()
+    output, pruned = {}, {}
+    for arch in arches:
+        resolved, arch_pruned, skipped = resolve(arch, base_vars, extra_vars, checksums, urls)
+        merge(pruned, arch_pruned)
+        if len(arches) == 1:
+            output.update(resolved)
+        for name in skipped:
+            print(f"{arch}: skipped {name}, it does not resolve for this architecture", file=sys.stderr)
+
+    header = ("---\n"
+              "# Generated by scripts/generate_download_vars.py, do not edit.\n"
+              f"# Architectures: {', '.join(arches)}\n")
+    content = header + yaml.safe_dump(dict(pruned, **output), default_flow_style=False, sort_keys=False, width=4096)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(content)
+        print(f"Updated {args.output}", file=sys.stderr)
+    else:
+        sys.stdout.write(content)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,37 +2,138 @@ import gitlab
 import argparse
 import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, datetime, timezone
+from urllib.parse import quote
 
+import requests
 
-parser = argparse.ArgumentParser(
-    description='Cleanup old branches in a GitLab project')
-parser.add_argument('--api', default='https://gitlab.com/',
-    help='URL of GitLab API, defaults to gitlab.com')
-parser.add_argument('--age', type=int, default=30,
-    help='Delete branches older than this many days')
-parser.add_argument('--prefix', default='pr-',
-    help='Cleanup only branches with names matching this prefix')
-parser.add_argument('--dry-run', action='store_true',
-    help='Do not delete anything')
-parser.add_argument('project',
-    help='Path of the GitLab project')
-
-args = parser.parse_args()
-limit = datetime.now(timezone.utc) - timedelta(days=args.age)
-
-if os.getenv('GITLAB_API_TOKEN', '') == '':
-    print("Environment variable GITLAB_API_TOKEN is required.")
-    sys.exit(2)
-
-gl = gitlab.Gitlab(args.api, private_token=os.getenv('GITLAB_API_TOKEN'))
-gl.auth()
-
-p = gl.projects.get(args.project)
-for b in p.branches.list(all=True):
-    date = datetime.fromisoformat(b.commit['created_at'])
-    if date < limit and not b.protected and not b.default and b.name.startswith(args.prefix):
-        print("Deleting branch %s from %s ..." %
-            (b.name, date.date().isoformat()))
-        if not args.dry_run:
-            b.delete()
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, not %s' % value)
+    return number
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Cleanup old branches in a GitLab project')
+    parser.add_argument('--api', default='https://gitlab.com/',
+        help='URL of GitLab API, defaults to gitlab.com')
+    parser.add_argument('--age', type=int, default=30,
+        help='Delete branches older than this many days')
+    parser.add_argument('--prefix', default='pr-',
+        help='Cleanup only branches with names matching this prefix')
+    parser.add_argument('--workers', type=positive_int, default=8,
+        help='Branches deleted at the same time, defaults to 8')
+    parser.add_argument('--dry-run', action='store_true',
+        help='Do not delete anything')
+    parser.add_argument('project',
+        help='Path of the GitLab project')
+    return parser.parse_args(argv)
+
+
+class RateLimiter:
+    """Hold the workers back when the RateLimit headers say the quota is almost used.
+
+    python-gitlab already waits and retries on 429 responses, this avoids
+    getting them by pausing every worker until the quota is reset as soon
+    as fewer requests than workers are left.
+    """
+
+    def __init__(self, reserve):
+        self.reserve = reserve
+        self.resume_at = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def update(self, headers):
+        remaining = headers.get('RateLimit-Remaining')
+        reset = headers.get('RateLimit-Reset')
+        if remaining is None or reset is None or int(remaining) > self.reserve:
+            return
+        with self.lock:
+            now = time.time()
+            if float(reset) > max(self.resume_at, now):
+                self.throttled += float(reset) - max(self.resume_at, now)
+                self.resume_at = float(reset)
+
+    def wait(self):
+        delay = self.resume_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def old_branches(project, prefix, limit):
+    """Yield (name, date) of the branches to delete, reading the pages as they are consumed."""
+    # the search is done by GitLab, with ^ to only match the start of the names
+    for b in project.branches.list(iterator=True, per_page=100, search='^' + prefix):
+        date = datetime.fromisoformat(b.commit['created_at'])
+        if date < limit and not b.protected and not b.default and b.name.startswith(prefix):
+            yield b.name, date
+
+
+def delete_branches(gl, project, branches, workers, limiter):
+    """Delete the branches with a pool of workers; return the names that failed."""
+    failed = []
+
+    def delete(branch):
+        name, date = branch
+        limiter.wait()
+        print("Deleting branch %s from %s ..." % (name, date.date().isoformat()))
+        try:
+            response = gl.http_delete('/projects/%s/repository/branches/%s' % (project.id, quote(name, safe='')))
+        except gitlab.exceptions.GitlabError as ex:
+            print("Failed to delete branch %s: %s" % (name, ex))
+            failed.append(name)
+            return
+        limiter.update(response.headers)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(delete, branches))
+    return failed
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    limit = datetime.now(timezone.utc) - timedelta(days=args.age)
+
+    if os.getenv('GITLAB_API_TOKEN', '') == '':
+        print("Environment variable GITLAB_API_TOKEN is required.")
+        return 2
+
+    gl = gitlab.Gitlab(args.api, private_token=os.getenv('GITLAB_API_TOKEN'))
+    # one connection per worker instead of the default pool of 10
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.workers)
+    gl.session.mount('http://', adapter)
+    gl.session.mount('https://', adapter)
+    gl.auth()
+
+    p = gl.projects.get(args.project)
+
+    # deleting while paging would shift the next pages and skip branches,
+    # so the pages are read first, keeping only the names to delete
+    start = time.time()
+    branches = list(old_branches(p, args.prefix, limit))
+    listed = time.time() - start
+    print("Found %d branches to delete in %.1fs" % (len(branches), listed))
+    if args.dry_run:
+        for name, date in branches:
+            print("Deleting branch %s from %s ..." % (name, date.date().isoformat()))
+        return 0
+
+    limiter = RateLimiter(args.workers)
+    start = time.time()
+    failed = delete_branches(gl, p, branches, args.workers, limiter)
+    elapsed = time.time() - start
+    deleted = len(branches) - len(failed)
+    print("Deleted %d branches in %.1fs (%.1f/s), %d failed, throttled %.1fs" %
+        (deleted, elapsed, deleted / max(elapsed, 0.001), len(failed), limiter.throttled))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
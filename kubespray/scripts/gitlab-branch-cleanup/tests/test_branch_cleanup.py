@@ -0,0 +1,173 @@
+import io
+import json
+import os
+import re
+import sys
+import threading
+import time
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, unquote, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main  # noqa: E402
+
+OLD = "2020-02-17T10:00:00+00:00"
+NEW = "2999-01-01T10:00:00+00:00"
+
+
+class FakeGitLab(ThreadingHTTPServer):
+    """The part of the GitLab API used by the cleanup, serving one project."""
+
+    daemon_threads = True
+
+    def __init__(self, branches, delay=0.0, rate_limit=None):
+        super().__init__(("127.0.0.1", 0), FakeGitLabHandler)
+        self.branches = branches
+        self.delay = delay
+        # (remaining, seconds to reset) sent with the DELETE responses, one per response
+        self.rate_limit = list(rate_limit or [])
+        self.searches = []
+        self.pages = 0
+        self.deleted = []
+        self.lock = threading.Lock()
+        self.running = self.max_running = 0
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server_address[1]
+
+
+class FakeGitLabHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, status=200, headers=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        if url.path == "/api/v4/user":
+            return self.reply({"id": 1, "username": "ci"})
+        if url.path == "/api/v4/projects/kargo-ci%2Fkubespray":
+            return self.reply({"id": 42, "path_with_namespace": "kargo-ci/kubespray"})
+        if url.path == "/api/v4/projects/42/repository/branches":
+            server = self.server
+            server.searches.append(query.get("search"))
+            server.pages += 1
+            names = sorted(server.branches)
+            if query.get("search", "").startswith("^"):
+                names = [n for n in names if n.startswith(query["search"][1:])]
+            page, per_page = int(query.get("page", 1)), int(query.get("per_page", 20))
+            body = [dict(name=n, **server.branches[n]) for n in names[(page - 1) * per_page:page * per_page]]
+            headers = {"X-Page": str(page), "X-Per-Page": str(per_page), "X-Total": str(len(names))}
+            if page * per_page < len(names):
+                next_query = dict(query, page=page + 1)
+                next_url = "%sapi/v4/projects/42/repository/branches?%s" % (
+                    server.url, "&".join("%s=%s" % item for item in next_query.items()))
+                headers["Link"] = '<%s>; rel="next"' % next_url
+                headers["X-Next-Page"] = str(page + 1)
+            return self.reply(body, headers=headers)
+        self.reply({"message": "404 Not Found"}, 404)
+
+    def do_DELETE(self):
+        server = self.server
+        match = re.match(r"^/api/v4/projects/42/repository/branches/([^/?]+)$", self.path)
+        if not match:
+            return self.reply({"message": "404 Not Found"}, 404)
+        with server.lock:
+            server.running += 1
+            server.max_running = max(server.max_running, server.running)
+        time.sleep(server.delay)
+        with server.lock:
+            server.running -= 1
+            server.deleted.append((time.time(), unquote(match.group(1))))
+            rate_limit = server.rate_limit.pop(0) if server.rate_limit else (1000, 60)
+        self.reply(None, 204, {"RateLimit-Remaining": str(rate_limit[0]),
+                               "RateLimit-Reset": str(int(time.time() + rate_limit[1]) if rate_limit[1] else 0)})
+
+
+def branch(created_at=OLD, protected=False, default=False):
+    return {"commit": {"created_at": created_at}, "protected": protected, "default": default}
+
+
+class TestBranchCleanup(unittest.TestCase):
+
+    def run_cleanup(self, server, *argv):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            out = io.StringIO()
+            with mock.patch.dict(os.environ, {"GITLAB_API_TOKEN": "token"}), redirect_stdout(out):
+                code = main.main(["--api", server.url] + list(argv) + ["kargo-ci/kubespray"])
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        return code, out.getvalue()
+
+    def test_deletes_old_prefixed_branches(self):
+        branches = dict(("pr-%04d" % i, branch()) for i in range(250))
+        branches.update({
+            "pr-new": branch(NEW),
+            "pr-protected": branch(protected=True),
+            "pr-1-feature/x": branch(),
+            "master": branch(default=True),
+            "release-2.20": branch(),
+        })
+        server = FakeGitLab(branches)
+        code, out = self.run_cleanup(server)
+        self.assertEqual(code, 0)
+        self.assertEqual(sorted(name for _, name in server.deleted),
+                         sorted(["pr-%04d" % i for i in range(250)] + ["pr-1-feature/x"]))
+        # the prefix is searched by GitLab, which only returns the 253 pr- branches in 3 pages
+        self.assertEqual(server.searches, ["^pr-"] * 3)
+        self.assertIn("Found 251 branches to delete", out)
+        self.assertRegex(out, r"Deleted 251 branches in [0-9.]+s \([0-9.]+/s\), 0 failed, throttled 0.0s")
+
+    def test_bounded_workers(self):
+        server = FakeGitLab(dict(("pr-%d" % i, branch()) for i in range(24)), delay=0.05)
+        start = time.time()
+        code, _ = self.run_cleanup(server, "--workers", "4")
+        self.assertEqual(code, 0)
+        self.assertEqual(len(server.deleted), 24)
+        self.assertEqual(server.max_running, 4)
+        self.assertLess(time.time() - start, 24 * 0.05)
+
+    def test_rate_limit(self):
+        # the quota is almost used after the first deletion and reset 2s later
+        server = FakeGitLab(dict(("pr-%d" % i, branch()) for i in range(4)), rate_limit=[(1, 2)])
+        code, out = self.run_cleanup(server, "--workers", "1")
+        self.assertEqual(code, 0)
+        times = [t for t, _ in server.deleted]
+        self.assertGreaterEqual(times[1] - times[0], 0.9)
+        self.assertLess(times[3] - times[1], 0.5)
+        self.assertNotRegex(out, r"throttled 0.0s")
+
+    def test_dry_run(self):
+        server = FakeGitLab({"pr-1": branch(), "pr-2": branch(NEW)})
+        code, out = self.run_cleanup(server, "--dry-run")
+        self.assertEqual(code, 0)
+        self.assertEqual(server.deleted, [])
+        self.assertIn("Deleting branch pr-1 from 2020-02-17 ...", out)
+        self.assertNotIn("pr-2", out)
+
+    def test_at_least_one_worker(self):
+        self.assertEqual(main.parse_args(["--workers", "1", "kargo-ci/kubespray"]).workers, 1)
+        with redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            main.parse_args(["--workers", "0", "kargo-ci/kubespray"])
+
+
+if __name__ == "__main__":
+    unittest.main()
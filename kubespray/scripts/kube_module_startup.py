@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# Measure the cold-start time of the kube module.
+#
+# Every run starts a fresh interpreter that executes plugins/modules/kube.py
+# directly (as AnsiballZ does on the target) with state=exists and a kubectl
+# that exits immediately, so the time measured is interpreter start-up,
+# imports and argument parsing. The same is measured for a bare
+# `from ansible.module_utils.basic import AnsibleModule` as a baseline.
+#
+# Requires ansible-core in the python used to run this script:
+#   ./kube_module_startup.py --runs 50
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULE = os.path.join(REPO_ROOT, "plugins", "modules", "kube.py")
+
+
+def measure(cmd, runs, env):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        samples.append(time.perf_counter() - start)
+        if proc.returncode != 0:
+            sys.exit(f"{' '.join(cmd)} failed (rc={proc.returncode}):\n{proc.stdout.decode()}{proc.stderr.decode()}")
+    return samples
+
+
+def report(name, samples):
+    print(f"{name:<12} median {statistics.median(samples) * 1000:7.1f} ms"
+          f"  min {min(samples) * 1000:7.1f} ms  max {max(samples) * 1000:7.1f} ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the cold-start time of the kube module")
+    parser.add_argument("--runs", type=int, default=20, help="number of runs per measurement")
+    parser.add_argument("--python", default=sys.executable, help="interpreter used to run the module")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # expose the repository as the kubernetes_sigs.kubespray collection so
+        # the module finds its module_utils without an installed collection
+        namespace = os.path.join(tmp, "ansible_collections", "kubernetes_sigs")
+        os.makedirs(namespace)
+        os.symlink(REPO_ROOT, os.path.join(namespace, "kubespray"))
+
+        module_args = os.path.join(tmp, "args.json")
+        with open(module_args, "w") as f:
+            json.dump({"ANSIBLE_MODULE_ARGS": {"state": "exists", "resource": "pods", "kubectl": "true"}}, f)
+
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [tmp, os.environ.get("PYTHONPATH")])))
+        # warm the filesystem cache so the first run is not an outlier
+        measure([args.python, MODULE, module_args], 1, env)
+
+        report("baseline", measure([args.python, "-c", "from ansible.module_utils.basic import AnsibleModule"],
+                                   args.runs, env))
+        report("kube module", measure([args.python, MODULE, module_args], args.runs, env))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
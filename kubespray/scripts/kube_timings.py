@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+# Report the slowest kube module operations per role from a playbook log.
+#
+# Enable the kube module instrumentation for the play, e.g.
+#   module_defaults:
+#     kube:
+#       timings: true
+# and run the playbook with -v so task results are printed, keeping the
+# profile_tasks callback enabled in ansible.cfg:
+#   ansible-playbook -v -i inventory/mycluster/hosts.yaml cluster.yml | tee run.log
+#   ./kube_timings.py run.log
+#
+# For every task the report shows the wall time measured by profile_tasks,
+# the time spent in kubectl and the difference between the two, which is
+# the time spent in Ansible itself (connection, module transfer, templating).
+
+import argparse
+import json
+import re
+import sys
+from collections import defaultdict
+
+TASK_RE = re.compile(r"^TASK \[(?P<task>.*)\] \*+$", re.MULTILINE)
+# profile_tasks prints the duration of the previous task after each header:
+# Thursday 19 October 2026  10:00:00 +0000 (0:00:01.234)       0:01:02.345 ****
+DURATION_RE = re.compile(r"^\w+ \d+ \w+ \d+\s+[\d:]+ [+-]\d+ \((?P<h>\d+):(?P<m>\d+):(?P<s>[\d.]+)\)", re.MULTILINE)
+RESULT_RE = re.compile(r"^(?:ok|changed|failed|fatal): \[(?P<host>[^\]]+)\].*?=> (?=\{)", re.MULTILINE)
+
+
+def role_of(task):
+    role, sep, _ = task.partition(" : ")
+    return role if sep else "(playbook)"
+
+
+def parse_log(text):
+    """Return {task: {"wall": seconds, "hosts": {host: [timing, ...]}}}."""
+    tasks = defaultdict(lambda: {"wall": 0.0, "hosts": defaultdict(list)})
+    decoder = json.JSONDecoder()
+
+    events = [(m.start(), "task", m) for m in TASK_RE.finditer(text)]
+    events += [(m.start(), "duration", m) for m in DURATION_RE.finditer(text)]
+    events += [(m.start(), "result", m) for m in RESULT_RE.finditer(text)]
+    events.sort(key=lambda e: e[0])
+
+    previous = current = None
+    for _, kind, match in events:
+        if kind == "task":
+            previous, current = current, match.group("task")
+        elif kind == "duration":
+            # the first duration after a header belongs to the task before it
+            if previous is not None:
+                tasks[previous]["wall"] += (int(match.group("h")) * 3600 + int(match.group("m")) * 60
+                                            + float(match.group("s")))
+                previous = None
+        elif current is not None:
+            try:
+                result, _ = decoder.raw_decode(text, match.end())
+            except ValueError:
+                continue
+            if isinstance(result, dict) and result.get("timings"):
+                tasks[current]["hosts"][match.group("host")].extend(result["timings"])
+    return tasks
+
+
+def build_report(tasks):
+    roles = defaultdict(list)
+    for task, data in tasks.items():
+        if not data["hosts"]:
+            continue
+        per_host = {host: sum(t["seconds"] for t in timings) for host, timings in data["hosts"].items()}
+        calls = [t for timings in data["hosts"].values() for t in timings]
+        kubectl = max(per_host.values())
+        roles[role_of(task)].append({
+            "task": task,
+            "wall": round(data["wall"], 3),
+            "kubectl": round(kubectl, 3),
+            "overhead": round(max(data["wall"] - kubectl, 0.0), 3) if data["wall"] else None,
+            "calls": len(calls),
+            "stdout_bytes": sum(t["stdout_bytes"] for t in calls),
+            "slowest": max(calls, key=lambda t: t["seconds"]),
+        })
+    for entries in roles.values():
+        entries.sort(key=lambda e: e["kubectl"], reverse=True)
+    return dict(sorted(roles.items(), key=lambda r: sum(e["kubectl"] for e in r[1]), reverse=True))
+
+
+def print_report(report, top):
+    for role, entries in report.items():
+        print(f"== {role} (kubectl {sum(e['kubectl'] for e in entries):.2f}s)")
+        print(f"  {'wall':>8} {'kubectl':>8} {'ansible':>8} {'calls':>5}  task")
+        for entry in entries[:top]:
+            wall = f"{entry['wall']:.2f}" if entry["wall"] else "-"
+            overhead = f"{entry['overhead']:.2f}" if entry["overhead"] is not None else "-"
+            print(f"  {wall:>8} {entry['kubectl']:>8.2f} {overhead:>8} {entry['calls']:>5}  {entry['task']}")
+            slowest = entry["slowest"]
+            print(f"  {'':>8} {slowest['seconds']:>8.2f} {'':>8} {'':>5}    slowest: {slowest['cmd']} (rc={slowest['rc']})")
+        print()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report the slowest kube module operations per role")
+    parser.add_argument("log", nargs="?", type=argparse.FileType("r"), default=sys.stdin,
+                        help="output of ansible-playbook -v with kube timings enabled (default: stdin)")
+    parser.add_argument("--top", type=int, default=10, help="number of tasks shown per role")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    report = build_report(parse_log(args.log.read()))
+    if not report:
+        print("no kube timings found, was the module run with timings: true and ansible-playbook -v?",
+              file=sys.stderr)
+        return 1
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report, args.top)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
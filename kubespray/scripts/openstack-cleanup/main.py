@@ -3,28 +3,193 @@ import argparse
 import openstack
 import logging
 import datetime
+import sys
+import threading
 import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 PAUSE_SECONDS = 5
+ROUTER_INTERFACE_OWNERS = (
+    'network:router_interface',
+    'network:router_interface_distributed',
+    'network:ha_router_replicated_interface',
+)
 
-log = logging.getLogger('openstack-cleanup')
-
-parser = argparse.ArgumentParser(description='Cleanup OpenStack resources')
+# the interface of a router on a subnet, through one of its ports
+Attachment = namedtuple('Attachment', ['subnet_id', 'router_id', 'port_id'])
 
-parser.add_argument('-v', '--verbose', action='store_true',
-                    help='Increase verbosity')
-parser.add_argument('--hours', type=int, default=4,
-                    help='Age (in hours) of VMs to cleanup (default: 4h)')
-parser.add_argument('--dry-run', action='store_true',
-                    help='Do not delete anything')
-
-args = parser.parse_args()
+log = logging.getLogger('openstack-cleanup')
 
-oldest_allowed = datetime.datetime.now() - datetime.timedelta(hours=args.hours)
 
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, not %s' % value)
+    return number
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Cleanup OpenStack resources')
+
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Increase verbosity')
+    parser.add_argument('--hours', type=int, default=4,
+                        help='Age (in hours) of VMs to cleanup (default: 4h)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Do not delete anything')
+    parser.add_argument('--workers', type=positive_int, default=16,
+                        help='Deletions running at the same time (default: 16)')
+    parser.add_argument('--retries', type=positive_int, default=5,
+                        help='Attempts for every deletion (default: 5)')
+    parser.add_argument('--retry-delay', type=float, default=2,
+                        help='Seconds before the first retry, doubled at every '
+                             'attempt (default: 2)')
+
+    return parser.parse_args(argv)
+
+
+class Cleanup:
+    """Delete the old resources of a tenant, one dependency layer at a time.
+
+    Everything is listed once up front. Each layer only holds resources that
+    nothing in a later layer depends on, and its deletions run concurrently on
+    a bounded pool. A deletion that still conflicts, because a resource it
+    depends on is being removed asynchronously, is retried with an exponential
+    backoff.
+    """
+
+    def __init__(self, conn, oldest_allowed, dry_run=False, workers=16,
+                 retries=5, retry_delay=2):
+        self.conn = conn
+        self.oldest_allowed = oldest_allowed
+        self.dry_run = dry_run
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        self.deleted = 0
+        self.failed = []
+
+    def is_old(self, item):
+        if item.name == "default":  # skip default security group
+            return False
+        created_at = datetime.datetime.strptime(item.created_at, DATE_FORMAT)
+        return created_at < self.oldest_allowed
+
+    def list_resources(self):
+        compute, network = self.conn.compute, self.conn.network
+        listings = {
+            'servers': compute.servers,
+            'ips': network.ips,
+            'ports': network.ports,
+            'security_groups': network.security_groups,
+            'subnets': network.subnets,
+            'networks': network.networks,
+        }
+        with ThreadPoolExecutor(max_workers=len(listings)) as executor:
+            futures = dict((kind, executor.submit(lambda fn: list(fn()), fn))
+                           for kind, fn in listings.items())
+        return dict((kind, future.result()) for kind, future in futures.items())
+
+    @staticmethod
+    def router_interfaces(ports):
+        """Index the router interfaces of the ports by subnet id."""
+        index = defaultdict(list)
+        for port in ports:
+            if port.device_owner in ROUTER_INTERFACE_OWNERS:
+                for fixed_ip in port.fixed_ips or []:
+                    index[fixed_ip['subnet_id']].append(
+                        Attachment(fixed_ip['subnet_id'], port.device_id, port.id))
+        return index
+
+    def detach(self, attachment):
+        # positional, the keyword is subnet_id or subnet depending on the SDK version
+        self.conn.network.remove_interface_from_router(
+            attachment.router_id, attachment.subnet_id)
+
+    def layers(self, resources):
+        """Return [(title, delete function, items)] in deletion order."""
+        network = self.conn.network
+        old = dict((kind, [item for item in items if self.is_old(item)])
+                   for kind, items in resources.items())
+        # only the subnets that will be deleted are removed from their
+        # routers, which deletes the interface ports with them; a router
+        # interface port can't be deleted directly
+        index = self.router_interfaces(resources['ports'])
+        attachments = [a for sn in old['subnets'] for a in index.get(sn.id, [])]
+        return [
+            ('Servers', self.conn.compute.delete_server, old['servers']),
+            ('Floating IPs', network.delete_ip, old['ips']),
+            ('Router interfaces', self.detach, attachments),
+            ('Ports', network.delete_port,
+             [p for p in old['ports'] if p.device_owner not in ROUTER_INTERFACE_OWNERS]),
+            ('Security groups', network.delete_security_group,
+             old['security_groups']),
+            ('Subnets', network.delete_subnet, old['subnets']),
+            ('Networks', network.delete_network,
+             [n for n in old['networks'] if not n.is_router_external]),
+        ]
+
+    def call(self, fn, *fargs, **fkwargs):
+        """Call fn, retrying while it conflicts or fails; return the error of the last attempt."""
+        for attempt in range(self.retries):
+            try:
+                fn(*fargs, **fkwargs)
+                return None
+            except openstack.exceptions.SDKException as ex:
+                error = ex
+                log.debug('Attempt %d of %s failed: %s', attempt + 1, fn.__name__, ex)
+                if attempt + 1 < self.retries:
+                    time.sleep(self.retry_delay * 2 ** attempt)
+        return error
+
+    @staticmethod
+    def describe(item):
+        if isinstance(item, Attachment):
+            return 'subnet %s from router %s (port %s)' % item
+        return '%(name)s (%(id)s)' % item
+
+    def delete(self, fn, item):
+        error = self.call(fn, item)
+        with self.lock:
+            if error is None:
+                self.deleted += 1
+            else:
+                self.failed.append((item, error))
+                print('Failed to delete %s: %s' % (self.describe(item), error))
+
+    def delete_layer(self, fn, items):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(lambda item: self.delete(fn, item), items))
+
+    def print_plan(self, layers):
+        print('Deletion plan:')
+        for step, (title, _, items) in enumerate(layers, 1):
+            print('%d. %s: %d' % (step, title, len(items)))
+            for item in items:
+                print('   Will delete %s' % self.describe(item))
+
+    def run(self):
+        start = time.time()
+        layers = self.layers(self.list_resources())
+        self.print_plan(layers)
+        if self.dry_run:
+            return True
+        for title, fn, items in layers:
+            print('%s...' % title)
+            self.delete_layer(fn, items)
+        print('Deleted %d resources in %.1fs, %d failed' % (
+            self.deleted, time.time() - start, len(self.failed)))
+        return not self.failed
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    oldest_allowed = datetime.datetime.now() - datetime.timedelta(hours=args.hours)
 
-def main():
     if args.dry_run:
         print('Running in dry-run mode')
     else:
@@ -32,67 +197,12 @@ def main():
         time.sleep(PAUSE_SECONDS)
 
     conn = openstack.connect()
-
-    print('Servers...')
-    map_if_old(conn.compute.delete_server,
-               conn.compute.servers())
-
-    print('Security groups...')
-    map_if_old(conn.network.delete_security_group,
-               conn.network.security_groups())
-
-    print('Ports...')
-    try:
-        map_if_old(conn.network.delete_port,
-                   conn.network.ports())
-    except openstack.exceptions.ConflictException as ex:
-        # Need to find subnet-id which should be removed from a router
-        for sn in conn.network.subnets():
-            try:
-                fn_if_old(conn.network.delete_subnet, sn)
-            except openstack.exceptions.ConflictException:
-                for r in conn.network.routers():
-                    print("Deleting subnet %s from router %s", sn, r)
-                    try:
-                        conn.network.remove_interface_from_router(
-                            r, subnet_id=sn.id)
-                    except Exception as ex:
-                        print("Failed to delete subnet from router as %s", ex)
-
-        for ip in conn.network.ips():
-            fn_if_old(conn.network.delete_ip, ip)
-                
-        # After removing unnecessary subnet from router, retry to delete ports
-        map_if_old(conn.network.delete_port,
-                   conn.network.ports())
-
-    print('Subnets...')
-    map_if_old(conn.network.delete_subnet,
-               conn.network.subnets())
-
-    print('Networks...')
-    for n in conn.network.networks():
-        if not n.is_router_external:
-            fn_if_old(conn.network.delete_network, n)
-
-
-# runs the given fn to all elements of the that are older than allowed
-def map_if_old(fn, items):
-    for item in items:
-        fn_if_old(fn, item)
-
-
-# run the given fn function only if the passed item is older than allowed
-def fn_if_old(fn, item):
-    created_at = datetime.datetime.strptime(item.created_at, DATE_FORMAT)
-    if item.name == "default":  # skip default security group
-        return
-    if created_at < oldest_allowed:
-        print('Will delete %(name)s (%(id)s)' % item)
-        if not args.dry_run:
-            fn(item)
+    cleanup = Cleanup(conn, oldest_allowed, dry_run=args.dry_run,
+                      workers=args.workers, retries=args.retries,
+                      retry_delay=args.retry_delay)
+    return 0 if cleanup.run() else 1
 
 
 if __name__ == '__main__':
     # execute only if run as a script
-    main()
+    sys.exit(main())
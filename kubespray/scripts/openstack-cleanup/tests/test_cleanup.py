@@ -0,0 +1,185 @@
+import datetime
+import io
+import os
+import sys
+import threading
+import time
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+
+import openstack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main  # noqa: E402
+
+NOW = datetime.datetime(2024, 1, 1, 12)
+OLD = "2024-01-01T00:00:00Z"
+NEW = "2024-01-01T11:59:00Z"
+
+
+class Resource(dict):
+    """Stands for an openstacksdk resource: attributes that can also be formatted as a mapping."""
+
+    def __getattr__(self, name):
+        return self.get(name)
+
+
+def resource(id, created_at=OLD, **attrs):
+    return Resource(dict(id=id, name=attrs.pop("name", id), created_at=created_at, **attrs))
+
+
+class FakeService(object):
+    """A compute or network proxy deleting from a shared set of resources, with a delay per call."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getattr__(self, name):
+        if name.startswith("delete_"):
+            return lambda item: self.conn.delete(name, item)
+        if name in self.conn.resources:
+            return lambda: iter(self.conn.listed(name))
+        raise AttributeError(name)
+
+    def remove_interface_from_router(self, router_id, subnet_id):
+        self.conn.calls.append(("remove_interface_from_router", router_id, subnet_id))
+
+
+class FakeConnection(object):
+
+    def __init__(self, delay=0.0, **resources):
+        self.resources = dict((kind, resources.get(kind, [])) for kind in
+                              ("servers", "ips", "ports", "security_groups", "subnets", "networks"))
+        self.compute = self.network = FakeService(self)
+        self.delay = delay
+        self.calls = []
+        self.listings = []
+        self.lock = threading.Lock()
+        self.running = self.max_running = 0
+
+    def listed(self, kind):
+        self.listings.append(kind)
+        return self.resources[kind]
+
+    def delete(self, name, item):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(self.delay)
+            self.calls.append((name, item.id))
+            if name == "delete_port" and item.device_owner == "network:router_interface":
+                raise openstack.exceptions.ConflictException("port %s is a router interface" % item.id)
+            if item.get("fail"):
+                item["fail"] -= 1
+                raise openstack.exceptions.ConflictException("%s is still in use" % item.id)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+class TestCleanup(unittest.TestCase):
+
+    def cleanup(self, conn, **kwargs):
+        kwargs.setdefault("retry_delay", 0)
+        cleanup = main.Cleanup(conn, NOW - datetime.timedelta(hours=4), **kwargs)
+        with redirect_stdout(io.StringIO()) as out:
+            ok = cleanup.run()
+        return cleanup, ok, out.getvalue()
+
+    def test_layers_in_dependency_order(self):
+        conn = FakeConnection(
+            servers=[resource("vm1"), resource("vm2", NEW)],
+            ips=[resource("ip1")],
+            ports=[resource("port1")],
+            security_groups=[resource("sg1"), resource("sg-default", name="default")],
+            subnets=[resource("subnet1")],
+            networks=[resource("net1", is_router_external=False), resource("public", is_router_external=True)],
+        )
+        cleanup, ok, _ = self.cleanup(conn)
+        self.assertTrue(ok)
+        self.assertEqual(conn.calls, [
+            ("delete_server", "vm1"), ("delete_ip", "ip1"), ("delete_port", "port1"),
+            ("delete_security_group", "sg1"), ("delete_subnet", "subnet1"), ("delete_network", "net1"),
+        ])
+        self.assertEqual(cleanup.deleted, 6)
+        # every kind is listed once
+        self.assertEqual(sorted(conn.listings), sorted(conn.resources))
+
+    def test_bounded_concurrency(self):
+        conn = FakeConnection(delay=0.05, servers=[resource("vm%d" % i) for i in range(40)])
+        start = time.time()
+        cleanup, ok, _ = self.cleanup(conn, workers=8)
+        self.assertTrue(ok)
+        self.assertEqual(cleanup.deleted, 40)
+        self.assertEqual(conn.max_running, 8)
+        self.assertLess(time.time() - start, 40 * 0.05 / 2)
+
+    def test_retries(self):
+        conn = FakeConnection(security_groups=[resource("sg1", fail=2), resource("sg2", fail=5)])
+        cleanup, ok, out = self.cleanup(conn, retries=3)
+        self.assertFalse(ok)
+        self.assertEqual(conn.calls.count(("delete_security_group", "sg1")), 3)
+        self.assertEqual(conn.calls.count(("delete_security_group", "sg2")), 3)
+        self.assertEqual([item.id for item, _ in cleanup.failed], ["sg2"])
+        self.assertIn("Deleted 1 resources", out)
+
+    def test_router_interfaces(self):
+        def interface(id, router_id, subnet_id, created_at=OLD):
+            return resource(id, created_at, device_owner="network:router_interface", device_id=router_id,
+                            fixed_ips=[{"subnet_id": subnet_id, "ip_address": "10.0.0.1"}])
+
+        conn = FakeConnection(
+            ports=[interface("if1", "router1", "subnet1"), interface("if2", "router2", "subnet2"),
+                   interface("if3", "router1", "subnet3", NEW), resource("port1")],
+            subnets=[resource("subnet1"), resource("subnet2"), resource("subnet3", NEW), resource("subnet4")],
+        )
+        cleanup, ok, _ = self.cleanup(conn)
+        self.assertTrue(ok)
+        # only the real attachments of the deleted subnets are removed, before
+        # any port; their interface ports go away with them
+        self.assertEqual(sorted(conn.calls[:2]), [
+            ("remove_interface_from_router", "router1", "subnet1"),
+            ("remove_interface_from_router", "router2", "subnet2"),
+        ])
+        self.assertEqual([call for call in conn.calls[2:] if call[0] != "delete_subnet"], [("delete_port", "port1")])
+        self.assertEqual(conn.listings.count("ports"), 1)
+
+    def test_router_interfaces_index(self):
+        ports = [
+            resource("if1", device_owner="network:router_interface", device_id="router1",
+                     fixed_ips=[{"subnet_id": "subnet1"}, {"subnet_id": "subnet2"}]),
+            resource("if2", device_owner="network:router_interface_distributed", device_id="router2",
+                     fixed_ips=[{"subnet_id": "subnet1"}]),
+            resource("gw", device_owner="network:router_gateway", device_id="router1",
+                     fixed_ips=[{"subnet_id": "public"}]),
+            resource("vm", device_owner="compute:nova", fixed_ips=[{"subnet_id": "subnet1"}]),
+        ]
+        index = main.Cleanup.router_interfaces(ports)
+        self.assertEqual(dict(index), {
+            "subnet1": [main.Attachment("subnet1", "router1", "if1"), main.Attachment("subnet1", "router2", "if2")],
+            "subnet2": [main.Attachment("subnet2", "router1", "if1")],
+        })
+
+    def test_dry_run(self):
+        conn = FakeConnection(servers=[resource("vm1")], networks=[resource("net1", is_router_external=False)])
+        conn.resources["ports"] = [resource("if1", device_owner="network:router_interface", device_id="router1",
+                                            fixed_ips=[{"subnet_id": "subnet1"}])]
+        conn.resources["subnets"] = [resource("subnet1")]
+        _, ok, out = self.cleanup(conn, dry_run=True)
+        self.assertTrue(ok)
+        self.assertEqual(conn.calls, [])
+        self.assertIn("1. Servers: 1\n   Will delete vm1 (vm1)\n", out)
+        self.assertIn("3. Router interfaces: 1\n   Will delete subnet subnet1 from router router1 (port if1)\n", out)
+        self.assertIn("4. Ports: 0\n", out)
+        self.assertIn("7. Networks: 1\n   Will delete net1 (net1)\n", out)
+
+    def test_at_least_one_attempt(self):
+        self.assertEqual(main.parse_args(["--retries", "1"]).retries, 1)
+        for option in ("--retries", "--workers"):
+            with redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+                main.parse_args([option, "0"])
+
+
+if __name__ == "__main__":
+    unittest.main()
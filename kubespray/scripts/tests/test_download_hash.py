@@ -0,0 +1,223 @@
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import download_hash  # noqa: E402
+
+CONTENT = os.urandom(3 * 1024 * 1024 + 17)
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+WRONG = "deadbeef" * 8
+
+
+class FakeUpstream(ThreadingHTTPServer):
+    """Serves files with an ETag and a Last-Modified, counting the requests made for each path."""
+
+    daemon_threads = True
+
+    def __init__(self, files):
+        super().__init__(("127.0.0.1", 0), FakeUpstreamHandler)
+        # path -> (content, etag)
+        self.files = files
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self.server_address[1], path)
+
+    def count(self, method, path):
+        return self.requests.count((method, path))
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, send_body):
+        with self.server.lock:
+            self.server.requests.append((self.command, self.path))
+        if self.path not in self.server.files:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        content, etag = self.server.files[self.path]
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", "Mon, 01 Jan 2024 00:00:00 GMT")
+        self.end_headers()
+        if send_body:
+            self.wfile.write(content)
+
+    def do_GET(self):
+        self.reply(True)
+
+    def do_HEAD(self):
+        self.reply(False)
+
+
+class UpstreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = FakeUpstream({
+            "/file": (CONTENT, '"v1"'),
+            "/file.sha256": (("%s  file\n" % SHA256).encode(), '"d1"'),
+            "/wrong": (CONTENT, '"v1"'),
+            "/wrong.sha256": (WRONG.encode(), '"d2"'),
+            "/garbage.sha256": (b"<html>not found</html>", '"d3"'),
+        })
+        threading.Thread(target=self.upstream.serve_forever, daemon=True).start()
+        self.addCleanup(self.upstream.server_close)
+        self.addCleanup(self.upstream.shutdown)
+        self.session = download_hash.new_session(4)
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+
+class TestResolve(UpstreamTestCase):
+
+    def test_stream_sha256(self):
+        entry = download_hash.stream_sha256(self.session, self.upstream.url("/file"))
+        self.assertEqual(entry, {
+            "source": self.upstream.url("/file"),
+            "etag": '"v1"',
+            "last_modified": "Mon, 01 Jan 2024 00:00:00 GMT",
+            "sha256": SHA256,
+        })
+
+    def test_published_digest(self):
+        url = self.upstream.url("/file")
+        entry = download_hash.resolve_sha256(self.session, url, url + ".sha256")
+        self.assertEqual(entry["sha256"], SHA256)
+        self.assertEqual(entry["source"], url + ".sha256")
+        # the file itself is not downloaded
+        self.assertEqual(self.upstream.count("GET", "/file"), 0)
+
+    def test_missing_or_invalid_digest_file(self):
+        url = self.upstream.url("/file")
+        for digest_url in (self.upstream.url("/missing.sha256"), self.upstream.url("/garbage.sha256")):
+            entry = download_hash.resolve_sha256(self.session, url, digest_url)
+            self.assertEqual(entry["sha256"], SHA256)
+            self.assertEqual(entry["source"], url)
+        self.assertEqual(self.upstream.count("GET", "/file"), 2)
+
+    def test_verify_published_digest(self):
+        url = self.upstream.url("/file")
+        entry = download_hash.resolve_sha256(self.session, url, url + ".sha256", verify=True)
+        self.assertEqual(entry["sha256"], SHA256)
+        self.assertEqual(self.upstream.count("GET", "/file"), 1)
+
+        url = self.upstream.url("/wrong")
+        with self.assertRaisesRegex(ValueError, "does not match downloaded file"):
+            download_hash.resolve_sha256(self.session, url, url + ".sha256", verify=True)
+
+    def test_cache_revalidation(self):
+        url = self.upstream.url("/file")
+        cache = download_hash.DigestCache(os.path.join(self.tmp, "cache.json"))
+        cache.set(url, download_hash.stream_sha256(self.session, url))
+        cached = download_hash.DigestCache(cache.path).entry(url)
+
+        # same ETag upstream: only a HEAD request
+        self.assertIs(download_hash.resolve_sha256(self.session, url, cached=cached), cached)
+        self.assertEqual(self.upstream.count("HEAD", "/file"), 1)
+        self.assertEqual(self.upstream.count("GET", "/file"), 1)
+
+        # the file changed upstream: downloaded again
+        new_content = CONTENT + b"new"
+        self.upstream.files["/file"] = (new_content, '"v2"')
+        entry = download_hash.resolve_sha256(self.session, url, cached=cached)
+        self.assertEqual(entry["sha256"], hashlib.sha256(new_content).hexdigest())
+        self.assertEqual(entry["etag"], '"v2"')
+        self.assertEqual(self.upstream.count("GET", "/file"), 2)
+
+        # entries of older caches have no validators to revalidate with
+        entry = download_hash.resolve_sha256(self.session, url, cached={"sha256": SHA256})
+        self.assertEqual(self.upstream.count("GET", "/file"), 3)
+
+    def test_verify_ignores_current_cache_entries(self):
+        url = self.upstream.url("/file")
+        cached = download_hash.stream_sha256(self.session, url)
+        entry = download_hash.resolve_sha256(self.session, url, url + ".sha256", verify=True, cached=cached)
+        self.assertEqual(entry["sha256"], SHA256)
+        self.assertEqual(self.upstream.count("HEAD", "/file"), 0)
+        self.assertEqual(self.upstream.count("GET", "/file"), 2)
+
+    def test_legacy_cache_entries(self):
+        path = os.path.join(self.tmp, "cache.json")
+        with open(path, "w") as f:
+            f.write('{"https://example.com/file": "%s"}' % SHA256)
+        cache = download_hash.DigestCache(path)
+        self.assertEqual(cache.get("https://example.com/file"), SHA256)
+        self.assertEqual(cache.entry("https://example.com/file"), {"sha256": SHA256})
+
+
+class TestMain(UpstreamTestCase):
+
+    def setUp(self):
+        super().setUp()
+        component = download_hash.Component(
+            "fake", lambda version, arch, os: self.upstream.url("/file"),
+            download_hash.Versions("example/fake"), skip_archs=("arm", "arm64", "ppc64le"))
+        self.checksums = os.path.join(self.tmp, "checksums.yml")
+        for patch in (mock.patch.object(download_hash, "COMPONENTS", [component]),
+                      mock.patch.object(download_hash, "MAIN_YML", self.checksums),
+                      mock.patch.dict(download_hash._versions, {component.versions: ["v1.0.0"]})):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def run_main(self, known, *args):
+        with open(self.checksums, "w") as f:
+            f.write("---\nfake_checksums:\n  amd64:\n    v1.0.0: %s\n" % known)
+        with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()) as err:
+            rc = download_hash.main(["--only", "fake", "--cache", os.path.join(self.tmp, "cache.json")] + list(args))
+        with open(self.checksums) as f:
+            return rc, err.getvalue(), f.read()
+
+    def test_known_checksums_are_trusted(self):
+        rc, _, checksums = self.run_main(WRONG)
+        self.assertEqual(rc, 0)
+        self.assertIn("v1.0.0: %s" % WRONG, checksums)
+        self.assertEqual(self.upstream.requests, [])
+
+    def test_verify_mismatch(self):
+        rc, err, checksums = self.run_main(WRONG, "--verify")
+        self.assertEqual(rc, 1)
+        self.assertIn("does not match the known checksum %s" % WRONG, err)
+        self.assertIn("1 downloads failed", err)
+        # checksums.yml is left as it was
+        self.assertEqual(checksums, "---\nfake_checksums:\n  amd64:\n    v1.0.0: %s\n" % WRONG)
+
+    def test_verify(self):
+        rc, _, checksums = self.run_main(SHA256, "--verify")
+        self.assertEqual(rc, 0)
+        self.assertIn("v1.0.0: %s" % SHA256, checksums)
+        self.assertEqual(self.upstream.count("GET", "/file"), 1)
+
+    def test_revalidate(self):
+        self.assertEqual(self.run_main(SHA256, "--revalidate")[0], 0)
+        self.assertEqual(self.upstream.count("GET", "/file"), 1)
+        # the cached digest is still current upstream: a HEAD request only
+        rc = self.run_main(SHA256, "--revalidate")[0]
+        self.assertEqual(rc, 0)
+        self.assertEqual(self.upstream.count("HEAD", "/file"), 1)
+        self.assertEqual(self.upstream.count("GET", "/file"), 1)
+
+    def test_verify_downloads_cached_files_again(self):
+        self.assertEqual(self.run_main(SHA256, "--verify")[0], 0)
+        self.assertEqual(self.run_main(SHA256, "--verify")[0], 0)
+        self.assertEqual(self.upstream.count("HEAD", "/file"), 0)
+        self.assertEqual(self.upstream.count("GET", "/file"), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,368 @@
 #!/usr/bin/env python
 
+# Check the syntax of Jinja templates, and when Ansible is installed that
+# they only use filters and tests Ansible knows.
+#
+#   tests/scripts/check-templates.py roles/etcd/templates/etcd.env.j2 ...
+#   tests/scripts/check-templates.py --all
+#   tests/scripts/check-templates.py --all --analyze --top 20
+#
+# --all checks every *.j2 under roles/ (or --root) in a pool of processes.
+# The result of every template is cached by the sha256 of its content, so
+# only the templates that changed since the last run are parsed again.
+#
+# --analyze also reports, ranked from the most expensive, the patterns that
+# make a template or a role variable slow to render on every host of a large
+# cluster: loops over the hosts nested in loops over the hosts, filters and
+# membership tests over all the hosts inside such loops, hostvars of the same
+# host looked up again and again in a loop, and large inline literals. With
+# --all, the templated values of roles/*/defaults, roles/*/vars and
+# roles/*/tasks are analyzed too, e.g. the /etc/hosts block that preinstall
+# builds with set_fact.
+
+import argparse
+import hashlib
+import json
+import os
 import sys
-from jinja2 import Environment
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import jinja2
+from jinja2 import Environment, nodes
+
+CACHE_PATH = os.path.join(os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                          'kubespray', 'check-templates.json')
+# below this number of templates to parse, starting the pool costs more than it saves
+POOL_THRESHOLD = 32
+# bumped when the checks change, to not reuse the cached results
+CHECKS_VERSION = 3
+
+# variables holding a list of hosts
+HOST_LISTS = ('play_hosts', 'ansible_play_hosts', 'ansible_play_hosts_all', 'ansible_play_batch')
+# filters turning a list of hosts into a single value
+REDUCING_FILTERS = ('first', 'last', 'length', 'count', 'random', 'min', 'max', 'bool', 'int', 'string')
+# lookups of the same hostvars in a loop from which they are reported
+HOSTVARS_REPEAT = 2
+# items of an inline dict or list literal from which it is reported
+LARGE_LITERAL = 20
+
+env = None
+check_names = False
+
+
+def ansible_names():
+    """Return the names of the filters and tests of Ansible, None when it is not installed."""
+    try:
+        import yaml
+        from ansible.config import __file__ as config_init
+        from ansible.plugins.loader import filter_loader, test_loader
+    except ImportError:
+        return None
+    names = {'filter': set(), 'test': set()}
+    for kind, loader in (('filter', filter_loader), ('test', test_loader)):
+        for plugin in loader.all():
+            names[kind].add(plugin.ansible_name)
+            if plugin.ansible_name.startswith('ansible.builtin.'):
+                names[kind].add(plugin.ansible_name[len('ansible.builtin.'):])
+    # short names Ansible redirects to collections, like ipaddr
+    with open(os.path.join(os.path.dirname(config_init), 'ansible_builtin_runtime.yml')) as f:
+        routing = yaml.safe_load(f)['plugin_routing']
+    for kind in names:
+        names[kind].update(routing.get(kind, {}))
+    return dict((kind, sorted(values)) for kind, values in names.items())
+
+
+def init(names):
+    """Build the Environment shared by all the checks of a process."""
+    global env, check_names
+    env = Environment()
+    if names is not None:
+        # only the names matter to check the templates, not the functions
+        env.filters.update(dict.fromkeys(names['filter'], None))
+        env.tests.update(dict.fromkeys(names['test'], None))
+    check_names = names is not None
+
+
+def expr(node):
+    """Return a short source-like text of an expression, for the report."""
+    if isinstance(node, nodes.Name):
+        return node.name
+    if isinstance(node, nodes.Const):
+        return repr(node.value)
+    if isinstance(node, nodes.Getitem):
+        return '%s[%s]' % (expr(node.node), expr(node.arg))
+    if isinstance(node, nodes.Getattr):
+        return '%s.%s' % (expr(node.node), node.attr)
+    if isinstance(node, nodes.Filter):
+        return '%s | %s' % (expr(node.node), node.name)
+    if isinstance(node, nodes.Call):
+        return '%s()' % expr(node.node)
+    return '...'
+
+
+def is_name(node, name):
+    return isinstance(node, nodes.Name) and node.name == name
+
+
+def host_sized(node):
+    """Whether an expression is a collection with one item per host."""
+    if isinstance(node, nodes.Name):
+        return node.name in HOST_LISTS or node.name == 'hostvars'
+    if isinstance(node, (nodes.Getitem, nodes.Getattr)):
+        if is_name(node.node, 'groups'):
+            return True
+        # hostvars.values(), hostvars.items(), but not hostvars[host]
+        return is_name(node.node, 'hostvars') and isinstance(node, nodes.Getattr) and \
+            node.attr in ('keys', 'values', 'items')
+    if isinstance(node, nodes.Call):
+        return host_sized(node.node)
+    if isinstance(node, nodes.Filter):
+        return node.name not in REDUCING_FILTERS and (
+            host_sized(node.node) or any(host_sized(arg) for arg in node.args))
+    if isinstance(node, nodes.BinExpr):
+        return host_sized(node.left) or host_sized(node.right)
+    if isinstance(node, nodes.CondExpr):
+        return host_sized(node.expr1) or (node.expr2 is not None and host_sized(node.expr2))
+    if isinstance(node, nodes.List):
+        return any(host_sized(item) for item in node.items)
+    return False
+
+
+def order(loops):
+    return 'O(n)' if loops == 0 else 'O(n^%d)' % (loops + 1)
+
+
+class Analyzer:
+    """Find the expensive patterns of a template, as [line, rank, cost, message].
+
+    The cost of a pattern is the power of the number of hosts n it takes to
+    render the template once, so one per host, and rank sorts them with the
+    number of operations at the same power.
+    """
+
+    def __init__(self):
+        self.findings = {}
+
+    def add(self, line, power, weight, cost, message):
+        # a pattern spread over several nodes of the same line is reported once
+        key = (line, message)
+        if key not in self.findings or self.findings[key][1] < [power, weight]:
+            self.findings[key] = [line, [power, weight], cost, message]
+
+    def walk(self, node, loops=()):
+        """Walk node, loops being the enclosing loops over hosts."""
+        if isinstance(node, nodes.For):
+            inner = loops
+            # the loop itself is the finding when it is nested, not its list
+            if not (loops and host_sized(node.iter)):
+                self.walk(node.iter, loops)
+            if host_sized(node.iter):
+                if loops:
+                    self.add(node.lineno, len(loops) + 1, 1, order(len(loops)),
+                             'loop over %s nested in %d loop(s) over hosts' % (expr(node.iter), len(loops)))
+                inner = loops + (node,)
+                self.hostvars_lookups(node, len(inner))
+            for child in node.body + node.else_ + ([node.test] if node.test else []):
+                self.walk(child, inner)
+            return
+        if loops and isinstance(node, (nodes.Filter, nodes.Test)) and host_sized(node.node):
+            self.add(node.lineno, len(loops) + 1, 1, order(len(loops)),
+                     '%s of %s in a loop over hosts' % (node.name, expr(node.node)))
+            for arg in node.args + [kwarg.value for kwarg in node.kwargs]:
+                self.walk(arg, loops)
+            return
+        if loops and isinstance(node, nodes.Compare) and \
+                any(op.op in ('in', 'notin') and host_sized(op.expr) for op in node.ops):
+            hosts = next(op.expr for op in node.ops if op.op in ('in', 'notin') and host_sized(op.expr))
+            self.add(node.lineno, len(loops) + 1, 1, order(len(loops)),
+                     'membership test in %s in a loop over hosts' % expr(hosts))
+        if isinstance(node, (nodes.Dict, nodes.List)) and len(node.items) >= LARGE_LITERAL:
+            kind = 'dict' if isinstance(node, nodes.Dict) else 'list'
+            self.add(node.lineno, len(loops), len(node.items), order(len(loops) - 1) if loops else 'O(1)',
+                     'inline %s literal of %d items built at every render' % (kind, len(node.items)))
+            return
+        for child in node.iter_child_nodes():
+            self.walk(child, loops)
+
+    def hostvars_lookups(self, loop, power):
+        lookups = {}
+        for node in loop.find_all(nodes.Getitem):
+            if is_name(node.node, 'hostvars'):
+                lookups.setdefault(expr(node.arg), []).append(node)
+        for host, found in sorted(lookups.items()):
+            if len(found) >= HOSTVARS_REPEAT:
+                self.add(loop.lineno, power, len(found), '%d x %s' % (len(found), order(power - 1)),
+                         'hostvars[%s] looked up %d times in a loop over hosts, set it once' % (host, len(found)))
+
+
+def analyze(ast, offset=0):
+    analyzer = Analyzer()
+    analyzer.walk(ast)
+    return [[line + offset, rank, cost, message] for line, rank, cost, message in analyzer.findings.values()]
+
+
+def check(item):
+    """Return the [line, message] errors and the findings of a template or of a YAML file of variables."""
+    kind, source = item
+    if kind == 'yaml':
+        return check_yaml(source)
+    try:
+        ast = env.parse(source)
+    except jinja2.TemplateSyntaxError as e:
+        return {'errors': [[e.lineno, e.message]], 'findings': []}
+    errors = []
+    if check_names:
+        for node in ast.find_all((nodes.Filter, nodes.Test)):
+            kind, known = ('filter', env.filters) if isinstance(node, nodes.Filter) else ('test', env.tests)
+            # filters of collections, like ansible.utils.ipaddr, can't be known without them
+            if node.name not in known and '.' not in node.name:
+                errors.append([node.lineno, 'no %s named %r' % (kind, node.name)])
+    return {'errors': errors, 'findings': analyze(ast)}
+
+
+def check_yaml(source):
+    """Analyze the templated values of a YAML file of variables or tasks.
+
+    They are not all Jinja (a task may only pass a string with {{ to a
+    module), so errors are ignored.
+    """
+    import yaml
+
+    findings = []
+    try:
+        pending = [yaml.compose(source, Loader=yaml.SafeLoader)]
+    except yaml.YAMLError:
+        return {'errors': [], 'findings': []}
+    while pending:
+        node = pending.pop()
+        if isinstance(node, yaml.MappingNode):
+            pending.extend(value for _, value in node.value)
+        elif isinstance(node, yaml.SequenceNode):
+            pending.extend(node.value)
+        elif isinstance(node, yaml.ScalarNode) and ('{{' in node.value or '{%' in node.value):
+            try:
+                ast = env.parse(node.value)
+            except jinja2.TemplateSyntaxError:
+                continue
+            # the value of a block scalar starts on the line after its indicator
+            offset = node.start_mark.line + (1 if node.style in ('|', '>') else 0)
+            findings += analyze(ast, offset)
+    return {'errors': [], 'findings': findings}
+
+
+def ansible_release():
+    """Identify the installed Ansible, cheaply compared to loading its plugins."""
+    try:
+        import ansible.release
+    except ImportError:
+        return None
+    return [ansible.release.__version__, os.path.dirname(ansible.release.__file__)]
+
+
+class Cache:
+    """Errors of the templates by sha256 of their content, for one version of the checks.
+
+    The names of the filters and tests of Ansible are kept too, loading all
+    its plugins takes longer than checking a few templates.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.ansible = ansible_release()
+        cache = {}
+        if path:
+            try:
+                with open(path) as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                pass
+        if 'names' in cache and cache.get('ansible') == self.ansible:
+            self.names = cache['names']
+        else:
+            self.names = ansible_names() if self.ansible else None
+        self.key = hashlib.sha256(json.dumps([CHECKS_VERSION, jinja2.__version__, self.names]).encode()).hexdigest()
+        self.results = cache.get('results', {}) if cache.get('key') == self.key else {}
+        self.changed = cache.get('key') != self.key
+
+    def update(self, results):
+        self.results.update(results)
+        self.changed = self.changed or bool(results)
+
+    def save(self):
+        if not self.path or not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = '%s.%d' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'ansible': self.ansible, 'names': self.names, 'key': self.key, 'results': self.results}, f)
+        os.replace(tmp, self.path)
+
+
+def check_all(sources, jobs, names):
+    """Check the sources, in a pool of processes when there are enough of them."""
+    if len(sources) < POOL_THRESHOLD or jobs == 1:
+        init(names)
+        return [check(source) for source in sources]
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init, initargs=(names,)) as executor:
+        return list(executor.map(check, sources, chunksize=max(len(sources) // (4 * (jobs or os.cpu_count())), 1)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the syntax of Jinja templates')
+    parser.add_argument('templates', nargs='*', help='templates to check')
+    parser.add_argument('--all', action='store_true', help='check every *.j2 under --root')
+    parser.add_argument('--root', default='roles', help='directory searched by --all (default: roles)')
+    parser.add_argument('--jobs', type=int, help='processes parsing the templates (default: number of CPUs)')
+    parser.add_argument('--cache', default=CACHE_PATH, help='cache file (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true', help='parse every template again')
+    parser.add_argument('--analyze', action='store_true', help='report the patterns expensive to render')
+    parser.add_argument('--top', type=int, help='only report the TOP most expensive patterns')
+    args = parser.parse_args(argv)
+
+    templates = list(args.templates)
+    if args.all:
+        templates += sorted(str(p) for p in Path(args.root).rglob('*.j2'))
+        if args.analyze:
+            templates += sorted(str(p) for p in Path(args.root).rglob('*.yml')
+                                if {'defaults', 'vars', 'tasks'} & set(p.parts))
+
+    cache = Cache(None if args.no_cache else args.cache)
+    sources = {}
+    digests = []
+    for template in templates:
+        with open(template, 'rb') as t:
+            content = t.read()
+        kind = 'yaml' if template.endswith(('.yml', '.yaml')) else 'jinja'
+        sha = hashlib.sha256(kind.encode() + b'\0' + content).hexdigest()
+        sources.setdefault(sha, (kind, content.decode()))
+        digests.append((template, sha))
+    missing = [sha for sha in sources if sha not in cache.results]
+    cache.update(zip(missing, check_all([sources[sha] for sha in missing], args.jobs, cache.names)))
+    cache.save()
+
+    failed = 0
+    findings = []
+    for template, sha in digests:
+        for line, message in cache.results[sha]['errors']:
+            print('%s:%s: %s' % (template, line, message))
+            failed += 1
+        findings += [('%s:%s' % (template, line), rank, cost, message)
+                     for line, rank, cost, message in cache.results[sha]['findings']]
+    if args.analyze:
+        report(findings, args.top)
+    return 1 if failed else 0
+
+
+def report(findings, top=None):
+    findings.sort(key=lambda finding: (-finding[1][0], -finding[1][1], finding[0]))
+    shown = findings[:top] if top else findings
+    print('%d of %d expensive patterns, most expensive first (n: number of hosts)' % (len(shown), len(findings)))
+    if shown:
+        width = max(len(location) for location, _, _, _ in shown)
+        for index, (location, _, cost, message) in enumerate(shown, 1):
+            print('%4d  %-12s  %-*s  %s' % (index, cost, width, location, message))
+
 
-env = Environment()
-for template in sys.argv[1:]:
-    with open(template) as t:
-        env.parse(t.read())
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,96 +1,143 @@
 #!/usr/bin/env python
 import argparse
+import json
 import sys
-import glob
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import yaml
-from pydblite import Base
 import re
 import jinja2
-import sys
-
-from pprint import pprint
-
 
-parser = argparse.ArgumentParser(description='Generate a Markdown table representing the CI test coverage')
-parser.add_argument('--dir', default='tests/files/', help='folder with test yml files')
+# libyaml is much faster when pyyaml was built with it
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
+env = jinja2.Environment(loader=jinja2.FileSystemLoader(searchpath=str(Path(__file__).parent)))
 
-args = parser.parse_args()
-p = Path(args.dir)
-
-env = jinja2.Environment(loader=jinja2.FileSystemLoader(searchpath=sys.path[0]))
 
 # Data represents CI coverage data matrix
 class Data:
     def __init__(self):
-        self.db = Base(':memory:')
-        self.db.create('container_manager', 'network_plugin', 'operating_system')
-
+        # (container_manager, network_plugin, operating_system) -> test files
+        self.files = {}
+        self._index = None
+
+    def set(self, container_manager, network_plugin, operating_system, file=None):
+        files = self.files.setdefault((container_manager, network_plugin, operating_system), [])
+        if file is not None:
+            files.append(file)
+        self._index = None
+
+    def _build(self):
+        # built once after loading, every lookup is then a set membership
+        # and the axes are sorted only once for the whole table
+        if self._index is None:
+            self._index = frozenset(self.files)
+            self._axes = tuple(sorted(set(values)) for values in zip(*self._index)) or ([], [], [])
+        return self._index
 
-    def set(self, container_manager, network_plugin, operating_system):
-        self.db.insert(container_manager=container_manager, network_plugin=network_plugin, operating_system=operating_system)
-        self.db.commit()
     def exists(self, container_manager, network_plugin, operating_system):
-        return len((self.db("container_manager") == container_manager) & (self.db("network_plugin") == network_plugin) & (self.db("operating_system") == operating_system)) > 0
+        return (container_manager, network_plugin, operating_system) in self._build()
 
-    def jinja(self):
-        template = env.get_template('table.md.j2')
-        container_engines = list(self.db.get_unique_ids('container_manager'))
-        network_plugins = list(self.db.get_unique_ids("network_plugin"))
-        operating_systems = list(self.db.get_unique_ids("operating_system"))
+    @property
+    def container_engines(self):
+        self._build()
+        return self._axes[0]
+
+    @property
+    def network_plugins(self):
+        self._build()
+        return self._axes[1]
 
-        container_engines.sort()
-        network_plugins.sort()
-        operating_systems.sort()
+    @property
+    def operating_systems(self):
+        self._build()
+        return self._axes[2]
 
+    def jinja(self):
+        template = env.get_template('table.md.j2')
         return template.render(
-            container_engines=container_engines,
-            network_plugins=network_plugins,
-            operating_systems=operating_systems,
+            container_engines=self.container_engines,
+            network_plugins=self.network_plugins,
+            operating_systems=self.operating_systems,
             exists=self.exists
         )
 
     def markdown(self):
         out = ''
-        for container_manager in self.db.get_unique_ids('container_manager'):
+        for container_manager in self.container_engines:
             # Prepare the headers
             out += "# " + container_manager + "\n"
             headers = '|OS / CNI| '
             underline = '|----|'
-            for network_plugin in self.db.get_unique_ids("network_plugin"):
+            for network_plugin in self.network_plugins:
                 headers += network_plugin + ' | '
                 underline += '----|'
             out += headers + "\n" + underline + "\n"
-            for operating_system in self.db.get_unique_ids("operating_system"):
+            for operating_system in self.operating_systems:
                 out += '| ' + operating_system + ' | '
-                for network_plugin in self.db.get_unique_ids("network_plugin"):
+                for network_plugin in self.network_plugins:
                     if self.exists(container_manager, network_plugin, operating_system):
                         emoji = ':white_check_mark:'
                     else:
                         emoji = ':x:'
                     out += emoji + ' | '
                 out += "\n"
-
-        pprint(self.db.get_unique_ids('operating_system'))
-        pprint(self.db.get_unique_ids('network_plugin'))
         return out
 
+    def json(self):
+        return json.dumps({
+            'container_engines': self.container_engines,
+            'network_plugins': self.network_plugins,
+            'operating_systems': self.operating_systems,
+            'coverage': [
+                dict(container_manager=c, network_plugin=n, operating_system=o, files=sorted(self.files[(c, n, o)]))
+                for c, n, o in sorted(self._build())
+            ],
+        }, indent=2)
 
 
-if not p.is_dir():
-    print("Path is not a directory")
-    sys.exit(2)
-
-data = Data()
-files = p.glob('*.yml')
-for f in files:
-    y = yaml.load(f.open(), Loader=yaml.FullLoader)
+def parse(f):
+    with f.open() as stream:
+        y = yaml.load(stream, Loader=Loader) or {}
 
     container_manager = y.get('container_manager', 'containerd')
     network_plugin = y.get('kube_network_plugin', 'calico')
     x = re.match(r"^[a-z-]+_([a-z0-9]+).*", f.name)
     operating_system = x.group(1)
-    data.set(container_manager=container_manager, network_plugin=network_plugin, operating_system=operating_system)
-#print(data.markdown())
-print(data.jinja())
+    return container_manager, network_plugin, operating_system
+
+
+def load(path):
+    data = Data()
+    files = sorted(path.glob('*.yml'))
+    with ThreadPoolExecutor() as executor:
+        for f, (container_manager, network_plugin, operating_system) in zip(files, executor.map(parse, files)):
+            data.set(container_manager=container_manager, network_plugin=network_plugin,
+                     operating_system=operating_system, file=f.name)
+    return data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a Markdown table representing the CI test coverage')
+    parser.add_argument('--dir', default='tests/files/', help='folder with test yml files')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the coverage matrix as JSON to FILE, - for stdout instead of the table')
+    args = parser.parse_args(argv)
+    p = Path(args.dir)
+
+    if not p.is_dir():
+        print("Path is not a directory")
+        return 2
+
+    data = load(p)
+    if args.json == '-':
+        print(data.json())
+        return 0
+    if args.json:
+        Path(args.json).write_text(data.json() + "\n")
+    print(data.jinja())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import yaml
+
+from main import Loader, load
+
+AXES = ('container_manager', 'network_plugin', 'operating_system')
+
+# changed paths that no CI scenario tests
+IGNORED = ('docs/', 'contrib/', '.github/', 'logo/')
+
+# roles of container-engine/ and network_plugin/ and the axis values they are tested with,
+# the others of these directories are used with any value of their axis
+ROLE_VALUES = {
+    'container-engine/containerd': ('container_manager', ['containerd']),
+    'container-engine/containerd-common': ('container_manager', ['containerd', 'docker']),
+    'container-engine/nerdctl': ('container_manager', ['containerd']),
+    'container-engine/cri-o': ('container_manager', ['crio']),
+    'container-engine/skopeo': ('container_manager', ['crio']),
+    'container-engine/docker': ('container_manager', ['docker']),
+    'container-engine/docker-storage': ('container_manager', ['docker']),
+    'container-engine/cri-dockerd': ('container_manager', ['docker']),
+    'network_plugin/calico_defaults': ('network_plugin', ['calico']),
+}
+
+# roles only deployed when a scenario enables them with a variable
+ROLE_VARIABLES = {
+    'network_plugin/multus': 'kube_network_plugin_multus',
+    'container-engine/kata-containers': 'kata_containers_enabled',
+    'container-engine/gvisor': 'gvisor_enabled',
+    'container-engine/crun': 'crun_enabled',
+    'container-engine/youki': 'youki_enabled',
+}
+
+# roles whose tasks differ per operating system
+OS_ROLES = ('bootstrap-os',)
+
+# directories of roles holding other roles
+ROLE_GROUPS = ('container-engine', 'network_plugin', 'kubernetes', 'kubernetes-apps')
+
+
+def role_of(path):
+    """Return the role of a changed path, None when it is not in roles/."""
+    parts = Path(path).parts
+    if len(parts) < 3 or parts[0] != 'roles':
+        return None
+    if parts[1] in ROLE_GROUPS and len(parts) > 3:
+        return '/'.join(parts[1:3])
+    return parts[1]
+
+
+def scenarios(data, directory):
+    """Return {file: (triple, set of enabled ROLE_VARIABLES)} of the CI scenarios."""
+    result = {}
+    for triple, files in data.files.items():
+        for name in files:
+            with (directory / name).open() as stream:
+                y = yaml.load(stream, Loader=Loader) or {}
+            result[name] = (triple, set(v for v in ROLE_VARIABLES.values() if y.get(v)))
+    return result
+
+
+def covers(triple, variables):
+    """Return the requirements met by a scenario: its axis values, their pairs and its variables."""
+    values = list(zip(AXES, triple))
+    elements = set(values)
+    elements.update((a, b) for i, a in enumerate(values) for b in values[i + 1:])
+    elements.update(('variable', v) for v in variables)
+    return elements
+
+
+def requirements(paths, data, directory, all_scenarios):
+    """Return (changed roles, requirements, scenarios to always run, requirements no scenario meets)."""
+    axes = dict(zip(AXES, (data.container_engines, data.network_plugins, data.operating_systems)))
+    triples = [triple for triple, _ in all_scenarios.values()]
+    required, forced, roles, uncovered = set(), set(), set(), set()
+
+    def pairs_of(axis, value):
+        # every existing combination of the value with the values of the other axes
+        index = AXES.index(axis)
+        for triple in triples:
+            if triple[index] == value:
+                for other, other_value in zip(AXES, triple):
+                    if other != axis:
+                        pair = sorted([(axis, value), (other, other_value)], key=lambda e: AXES.index(e[0]))
+                        required.add(tuple(pair))
+
+    def everything(*names):
+        for name in names:
+            required.update((name, value) for value in axes[name])
+
+    for path in paths:
+        if path.startswith(IGNORED) or path.endswith('.md'):
+            continue
+        if Path(path).parent == directory:
+            # a scenario, or the Vagrantfile settings of one
+            if Path(path).stem + '.yml' in all_scenarios:
+                forced.add(Path(path).stem + '.yml')
+            continue
+        role = role_of(path)
+        if role is None:
+            everything(*AXES)
+            continue
+        roles.add(role)
+        group, _, name = role.partition('/')
+        if role in ROLE_VARIABLES:
+            variable = ROLE_VARIABLES[role]
+            if any(variable in variables for _, variables in all_scenarios.values()):
+                required.add(('variable', variable))
+            else:
+                uncovered.add('%s: no scenario sets %s' % (role, variable))
+        elif role in ROLE_VALUES or (group == 'network_plugin' and name in axes['network_plugin']):
+            axis, values = ROLE_VALUES.get(role, ('network_plugin', [name]))
+            for value in values:
+                pairs_of(axis, value)
+        elif group in ('container-engine', 'network_plugin'):
+            everything('container_manager' if group == 'container-engine' else 'network_plugin')
+        elif role in OS_ROLES:
+            everything('operating_system')
+        else:
+            everything(*AXES)
+    return roles, required, forced, uncovered
+
+
+def plan(paths, data, directory):
+    """Select with a greedy set cover the fewest scenarios meeting the requirements of the changed paths."""
+    all_scenarios = scenarios(data, directory)
+    roles, required, forced, uncovered = requirements(paths, data, directory, all_scenarios)
+    coverage = dict((name, covers(*scenario)) for name, scenario in all_scenarios.items())
+
+    selected = sorted(forced)
+    remaining = set(required)
+    for name in selected:
+        remaining -= coverage[name]
+    while remaining:
+        # the scenario meeting the most remaining requirements, by name on a tie
+        name = min(coverage, key=lambda n: (-len(coverage[n] & remaining), n))
+        if not coverage[name] & remaining:
+            break
+        selected.append(name)
+        remaining -= coverage[name]
+    uncovered.update(describe(element) for element in remaining)
+
+    jobs = []
+    for name in selected:
+        triple, _ = all_scenarios[name]
+        jobs.append(dict(
+            name=Path(name).stem,
+            file=str(directory / name),
+            covers=sorted(describe(e) for e in coverage[name] & required),
+            **dict(zip(AXES, triple))))
+    return {
+        'changed_roles': sorted(roles),
+        'requirements': len(required),
+        'scenarios': len(all_scenarios),
+        'jobs': jobs,
+        'uncovered': sorted(uncovered),
+    }
+
+
+def describe(element):
+    if element[0] == 'variable':
+        return '%s=true' % element[1]
+    if isinstance(element[0], tuple):
+        return ' + '.join('%s=%s' % e for e in element)
+    return '%s=%s' % element
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Select the fewest CI scenarios covering the roles, CNIs and container managers of a change')
+    parser.add_argument('--dir', default='tests/files/', help='folder with test yml files')
+    parser.add_argument('--base', default='origin/master', help='git ref the change is compared to')
+    parser.add_argument('--changed', metavar='FILE',
+                        help='file listing the changed paths, - for stdin, instead of git diff with --base')
+    args = parser.parse_args(argv)
+
+    if args.changed:
+        stream = sys.stdin if args.changed == '-' else open(args.changed)
+        paths = [line.strip() for line in stream if line.strip()]
+    else:
+        paths = subprocess.run(['git', 'diff', '--name-only', '--relative', args.base + '...HEAD'],
+                               check=True, capture_output=True, text=True).stdout.split()
+
+    directory = Path(args.dir)
+    print(json.dumps(plan(paths, load(directory), Path(directory.as_posix().rstrip('/'))), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
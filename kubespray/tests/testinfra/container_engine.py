@@ -0,0 +1,85 @@
+"""Fixtures shared by the testinfra tests of the container-engine molecule scenarios.
+
+The conftest.py of each scenario imports this module. With pytest-xdist and
+--dist loadgroup (see the verifier options of molecule.yml) the tests of a
+host all run on the same worker, so its connection and the module scoped
+fixtures below are set up once per host while the hosts are checked in
+parallel.
+"""
+import os
+import shlex
+
+import pytest
+import testinfra.utils.ansible_runner
+
+CRICTL = '/usr/local/bin/crictl'
+NERDCTL = '/usr/local/bin/nerdctl'
+HELLO_WORLD = 'quay.io/kubespray/hello-world:latest'
+HELLO_WORLD_TAR = '/tmp/hello-world.tar'
+HELLO_FROM_DOCKER = 'Hello from Docker'
+
+
+def inventory_hosts():
+    """Return the hosts of the molecule inventory.
+
+    The runner is the one the ansible backend of testinfra uses too, so the
+    inventory is only read once per process.
+    """
+    runner = testinfra.utils.ansible_runner.AnsibleRunner.get_runner(os.environ['MOLECULE_INVENTORY_FILE'])
+    return runner.get_hosts('all')
+
+
+# before pytest-xdist, which reads the groups in its own hook
+@pytest.hookimpl(tryfirst=True)
+def pytest_collection_modifyitems(config, items):
+    if not config.pluginmanager.hasplugin('xdist'):
+        return
+    for item in items:
+        callspec = getattr(item, 'callspec', None)
+        if callspec is not None and '_testinfra_host' in callspec.params:
+            host = callspec.params['_testinfra_host']
+            item.add_marker(pytest.mark.xdist_group(host.backend.get_pytest_id()))
+
+
+def run(host, command):
+    """Run a command as root and fail the test with its output when it does not succeed."""
+    with host.sudo():
+        cmd = host.run(command)
+    assert cmd.rc == 0, '%s failed with %d:\n%s%s' % (command, cmd.rc, cmd.stdout, cmd.stderr)
+    return cmd
+
+
+def run_pod(host, log, runtime=None, expected=HELLO_FROM_DOCKER, timeout=60):
+    """Run the pod the scenario prepared in /tmp with crictl and return the content of its log.
+
+    The container may only write to its log after crictl returns, once the
+    runtime booted its VM or sandbox, so the log is polled for the expected
+    output for up to timeout seconds. Running the pod, waiting and reading
+    the log is a single round trip to the host.
+    """
+    command = CRICTL + ' run --with-pull'
+    if runtime is not None:
+        command += ' --runtime ' + runtime
+    wait = 'timeout %d sh -c %s %s %s' % (
+        timeout, shlex.quote('until grep -qF "$0" "$1" 2>/dev/null; do sleep 1; done'),
+        shlex.quote(expected), shlex.quote(log))
+    return run(host, '%s /tmp/container.json /tmp/sandbox.json && { %s; cat %s; }' % (command, wait, log)).stdout
+
+
+@pytest.fixture(scope='module')
+def hello_world_tar(host):
+    """Pull and save the hello-world image once per host.
+
+    An archive left by a previous run of the verifier is reused, remove it to
+    test the pull again.
+    """
+    run(host, 'test -s {tar} || {{ {nerdctl} pull {image} && {nerdctl} save -o {tar} {image}; }}'.format(
+        tar=HELLO_WORLD_TAR, nerdctl=NERDCTL, image=HELLO_WORLD))
+    return HELLO_WORLD_TAR
+
+
+@pytest.fixture(scope='module')
+def hello_world_image(host, hello_world_tar):
+    """Load the saved hello-world image in the namespace of the kubelet, once per host."""
+    run(host, '%s -n k8s.io load < %s' % (NERDCTL, hello_world_tar))
+    return HELLO_WORLD
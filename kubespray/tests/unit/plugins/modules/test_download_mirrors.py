@@ -0,0 +1,97 @@
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), *[os.pardir] * 4, "plugins", "modules"))
+import download_mirrors  # noqa: E402
+
+DATA = os.urandom(64 * 1024 + 3)
+
+
+class Failed(Exception):
+    pass
+
+
+class FakeModule(object):
+
+    params = dict(timeout=10, validate_certs=True, url_username=None, url_password=None, force_basic_auth=False)
+
+    def fail_json(self, **kwargs):
+        raise Failed(kwargs['msg'])
+
+    def digest_from_file(self, path, algorithm):
+        with open(path, 'rb') as f:
+            return hashlib.new(algorithm, f.read()).hexdigest()
+
+
+class FakeResponse(object):
+
+    def __init__(self, data):
+        self.body = io.BytesIO(data)
+
+    def getcode(self):
+        return 206
+
+    def read(self, size):
+        return self.body.read(size)
+
+
+class FakeFetcher(download_mirrors.MirrorFetcher):
+    """Serves the ranges of DATA after the delay of each mirror, the mirrors in broken fail instead."""
+
+    def __init__(self, broken, delays=None):
+        super().__init__(FakeModule())
+        self.broken = broken
+        self.delays = delays or {}
+        self.requests = []
+
+    def _get(self, url, start=None, end=None):
+        self.requests.append((url, start, end))
+        time.sleep(self.delays.get(url, 0))
+        if url in self.broken:
+            raise IOError('connection reset')
+        return FakeResponse(DATA[start:end + 1])
+
+
+class TestFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.dest = os.path.join(self.tmp, 'file')
+
+    def fetch(self, fetcher, urls, segments=4):
+        mirrors = [dict(url=url, ok=True, ranges=True) for url in urls]
+        return fetcher.fetch(mirrors, self.dest, len(DATA), segments)
+
+    def test_segments(self):
+        fetcher = FakeFetcher(broken=())
+        part, sha256 = self.fetch(fetcher, ['http://a/file', 'http://b/file'])
+        self.assertEqual(sha256, hashlib.sha256(DATA).hexdigest())
+        with open(part, 'rb') as f:
+            self.assertEqual(f.read(), DATA)
+        self.assertEqual(len(fetcher.requests), 4)
+
+    def test_range_failing_after_the_others_are_done(self):
+        # b fails its range once a has fetched all the others and found
+        # the queue empty: a still takes it over
+        fetcher = FakeFetcher(broken=('http://b/file',), delays={'http://a/file': 0.05, 'http://b/file': 0.3})
+        part, sha256 = self.fetch(fetcher, ['http://a/file', 'http://b/file'])
+        self.assertEqual(sha256, hashlib.sha256(DATA).hexdigest())
+        self.assertEqual(len([r for r in fetcher.requests if r[0] == 'http://b/file']), 1)
+        self.assertEqual(len([r for r in fetcher.requests if r[0] == 'http://a/file']), 4)
+
+    def test_every_mirror_failing(self):
+        fetcher = FakeFetcher(broken=('http://a/file', 'http://b/file'))
+        with self.assertRaisesRegex(Failed, 'Failed to download .* from any mirror'):
+            self.fetch(fetcher, ['http://a/file', 'http://b/file'])
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+
+
+if __name__ == '__main__':
+    unittest.main()